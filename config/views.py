@@ -7,7 +7,7 @@ from .models import Module, ModulePermission
 from qm.models import TasksStatus
 from notifications.utils import add_debug_notification, add_error_notification, add_success_notification
 from .utils import check_group_permission
-from celery import current_app
+from qm.utils import revoke_task
 
 DEBUG = settings.DEBUG
 
@@ -97,11 +97,10 @@ def task_status(request, task_id):
 def stop_running_task(request, task_id):
     try:
         task = get_object_or_404(TasksStatus, pk=task_id)
-        # without signal='SIGKILL', the task is not cancelled immediately
-        current_app.control.revoke(task.taskid, terminate=True, signal='SIGKILL')
+        # revoke the task and its subtasks (distributed campaigns)
+        revoke_task(task)
         # delete task in DB
-        celery_status = get_object_or_404(TasksStatus, taskid=task.taskid)
-        celery_status.delete()
+        task.delete()
         add_success_notification(f'Celery Task {task.taskname} terminated')
         return HttpResponse('Task terminated')
     except Exception as e:
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Connector, ConnectorConf
+from .models import Connector, ConnectorConf, QueryCache, CircuitBreaker
 
 class ConnectorAdmin(admin.ModelAdmin):
     list_display = ('name', 'description', 'installed', 'enabled', 'domain')
@@ -11,5 +11,16 @@ class ConnectorConfAdmin(admin.ModelAdmin):
     list_filter = ['connector', 'key', 'fieldtype']
     search_fields = ['key', 'value', 'description']
 
+class QueryCacheAdmin(admin.ModelAdmin):
+    list_display = ('connector', 'query_hash', 'from_date', 'to_date', 'date')
+    list_filter = ['connector', 'date']
+    search_fields = ['query_hash']
+
+class CircuitBreakerAdmin(admin.ModelAdmin):
+    list_display = ('connector', 'state', 'consecutive_failures', 'date_opened')
+    list_filter = ['state']
+
 admin.site.register(Connector, ConnectorAdmin)
 admin.site.register(ConnectorConf, ConnectorConfAdmin)
+admin.site.register(QueryCache, QueryCacheAdmin)
+admin.site.register(CircuitBreaker, CircuitBreakerAdmin)
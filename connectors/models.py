@@ -46,4 +46,39 @@ class ConnectorConf(models.Model):
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['connector', 'key'], name='unique_connector_key')
-        ]
\ No newline at end of file
+        ]
+
+class QueryCache(models.Model):
+    connector = models.ForeignKey(Connector, on_delete=models.CASCADE)
+    query_hash = models.CharField(max_length=64, help_text="SHA256 of the normalized query")
+    from_date = models.CharField(max_length=32)
+    to_date = models.CharField(max_length=32)
+    result = models.JSONField()
+    date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.connector.name}:{self.query_hash[:12]} ({self.from_date} - {self.to_date})"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['connector', 'query_hash', 'from_date', 'to_date'], name='unique_query_cache')
+        ]
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+        verbose_name_plural = "Query cache"
+
+class CircuitBreaker(models.Model):
+    STATE_CHOICES = [
+        ('CLOSED', 'Closed'),
+        ('OPEN', 'Open'),
+    ]
+
+    connector = models.OneToOneField(Connector, on_delete=models.CASCADE, primary_key=True)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default='CLOSED')
+    consecutive_failures = models.IntegerField(default=0, help_text="Number of consecutive failures when the circuit breaker was opened")
+    last_error = models.TextField(blank=True)
+    date_opened = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.connector.name}: {self.state}"
@@ -0,0 +1,147 @@
+"""
+Replay connector.
+Serves recorded connector responses instead of querying a data lake, with a configurable latency, so that campaigns
+and stats regeneration can be benchmarked offline (see the bench_campaign management command).
+This is not a plugin: it is registered by the benchmark commands only (bench_campaign, bench_reports), and is never
+installed. Analytics of generated datasets (see the generate_dataset management command) use it as well.
+
+Recorded responses (fixtures) are exported from the query cache, which stores the results of real "query" calls
+(see connectors.utils.set_cached_result). Analytics of the replay connector hold the hash of the recorded query
+in their "query" field, optionally followed by a suffix (after a space) so that several analytics can replay the same
+recorded query without being deduplicated by the campaign engine.
+When no response is recorded for a query, a synthetic (but deterministic) result is generated.
+"""
+
+import json
+import random
+from time import sleep
+from connectors.models import Connector, QueryCache
+
+CONNECTOR_NAME = 'replay'
+
+# Latency of each query, in seconds (see configure)
+LATENCY = 0
+JITTER = 0
+# Recorded responses {query_hash: {(from_date, to_date): result}}
+FIXTURES = {}
+
+# Synthetic results: number of endpoints follows a Pareto distribution (most queries have few hits, some have many)
+SYNTHETIC_HOSTS = 5000
+SYNTHETIC_SITES = 20
+SYNTHETIC_MAX_ENDPOINTS = 200
+
+
+def configure(latency=0, jitter=0, fixtures=None):
+    """
+    Configure the replay connector.
+    :param latency: Mean latency of each query, in seconds.
+    :param jitter: Maximum deviation from the mean latency, in seconds (uniformly distributed).
+    :param fixtures: Recorded responses, as returned by load_fixtures.
+    """
+    global LATENCY, JITTER, FIXTURES
+    LATENCY = latency
+    JITTER = jitter
+    FIXTURES = fixtures or {}
+
+def create_connector():
+    """
+    Create the replay connector in DB (installed and enabled, so that its analytics are run by campaigns and shown in reports).
+    :return: Connector object.
+    """
+    connector, created = Connector.objects.update_or_create(
+        name=CONNECTOR_NAME,
+        defaults={
+            'description': 'Replay of recorded responses (benchmark)',
+            'domain': 'analytics',
+            'installed': True,
+            'enabled': True
+        })
+    return connector
+
+def record_fixtures(path, connector_name=None):
+    """
+    Export the results of real queries (query cache) to a fixtures file.
+    :param path: Path of the JSON file.
+    :param connector_name: Only export the results of this connector (all connectors if not set).
+    :return: Number of recorded responses.
+    """
+    entries = QueryCache.objects.select_related('connector').order_by('pk')
+    if connector_name:
+        entries = entries.filter(connector__name=connector_name)
+    fixtures = [
+        {
+            'connector': entry.connector.name,
+            'query_hash': entry.query_hash,
+            'from_date': entry.from_date,
+            'to_date': entry.to_date,
+            'result': entry.result
+        }
+        for entry in entries
+    ]
+    with open(path, 'w') as f:
+        json.dump(fixtures, f)
+    return len(fixtures)
+
+def load_fixtures(path):
+    """
+    Load a fixtures file (see record_fixtures).
+    :param path: Path of the JSON file.
+    :return: Dictionary {query_hash: {(from_date, to_date): result}}.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    fixtures = {}
+    for entry in entries:
+        fixtures.setdefault(entry['query_hash'], {})[(entry['from_date'], entry['to_date'])] = entry['result']
+    return fixtures
+
+def synthetic_result(query, from_date):
+    """
+    Generate a deterministic result for a query and a time window.
+    :param query: Query string.
+    :param from_date: Start date of the query, in isoformat.
+    :return: List of [endpoint name, site name, number of events, storylineIDs].
+    """
+    rng = random.Random(f"{query}|{from_date}")
+    nb_endpoints = min(int(rng.paretovariate(1.2)) - 1, SYNTHETIC_MAX_ENDPOINTS)
+    hosts = rng.sample(range(SYNTHETIC_HOSTS), nb_endpoints)
+    return [
+        [f"host-{host:05d}", f"site-{host % SYNTHETIC_SITES:02d}", rng.randint(1, 500), ""]
+        for host in hosts
+    ]
+
+def query(analytic, from_date=None, to_date=None, debug=False):
+    """
+    Replay the recorded response of a query.
+    The response recorded for the same time window is used if available, otherwise one of the responses recorded
+    for the query (so that a few days of recording can feed a 90 days benchmark).
+    :return: Recorded (or synthetic) result, same format as the "query" function of the connectors.
+    """
+    sleep(max(0, LATENCY + random.uniform(-JITTER, JITTER)))
+
+    # the suffix of the query (if any) is ignored
+    recorded = FIXTURES.get(analytic.query.split(' ')[0].strip())
+    if not recorded:
+        return synthetic_result(analytic.query, from_date)
+    if (from_date, to_date) in recorded:
+        return recorded[(from_date, to_date)]
+    windows = sorted(recorded)
+    return recorded[windows[sum(map(ord, from_date or '')) % len(windows)]]
+
+def need_to_sync_rule():
+    """
+    No remote rule is created for replayed analytics.
+    """
+    return False
+
+def get_redirect_analytic_link(analytic, filter_date=None, endpoint_name=None):
+    """
+    Replayed analytics have no data lake to redirect to.
+    """
+    return '#'
+
+def error_is_info(error):
+    """
+    Errors of replayed analytics are never informational.
+    """
+    return False
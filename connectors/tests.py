@@ -1,3 +1,30 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from connectors.utils import normalize_query, get_query_hash
 
-# Create your tests here.
+
+class NormalizeQueryTestCase(SimpleTestCase):
+    """
+    Queries that only differ by formatting share the same hash (deduplication and query cache),
+    queries that differ inside a string literal don't.
+    """
+    def test_formatting(self):
+        self.assertEqual(
+            get_query_hash('DeviceProcessEvents\n| where FileName == "cmd.exe"  '),
+            get_query_hash('  DeviceProcessEvents | where  FileName == "cmd.exe"')
+            )
+
+    def test_string_literals(self):
+        self.assertNotEqual(
+            get_query_hash('DeviceProcessEvents | where ProcessCommandLine has "a  b"'),
+            get_query_hash('DeviceProcessEvents | where ProcessCommandLine has "a b"')
+            )
+        self.assertNotEqual(
+            get_query_hash("DeviceProcessEvents | where ProcessCommandLine has 'a\tb'"),
+            get_query_hash("DeviceProcessEvents | where ProcessCommandLine has 'a b'")
+            )
+
+    def test_verbatim_strings(self):
+        self.assertEqual(
+            normalize_query('DeviceFileEvents | where FolderPath startswith @"C:\\Temp\\"   and FileName == "a  b"'),
+            'DeviceFileEvents | where FolderPath startswith @"C:\\Temp\\" and FileName == "a  b"'
+            )
@@ -2,16 +2,56 @@
 Utils is used as a module for common functions used by connectors.
 """
 
-from connectors.models import Connector, ConnectorConf
+from connectors.models import Connector, ConnectorConf, QueryCache, CircuitBreaker
 import re
+import hashlib
 import gzip
 import base64
 import urllib.parse
-from datetime import datetime
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+from collections import defaultdict
 from django.utils import timezone
 from io import BytesIO
 from django.conf import settings
-from notifications.utils import add_error_notification, del_notification_by_uid
+from django.db.models import Q
+from notifications.utils import add_error_notification, add_warning_notification, del_notification_by_uid
+
+# The query cache is disabled if the setting is missing (settings.py not updated yet)
+QUERY_CACHE = getattr(settings, 'QUERY_CACHE', {"ENABLED": False, "MAX_AGE_DAYS": 90, "MAX_ENTRIES": 50000})
+# Default HTTP session settings if the setting is missing (settings.py not updated yet)
+HTTP_SESSION = getattr(settings, 'HTTP_SESSION', {
+    "POOL_MAXSIZE": 10,
+    "CONNECT_TIMEOUT": 10,
+    "READ_TIMEOUT": 300,
+    "RETRIES": 3,
+    "BACKOFF_FACTOR": 1,
+})
+
+# HTTP status codes of the requests retried by the shared HTTP sessions (see ConnectorHTTPAdapter)
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Idempotent HTTP methods, retried on server errors (see ConnectorHTTPAdapter)
+RETRY_METHODS = ['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE']
+
+# String literals (verbatim @"..." strings of KQL, where quotes are doubled, then quoted strings with backslash escapes)
+# and runs of whitespaces, see normalize_query
+QUERY_TOKENS = re.compile(r'@"(?:[^"]|"")*"|@\'(?:[^\']|\'\')*\'|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|\s+')
+
+# Shared HTTP sessions, one per remote host and connector (see get_http_session)
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+# Rate limiters, one per connector (see get_rate_limiter)
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# Consecutive failures per connector, counted by the process (see record_connector_failure)
+connector_failures = defaultdict(int)
+connector_failures_lock = threading.Lock()
 
 def get_connector_conf(connector_name, conf_name):
     """
@@ -28,6 +68,18 @@ def get_connector_conf(connector_name, conf_name):
     except ConnectorConf.DoesNotExist:
         return None
 
+def get_max_concurrent_queries(connector_name):
+    """
+    Get the maximum number of queries that can run in parallel for a connector.
+    This is defined by the MAX_CONCURRENT_QUERIES setting of the connector (defaults to 1 if not set).
+    :param connector_name: Name of the connector.
+    :return: Integer (>= 1).
+    """
+    try:
+        return max(1, int(get_connector_conf(connector_name, 'MAX_CONCURRENT_QUERIES')))
+    except (TypeError, ValueError):
+        return 1
+
 def is_connector_enabled(connector_name):
     """
     Check if a connector is enabled.
@@ -123,3 +175,308 @@ def manage_analytic_error(analytic, error_message):
     analytic.analyticmeta.save()
     analytic.save()
 
+def normalize_query(query):
+    """
+    Normalize a query so that queries that only differ by formatting are considered identical.
+    Leading/trailing spaces are removed and consecutive whitespaces (including new lines) are replaced by a single space,
+    except inside string literals (e.g., "a  b" and "a b" are different values), which are kept as is.
+    :param query: Query string.
+    :return: Normalized query string.
+    """
+    return QUERY_TOKENS.sub(lambda m: ' ' if m.group(0).isspace() else m.group(0), query).strip()
+
+def get_query_hash(query):
+    """
+    Get the hash of a normalized query.
+    :param query: Query string.
+    :return: SHA256 hex digest of the normalized query.
+    """
+    return hashlib.sha256(normalize_query(query).encode()).hexdigest()
+
+def group_by_query(analytics):
+    """
+    Group analytics running the same query (after normalization) on the same connector.
+    :param analytics: List (or queryset) of Analytic objects.
+    :return: Dictionary {(connector_id, query_hash): [analytics]}, in the order of the analytics list.
+    """
+    groups = {}
+    for analytic in analytics:
+        groups.setdefault((analytic.connector_id, get_query_hash(analytic.query)), []).append(analytic)
+    return groups
+
+def is_query_cache_enabled(analytic):
+    """
+    Check if the query cache can be used for an analytic.
+    The cache is bypassed for dynamic queries, as their result may change without the query being modified.
+    :param analytic: Analytic object.
+    :return: True if the cache can be used, False otherwise.
+    """
+    return QUERY_CACHE['ENABLED'] and not analytic.dynamic_query
+
+def get_cached_result(analytic, from_date, to_date):
+    """
+    Get the cached result of the query of an analytic for a given time window.
+    :param analytic: Analytic object.
+    :param from_date: Start date of the query (isoformat).
+    :param to_date: End date of the query (isoformat).
+    :return: Result of the query (same format as the connector "query" function), or None if not in cache.
+    """
+    if not is_query_cache_enabled(analytic) or not from_date or not to_date:
+        return None
+    return QueryCache.objects.filter(
+        connector_id=analytic.connector_id,
+        query_hash=get_query_hash(analytic.query),
+        from_date=from_date,
+        to_date=to_date,
+        date__gte=timezone.now() - timedelta(days=QUERY_CACHE['MAX_AGE_DAYS'])
+        ).values_list('result', flat=True).first()
+
+def count_cached_results(analytic, windows):
+    """
+    Count how many time windows have a cached result for the query of an analytic.
+    :param analytic: Analytic object.
+    :param windows: List of tuples (from_date, to_date), in isoformat.
+    :return: Number of windows in cache.
+    """
+    if not is_query_cache_enabled(analytic):
+        return 0
+    windows_filter = Q()
+    for from_date, to_date in windows:
+        windows_filter |= Q(from_date=from_date, to_date=to_date)
+    return QueryCache.objects.filter(
+        windows_filter,
+        connector_id=analytic.connector_id,
+        query_hash=get_query_hash(analytic.query),
+        date__gte=timezone.now() - timedelta(days=QUERY_CACHE['MAX_AGE_DAYS'])
+        ).count()
+
+def set_cached_result(analytic, from_date, to_date, result):
+    """
+    Save the result of the query of an analytic in cache. Errors are never cached.
+    :param analytic: Analytic object.
+    :param from_date: Start date of the query (isoformat).
+    :param to_date: End date of the query (isoformat).
+    :param result: Result of the query (same format as the connector "query" function).
+    """
+    if not is_query_cache_enabled(analytic) or not from_date or not to_date or result == "ERROR":
+        return
+    QueryCache.objects.update_or_create(
+        connector_id=analytic.connector_id,
+        query_hash=get_query_hash(analytic.query),
+        from_date=from_date,
+        to_date=to_date,
+        defaults={'result': result, 'date': timezone.now()}
+        )
+
+def evict_query_cache():
+    """
+    Evict entries of the query cache older than QUERY_CACHE['MAX_AGE_DAYS'], and the oldest entries
+    if the cache contains more than QUERY_CACHE['MAX_ENTRIES'] entries.
+    :return: Number of deleted entries.
+    """
+    deleted, _ = QueryCache.objects.filter(
+        date__lt=timezone.now() - timedelta(days=QUERY_CACHE['MAX_AGE_DAYS'])
+        ).delete()
+    # date of the most recent entry beyond MAX_ENTRIES (if any)
+    exceeding = list(QueryCache.objects.order_by('-date').values_list('date', flat=True)[QUERY_CACHE['MAX_ENTRIES']:QUERY_CACHE['MAX_ENTRIES']+1])
+    if exceeding:
+        deleted += QueryCache.objects.filter(date__lte=exceeding[0]).delete()[0]
+    return deleted
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, shared by the threads of the process.
+    Tokens are added at a constant rate (up to one second of burst), and each request consumes one token.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Consume a token, waiting until one is available.
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+def get_rate_limiter(connector_name):
+    """
+    Get the rate limiter of a connector, defined by the MAX_REQUESTS_PER_SECOND setting of the connector.
+    :param connector_name: Name of the connector.
+    :return: TokenBucket object, or None if the connector is not rate limited (setting missing or 0).
+    """
+    with rate_limiters_lock:
+        if connector_name not in rate_limiters:
+            try:
+                rate = float(get_connector_conf(connector_name, 'MAX_REQUESTS_PER_SECOND'))
+            except (TypeError, ValueError):
+                rate = 0
+            rate_limiters[connector_name] = TokenBucket(rate) if rate > 0 else None
+        return rate_limiters[connector_name]
+
+def get_circuit_breaker_threshold(connector_name):
+    """
+    Get the number of consecutive failures opening the circuit breaker of a connector (CIRCUIT_BREAKER_THRESHOLD setting).
+    :param connector_name: Name of the connector.
+    :return: Integer, or 0 if the circuit breaker is disabled (setting missing or 0).
+    """
+    try:
+        return max(0, int(get_connector_conf(connector_name, 'CIRCUIT_BREAKER_THRESHOLD')))
+    except (TypeError, ValueError):
+        return 0
+
+def record_connector_failure(connector_name, error_message=''):
+    """
+    Record a connection failure (or server error) of a connector. The circuit breaker of the connector is opened
+    after CIRCUIT_BREAKER_THRESHOLD consecutive failures.
+    :param connector_name: Name of the connector.
+    :param error_message: Error message, saved when the circuit breaker is opened.
+    """
+    with connector_failures_lock:
+        connector_failures[connector_name] += 1
+        failures = connector_failures[connector_name]
+    threshold = get_circuit_breaker_threshold(connector_name)
+    if threshold and failures >= threshold and not is_circuit_open(connector_name):
+        connector = Connector.objects.get(name=connector_name)
+        CircuitBreaker.objects.update_or_create(
+            connector=connector,
+            defaults={
+                'state': 'OPEN',
+                'consecutive_failures': failures,
+                'last_error': error_message[:1000],
+                'date_opened': timezone.now()
+            })
+        add_warning_notification(f"Circuit breaker opened for connector {connector_name} after {failures} consecutive failures. Remaining analytics of the connector are skipped.")
+
+def record_connector_success(connector_name):
+    """
+    Record a successful call to a connector (resets the count of consecutive failures).
+    :param connector_name: Name of the connector.
+    """
+    with connector_failures_lock:
+        connector_failures[connector_name] = 0
+
+def is_circuit_open(connector_name):
+    """
+    Check if the circuit breaker of a connector is open (analytics of the connector should be skipped).
+    :param connector_name: Name of the connector.
+    :return: True if the circuit breaker is open, False otherwise.
+    """
+    return CircuitBreaker.objects.filter(connector__name=connector_name, state='OPEN').exists()
+
+def reset_circuit_breakers():
+    """
+    Close all circuit breakers (e.g., at the beginning of a campaign, to try the data lakes again).
+    """
+    CircuitBreaker.objects.filter(state='OPEN').update(state='CLOSED', consecutive_failures=0)
+    with connector_failures_lock:
+        connector_failures.clear()
+
+class ConnectorHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter applying a default timeout to requests that don't set their own timeout, and retrying requests
+    failing with HTTP 429/5xx with an exponential backoff, honouring the Retry-After header. Server errors are only
+    retried for idempotent methods: a POST request (e.g., query submission) may have been processed by the server,
+    while a throttled request (HTTP 429) has not, and is retried whatever its method.
+    When the adapter belongs to a connector, requests (including retries) are rate limited (MAX_REQUESTS_PER_SECOND
+    setting), and connection failures and server errors are recorded for the circuit breaker of the connector,
+    once per request when its retries are exhausted (throttled requests are not recorded).
+    """
+    def __init__(self, *args, timeout=None, connector_name=None, rate_limiter=None, retries=0, backoff_factor=0, **kwargs):
+        self.timeout = timeout
+        self.connector_name = connector_name
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        super().__init__(*args, **kwargs)
+
+    def get_retry_delay(self, response, attempt):
+        """
+        Delay before retrying a request: Retry-After header sent by the server (in seconds) if any,
+        exponential backoff otherwise.
+        """
+        try:
+            return max(0, float(response.headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return self.backoff_factor * (2 ** attempt)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # raised once the retries of failed connections are exhausted (see get_http_session)
+                if self.connector_name:
+                    record_connector_failure(self.connector_name, str(e))
+                raise
+            retryable = response.status_code == 429 or (
+                response.status_code in RETRY_STATUSES and request.method in RETRY_METHODS
+                )
+            # the last response is returned to the caller, which checks the status code
+            if not retryable or attempt >= self.retries:
+                # one failure per request (not per attempt), and throttling is neither a success nor a failure
+                if self.connector_name:
+                    if response.status_code >= 500:
+                        record_connector_failure(self.connector_name, f"Error: {response.status_code} - {response.text}")
+                    elif response.status_code != 429:
+                        record_connector_success(self.connector_name)
+                return response
+            delay = self.get_retry_delay(response, attempt)
+            response.close()
+            sleep(delay)
+            attempt += 1
+
+def get_http_session(url, connector_name=None):
+    """
+    Get the shared HTTP session of the host of a URL, created on first use.
+    Connections are kept alive and pooled (HTTP_SESSION['POOL_MAXSIZE'] per host), requests have a default timeout,
+    and requests failing with HTTP 429/5xx are retried (see ConnectorHTTPAdapter).
+    Sessions are shared between threads (campaign workers), only the connection pool is used concurrently.
+    :param url: URL (or base URL) of the API.
+    :param connector_name: Optional name of the connector sending the requests, to apply its rate limiter and circuit breaker
+        (see the MAX_REQUESTS_PER_SECOND and CIRCUIT_BREAKER_THRESHOLD settings of the connector).
+    :return: requests.Session object.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    host = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    with http_sessions_lock:
+        session = http_sessions.get((host, connector_name))
+        if session is None:
+            # urllib3 only retries failed connections (and read errors of idempotent methods),
+            # HTTP 429/5xx are retried by the adapter so that retries go through the rate limiter
+            retry = Retry(
+                total=HTTP_SESSION['RETRIES'],
+                backoff_factor=HTTP_SESSION['BACKOFF_FACTOR']
+                )
+            adapter = ConnectorHTTPAdapter(
+                timeout=(HTTP_SESSION['CONNECT_TIMEOUT'], HTTP_SESSION['READ_TIMEOUT']),
+                connector_name=connector_name,
+                rate_limiter=get_rate_limiter(connector_name) if connector_name else None,
+                retries=HTTP_SESSION['RETRIES'],
+                backoff_factor=HTTP_SESSION['BACKOFF_FACTOR'],
+                pool_connections=1,
+                pool_maxsize=HTTP_SESSION['POOL_MAXSIZE'],
+                max_retries=retry
+                )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.proxies.update(settings.PROXY or {})
+            http_sessions[(host, connector_name)] = session
+    return session
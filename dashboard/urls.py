@@ -20,4 +20,5 @@ urlpatterns = [
     path('db_analyticsbyuser/', views.db_analyticsbyuser, name='db_analyticsbyuser'),
     path('db_analytics-reviews-workload/', views.db_analytics_reviews_workload, name='db_analytics_reviews_workload'),
     path('db-campaign-completion/', views.db_campaign_completion, name='db_campaign_completion'),
+    path('db-circuit-breakers/', views.db_circuit_breakers, name='db_circuit_breakers'),
 ]
@@ -1,9 +1,11 @@
 from django.conf import settings
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required, permission_required
-from django.db.models import Q, Sum, Count, F
+from django.db.models import Q, Sum, Count, F, Max
 from datetime import datetime, timedelta, timezone
-from qm.models import Analytic, Campaign, CampaignCompletion, Endpoint, TasksStatus
+from qm.models import Analytic, Campaign, CampaignCompletion, Endpoint, TasksStatus, HostScore
+from connectors.models import Connector, CircuitBreaker
+from qm.results import get_host_scores
 from django.http import HttpResponse
 
 
@@ -94,23 +96,33 @@ def db_campaign_completion(request):
         code += f"""<div class="num_red"><a href="/qm/managecampaigns">{analytics_run}/{analytics_target}</a></div>"""
     return HttpResponse(code)
 
+@login_required
+@permission_required('qm.view_analytic', raise_exception=True)
+def db_circuit_breakers(request):
+    connectors = Connector.objects.filter(domain="analytics", enabled=True)
+    open_breakers = CircuitBreaker.objects.filter(state='OPEN', connector__in=connectors).select_related('connector')
+    names = ', '.join(breaker.connector.name for breaker in open_breakers)
+
+    code = "<h3>Circuit breakers<br />(open/connectors)</h3>"
+    if open_breakers:
+        code += f"""<div class="num_red" title="{names}"><a href="/admin/connectors/circuitbreaker/">{len(open_breakers)}/{connectors.count()}</a></div>"""
+    else:
+        code += f"""<div class="num_green"><a href="/admin/connectors/circuitbreaker/">0/{connectors.count()}</a></div>"""
+    return HttpResponse(code)
+
 @login_required
 @permission_required('qm.view_endpoint', raise_exception=True)
 def db_highestweightedscoretoday(request):
 
     campaign = get_object_or_404(Campaign, name='daily_cron_{}'.format(datetime.today().strftime('%Y-%m-%d')))
 
-    qs = Endpoint.objects.filter(
-        snapshot__campaign=campaign
-    ).values('hostname').annotate(
-        total_weighted_score=Sum(F('snapshot__analytic__weighted_relevance'))
-    ).order_by('-total_weighted_score')
+    # Get the highest score (computed from the endpoints collected so far if the campaign is still running)
+    highestweightedscore = get_host_scores(campaign).first()
+
+    score = highestweightedscore['total_weighted_score'] if highestweightedscore else 'N/A'
 
-    # Get the highest score
-    highestweightedscore = qs.first()
-    
     code = f"""<h3>Endpoint with highest weighted relevance today</h3>
-        <div class="num"><a href="/reports/endpoints/">{highestweightedscore['total_weighted_score']}</a></div>
+        <div class="num"><a href="/reports/endpoints/">{score}</a></div>
         """
     return HttpResponse(code)
 
@@ -118,19 +130,9 @@ def db_highestweightedscoretoday(request):
 @permission_required('qm.view_endpoint', raise_exception=True)
 def db_highest_weighted_score_all_campaigns(request):
 
-    highest_score = 0
-    campaigns = Campaign.objects.filter(name__startswith='daily_cron_')
-    for campaign in campaigns:
-        qs = Endpoint.objects.filter(
-            snapshot__campaign=campaign
-        ).values('hostname').annotate(
-            total_weighted_score=Sum(F('snapshot__analytic__weighted_relevance'))
-        ).order_by('-total_weighted_score')
-        highestweightedscore = qs.first()
-        if highestweightedscore:
-            highest_weighted_relevance = highestweightedscore['total_weighted_score']
-            if highest_weighted_relevance > highest_score:
-                highest_score = highest_weighted_relevance
+    highest_score = HostScore.objects.filter(
+        campaign__name__startswith='daily_cron_'
+    ).aggregate(highest_score=Max('total_weighted_score'))['highest_score'] or 0
 
     code = f"""<h3>Enpoint with highest weighted relevance (all campaigns)</h3>
         <div class="num"><a href="/reports/highest_weighted_score/">{highest_score}</a></div>
@@ -196,7 +198,7 @@ def db_runningtasks(request):
 def db_top_endpoint_distinct_analytics(request):
     top_endpoints = (
         Endpoint.objects
-        .values('hostname', 'site')
+        .values('host')
         .annotate(analytics_count=Count('snapshot__analytic', distinct=True))
         .order_by('-analytics_count')
     )
@@ -50,6 +50,26 @@ ON_MAXHOSTS_REACHED = {
     "DELETE_STATS": True
 }
 
+# Number of analytics per Celery subtask when campaigns are distributed over Celery workers (0 to run campaigns in a single task)
+# Each subtask runs its own concurrent queries: the load on the connectors is multiplied by the number of subtasks
+CAMPAIGN_SHARD_SIZE = 0
+
+# Cache of connector query results, keyed by connector, normalized query and time window
+# (bypassed for dynamic queries). Entries older than MAX_AGE_DAYS are evicted, as well as the oldest entries beyond MAX_ENTRIES
+QUERY_CACHE = {
+    "ENABLED": True,
+    "MAX_AGE_DAYS": 90,
+    "MAX_ENTRIES": 50000,
+}
+
+# Deletion of old data (DB_DATA_RETENTION) and of the stats of analytics: rows deleted per batch, pause between batches (in seconds)
+# and maximum duration of the retention purge run before each daily campaign (in seconds, 0 for no limit, remaining rows are deleted by the next run)
+RETENTION_PURGE = {
+    "BATCH_SIZE": 5000,
+    "PAUSE": 0.1,
+    "MAX_DURATION": 1800,
+}
+
 # Analytics per page in the list view
 ANALYTICS_PER_PAGE = 50
 
@@ -99,6 +119,15 @@ PROXY = {
     'https': 'http://proxy:port'
 }
 
+# Shared HTTP sessions used by the connectors (connection pooling, timeouts and retries)
+HTTP_SESSION = {
+    "POOL_MAXSIZE": 10,
+    "CONNECT_TIMEOUT": 10,
+    "READ_TIMEOUT": 300,
+    "RETRIES": 3,
+    "BACKOFF_FACTOR": 1,
+}
+
 # Keep ModelBackend around for per-user permissions and local superuser (admin)
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
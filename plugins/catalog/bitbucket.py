@@ -4,7 +4,7 @@ Used for repo sync with Bitbucket
 """
 
 from urllib.parse import urlparse
-import requests
+from connectors.utils import get_http_session
 from django.conf import settings
 from pathlib import Path
 from notifications.utils import add_error_notification
@@ -53,9 +53,9 @@ def get_bitbucket_contents(repo):
         api_url = f"https://api.bitbucket.org/2.0/repositories/{repo_owner}/{repo_slug}/src/{branch}/"
 
     if repo.token:
-        response = requests.get(api_url, auth=HTTPBasicAuth(repo_owner, repo.token), proxies=PROXY, timeout=30)
+        response = get_http_session(api_url).get(api_url, auth=HTTPBasicAuth(repo_owner, repo.token), proxies=PROXY, timeout=30)
     else:
-        response = requests.get(api_url, proxies=PROXY, timeout=30)
+        response = get_http_session(api_url).get(api_url, proxies=PROXY, timeout=30)
     
     if response.status_code == 200:
         data = response.json()
@@ -73,9 +73,9 @@ def get_bitbucket_contents(repo):
                 add_error_notification(f"Bitbucket connector: refusing to follow non-HTTPS pagination URL")
                 break
             if repo.token:
-                response = requests.get(api_url, auth=HTTPBasicAuth(repo_owner, repo.token), proxies=PROXY, timeout=30)
+                response = get_http_session(api_url).get(api_url, auth=HTTPBasicAuth(repo_owner, repo.token), proxies=PROXY, timeout=30)
             else:
-                response = requests.get(api_url, proxies=PROXY, timeout=30)
+                response = get_http_session(api_url).get(api_url, proxies=PROXY, timeout=30)
             data = response.json()
             for item in data.get('values'):
                 if item['type'] == 'commit_file' and Path(item['path']).suffix == ".json":
@@ -4,7 +4,7 @@ Used for repo sync with GitHub
 """
 
 from urllib.parse import urlparse
-import requests
+from connectors.utils import get_http_session
 from django.conf import settings
 from pathlib import Path
 from notifications.utils import add_error_notification
@@ -61,7 +61,7 @@ def get_github_contents(repo):
     else:
         headers = {}
     
-    response = requests.get(api_url, headers=headers, proxies=PROXY)
+    response = get_http_session(api_url).get(api_url, headers=headers, proxies=PROXY)
     
     if response.status_code == 200:
         data = response.json()
@@ -2,8 +2,7 @@
 LOLDrivers connector
 """
 
-from connectors.utils import get_connector_conf
-import requests
+from connectors.utils import get_connector_conf, get_http_session
 from django.conf import settings
 from bs4 import BeautifulSoup
 
@@ -30,7 +29,7 @@ def get_sha256_hashes():
     """
     init_globals()
     lol_hashes = []
-    response = requests.get(
+    response = get_http_session('https://www.loldrivers.io/').get(
         'https://www.loldrivers.io/',
         proxies=PROXY
         )
@@ -2,8 +2,7 @@
 MalwareBazaar connector
 """
 
-from connectors.utils import get_connector_conf, is_valid_md5, is_valid_sha1, is_valid_sha256
-import requests
+from connectors.utils import get_connector_conf, is_valid_md5, is_valid_sha1, is_valid_sha256, get_http_session
 from django.conf import settings
 from notifications.utils import add_error_notification
 
@@ -43,7 +42,7 @@ def check_hash(hash):
             'query':'get_info',
             'hash':hash
             }
-        response = requests.post(
+        response = get_http_session('https://mb-api.abuse.ch/').post(
             'https://mb-api.abuse.ch/api/v1/',
             data=data,
             headers=headers,
@@ -33,21 +33,36 @@ To do
 - get_threats() not implemented yet.
 """
 
-import requests
 from msal import ConfidentialClientApplication
-from connectors.utils import get_connector_conf, gzip_base64_urlencode, manage_analytic_error
+from connectors.utils import get_connector_conf, gzip_base64_urlencode, manage_analytic_error, get_http_session
 from django.conf import settings
 from datetime import datetime, timedelta
 from django.utils import timezone
 from urllib.parse import quote, unquote
 import re
+import threading
+import time
 from notifications.utils import add_debug_notification
 from datetime import date
 
+# Access token shared by all queries of the process (see authenticate)
+_app = None
+_token = None
+_token_expiration = 0
+_token_lock = threading.Lock()
+# Tokens are renewed this number of seconds before they expire
+TOKEN_RENEWAL_MARGIN = 300
+# Max number of requests per Graph JSON batch
+BATCH_SIZE = 20
+# Max number of retries of a throttled (HTTP 429) query of a batch
+BATCH_MAX_RETRIES = 5
+# Max number of rows returned by an advanced hunting query (results beyond are truncated)
+HUNTING_MAX_ROWS = 100000
+
 _globals_initialized = False
 def init_globals():
     global DEBUG, PROXY, TENANT_ID, CLIENT_ID, CLIENT_SECRET, SYNC_RULES, QUERY_ERROR_INFO, \
-            AUTHORITY, SCOPE, ENDPOINT, QUERY_LANGUAGE
+            AUTHORITY, SCOPE, ENDPOINT, BATCH_ENDPOINT, QUERY_LANGUAGE
     global _globals_initialized
     if not _globals_initialized:
         DEBUG = False
@@ -63,6 +78,7 @@ def init_globals():
         AUTHORITY = f'https://login.microsoftonline.com/{TENANT_ID}'
         SCOPE = ['https://graph.microsoft.com/.default']
         ENDPOINT = 'https://graph.microsoft.com/v1.0/security/runHuntingQuery'
+        BATCH_ENDPOINT = 'https://graph.microsoft.com/v1.0/$batch'
 
         _globals_initialized = True
 
@@ -83,41 +99,31 @@ def query_language():
 
 def authenticate():
     """
-    Authenticate and get token
+    Authenticate and get token.
+    The client application and the access token are shared by all queries of the process (including campaign threads),
+    and the token is only renewed shortly before it expires.
     :return: access token
     """
+    global _app, _token, _token_expiration
     init_globals()
-    app = ConfidentialClientApplication(CLIENT_ID, authority=AUTHORITY, client_credential=CLIENT_SECRET)
-    token_response = app.acquire_token_for_client(scopes=SCOPE)
-    access_token = token_response['access_token']
-    return access_token
-
-def query(analytic, from_date=None, to_date=None, debug=None):
+    with _token_lock:
+        if _token is None or time.time() >= _token_expiration - TOKEN_RENEWAL_MARGIN:
+            if _app is None:
+                _app = ConfidentialClientApplication(CLIENT_ID, authority=AUTHORITY, client_credential=CLIENT_SECRET)
+            token_response = _app.acquire_token_for_client(scopes=SCOPE)
+            _token = token_response['access_token']
+            _token_expiration = time.time() + int(token_response.get('expires_in', 3600))
+        return _token
+
+def build_query_body(analytic, from_date=None, to_date=None):
     """
-    API calls to Microsoft Sentinel to query logs. Used by the "campaign" daily cron, and the "regenerate stats" script
+    Build the body of the runHuntingQuery API call for an analytic.
     :param analytic: Analytic object corresponding to the threat hunting analytic.
     :param from_date: Optional start date for the query. Date received in isoformat.
     :param to_date: Optional end date for the query. Date received in isoformat.
-    :return: The result of the query (array with 4 fields: endpoint.name, NULL, number of hits, NULL), or "ERROR" if the query failed.
+    :return: Dictionary (body of the API call).
     """
-
-    init_globals()
-
-    # Authentication
-    try:
-        access_token = authenticate()
-    except:
-        if debug or DEBUG:
-            print(f"[ ERROR ] Analytic {analytic.name} failed. Failed to connect to MS Defender. Check report for more info.")
-        manage_analytic_error(analytic, f"Failed to connect to MS Defender while executing the analytic {analytic.name}.")
-        return []
-
-    # Define query and headers
     q = f'{analytic.query} | summarize count() by Computer'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
 
     ### Define time range and body    
     # starttime and endtime are provided in the query
@@ -147,12 +153,51 @@ def query(analytic, from_date=None, to_date=None, debug=None):
             'query': q,
             'timespan': timespan,
         }
+    return body
+
+def parse_results(results):
+    """
+    Convert the results of a hunting query to the format returned by the "query" function.
+    :param results: JSON response of the runHuntingQuery API call.
+    :return: List of results (endpoint.name, NULL, number of hits, NULL).
+    """
+    res = []
+    for row in results.get('results', []):
+        res.append([row.get('Computer', ''), '', row.get('count_', 0), ''])
+    return res
+
+def query(analytic, from_date=None, to_date=None, debug=None):
+    """
+    API calls to Microsoft Sentinel to query logs. Used by the "campaign" daily cron, and the "regenerate stats" script
+    :param analytic: Analytic object corresponding to the threat hunting analytic.
+    :param from_date: Optional start date for the query. Date received in isoformat.
+    :param to_date: Optional end date for the query. Date received in isoformat.
+    :return: The result of the query (array with 4 fields: endpoint.name, NULL, number of hits, NULL), or "ERROR" if the query failed.
+    """
+
+    init_globals()
+
+    # Authentication
+    try:
+        access_token = authenticate()
+    except:
+        if debug or DEBUG:
+            print(f"[ ERROR ] Analytic {analytic.name} failed. Failed to connect to MS Defender. Check report for more info.")
+        manage_analytic_error(analytic, f"Failed to connect to MS Defender while executing the analytic {analytic.name}.")
+        return []
+
+    # Define headers and body
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    body = build_query_body(analytic, from_date, to_date)
     if debug or DEBUG:
-        print(f"Query: {q}")
+        print(f"Query: {body['query']}")
  
     # Execute query
     try:
-        response = requests.post(ENDPOINT, headers=headers, proxies=PROXY, json=body)
+        response = get_http_session(ENDPOINT, 'microsoftdefender').post(ENDPOINT, headers=headers, proxies=PROXY, json=body)
     except Exception as e:
         if debug or DEBUG:
             print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
@@ -161,20 +206,180 @@ def query(analytic, from_date=None, to_date=None, debug=None):
 
     # Handle response
     if response.status_code == 200:
-        res = []
-        results = response.json()
-        if 'results' in results and len(results['results']) > 0:
-            for row in results['results']:
-                computer = row.get('Computer', '')
-                count = row.get('count_', 0)
-                res.append([computer, '', count, ''])
-        return res
+        return parse_results(response.json())
     else:
         if debug or DEBUG:
             print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
         manage_analytic_error(analytic, f"Error: {response.status_code} - {response.text}")
         return "ERROR"
 
+def query_batch(analytics, from_date=None, to_date=None, debug=None):
+    """
+    Run the hunting queries of several analytics through the Graph JSON batching endpoint ($batch),
+    with up to BATCH_SIZE queries per HTTP request. Responses are mapped back to their analytics by request id.
+    Throttled queries (HTTP 429) are sent again in a later batch, after the delay requested by the Retry-After header.
+    Batches are run one after the other. The runtime of a query is its share of the duration of the batches it was
+    sent in (duration of the batch divided by the number of queries), so that the runtimes of the analytics add up to
+    the duration of the campaign (see get_campaign_concurrency).
+    This is a generator: results are yielded as soon as each batch completes.
+    :param analytics: List of Analytic objects.
+    :param from_date: Optional start date for the queries (isoformat).
+    :param to_date: Optional end date for the queries (isoformat).
+    :return: Generator of tuples (analytic, data, runtime), where data is the same as the "query" function output
+        (list of results, or "ERROR") and runtime is in seconds.
+    """
+    init_globals()
+
+    # Use the global variable if not provided
+    if debug is None:
+        debug = DEBUG
+
+    def fail(analytic, error_message):
+        if debug or DEBUG:
+            print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
+        manage_analytic_error(analytic, error_message)
+
+    # Authentication
+    try:
+        access_token = authenticate()
+    except:
+        for analytic in analytics:
+            if debug or DEBUG:
+                print(f"[ ERROR ] Analytic {analytic.name} failed. Failed to connect to MS Defender. Check report for more info.")
+            manage_analytic_error(analytic, f"Failed to connect to MS Defender while executing the analytic {analytic.name}.")
+            yield analytic, "ERROR", 0
+        return
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+
+    # queries to run: [(analytic, number of retries, runtime of the previous attempts)]
+    pending = [(analytic, 0, 0) for analytic in analytics]
+    while pending:
+        batch = pending[:BATCH_SIZE]
+        pending = pending[BATCH_SIZE:]
+
+        requests_by_id = {}
+        batch_requests = []
+        for i, (analytic, retries, runtime) in enumerate(batch):
+            body = build_query_body(analytic, from_date, to_date)
+            if debug or DEBUG:
+                print(f"Query {analytic.name}: {body['query']}")
+            requests_by_id[str(i)] = (analytic, retries, runtime)
+            batch_requests.append({
+                'id': str(i),
+                'method': 'POST',
+                'url': '/security/runHuntingQuery',
+                'headers': {'Content-Type': 'application/json'},
+                'body': body
+            })
+
+        # Execute batch
+        start_runtime = datetime.now()
+        try:
+            response = get_http_session(BATCH_ENDPOINT, 'microsoftdefender').post(BATCH_ENDPOINT, headers=headers, proxies=PROXY, json={'requests': batch_requests})
+            if response.status_code != 200:
+                raise Exception(f"Error: {response.status_code} - {response.text}")
+            responses = response.json()['responses']
+        except Exception as e:
+            share = (datetime.now()-start_runtime).total_seconds() / len(batch)
+            for analytic, retries, runtime in requests_by_id.values():
+                fail(analytic, str(e))
+                yield analytic, "ERROR", runtime + share
+            continue
+        # share of each query in the duration of the batch
+        share = (datetime.now()-start_runtime).total_seconds() / len(batch)
+
+        # Demultiplex responses
+        retry_after = 0
+        for item in responses:
+            analytic, retries, runtime = requests_by_id.pop(item['id'])
+            if item['status'] == 200:
+                yield analytic, parse_results(item.get('body', {})), runtime + share
+            elif item['status'] == 429 and retries < BATCH_MAX_RETRIES:
+                if debug or DEBUG:
+                    print(f"Query {analytic.name} throttled, will be retried")
+                retry_after = max(retry_after, int(item.get('headers', {}).get('Retry-After', 2**retries)))
+                pending.append((analytic, retries+1, runtime + share))
+            else:
+                fail(analytic, f"Error: {item['status']} - {item.get('body')}")
+                yield analytic, "ERROR", runtime + share
+
+        # Requests without response (should not happen)
+        for analytic, retries, runtime in requests_by_id.values():
+            fail(analytic, f"Error: no response received for the analytic {analytic.name} in the batch")
+            yield analytic, "ERROR", runtime + share
+
+        if retry_after:
+            time.sleep(retry_after)
+
+def get_campaign_concurrency():
+    """
+    Number of queries running in parallel during campaigns, used by the campaign scheduler to predict the duration
+    of the campaign. Graph JSON batches are run one after the other by "query_batch", and the runtime of each query
+    is its share of the duration of its batch: queries are modeled as running one at a time.
+    :return: Integer.
+    """
+    return 1
+
+def query_by_day(analytic, from_date, to_date, debug=None):
+    """
+    Run the query of an analytic over a date range, with results grouped by day (bin(Timestamp, 1d)).
+    Used by the "regenerate stats" task to rebuild all snapshots of an analytic with a single query.
+    :param analytic: Analytic object corresponding to the threat hunting analytic.
+    :param from_date: Start date for the query (isoformat, midnight).
+    :param to_date: End date for the query (isoformat, midnight).
+    :return: Dictionary {date: results} where results have the same format as the "query" function output,
+        or None if the query can't be run this way or was truncated (the caller should then fall back to one query per day).
+    """
+    init_globals()
+
+    # Queries with time placeholders are bound to a single time range
+    if '{{StartTimeISO}}' in analytic.query or '{{EndTimeISO}}' in analytic.query:
+        return None
+
+    try:
+        access_token = authenticate()
+    except:
+        return None
+
+    q = f'{analytic.query} | summarize count() by Computer, Day=bin(Timestamp, 1d)'
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    body = {
+        'query': q,
+        'timespan': f"{from_date.split('.')[0]}Z/{to_date.split('.')[0]}Z",
+    }
+    if debug or DEBUG:
+        print(f"Query by day: {q}")
+
+    try:
+        response = get_http_session(ENDPOINT, 'microsoftdefender').post(ENDPOINT, headers=headers, proxies=PROXY, json=body)
+    except:
+        return None
+
+    if response.status_code != 200:
+        if debug or DEBUG:
+            print(f"[ ERROR ] Query by day failed for analytic {analytic.name}: {response.status_code} - {response.text}")
+        return None
+
+    results = response.json().get('results', [])
+    # if the limit is reached, some days may be incomplete
+    if len(results) >= HUNTING_MAX_ROWS:
+        if debug or DEBUG:
+            print(f"[ ERROR ] Query by day truncated for analytic {analytic.name}.")
+        return None
+
+    res = {}
+    for row in results:
+        day = datetime.fromisoformat(row.get('Day')[:10]).date()
+        res.setdefault(day, []).append([row.get('Computer', ''), '', row.get('count_', 0), ''])
+    return res
+
 def need_to_sync_rule():
     """
     Check if the rule needs to be synced with Microsoft Sentinel.
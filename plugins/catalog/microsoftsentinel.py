@@ -22,12 +22,22 @@ To do
 from azure.identity import ClientSecretCredential
 from azure.monitor.query import LogsQueryClient
 from azure.monitor.query import LogsQueryStatus
-from connectors.utils import get_connector_conf, gzip_base64_urlencode, manage_analytic_error
+from azure.monitor.query import LogsBatchQuery
+from azure.core.exceptions import ServiceRequestError, HttpResponseError
+from connectors.utils import get_connector_conf, gzip_base64_urlencode, manage_analytic_error, \
+    get_rate_limiter, record_connector_failure, record_connector_success
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote, unquote
 import re
+import threading
 from notifications.utils import add_debug_notification
 
+# Query client shared by all queries of the process (see authenticate)
+_client = None
+_client_lock = threading.Lock()
+# Max number of queries per Log Analytics batch request
+BATCH_SIZE = 10
+
 _globals_initialized = False
 def init_globals():
     global DEBUG, TENANT_ID, CLIENT_ID, CLIENT_SECRET, SUBSCRIPTION_ID, WORKSPACE_ID, \
@@ -63,12 +73,71 @@ def query_language():
     return QUERY_LANGUAGE
 
 def authenticate():
+    """
+    Get the Log Analytics query client.
+    The client (and its credential) is shared by all queries of the process (including campaign threads).
+    The credential caches the access token and only renews it shortly before it expires.
+    :return: LogsQueryClient object.
+    """
+    global _client
     init_globals()
-    credential = ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
-    client = LogsQueryClient(credential)
-    return client
+    with _client_lock:
+        if _client is None:
+            credential = ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+            _client = LogsQueryClient(credential)
+        return _client
 
 
+def call_api(function, *args, **kwargs):
+    """
+    Call the Log Analytics API through the rate limiter of the connector (MAX_REQUESTS_PER_SECOND setting).
+    Connection failures and server errors are recorded for the circuit breaker of the connector (CIRCUIT_BREAKER_THRESHOLD setting).
+    :param function: Method of the LogsQueryClient object to call.
+    :return: Result of the call.
+    """
+    rate_limiter = get_rate_limiter('microsoftsentinel')
+    if rate_limiter:
+        rate_limiter.acquire()
+    try:
+        response = function(*args, **kwargs)
+    except ServiceRequestError as e:
+        record_connector_failure('microsoftsentinel', str(e))
+        raise
+    except HttpResponseError as e:
+        if (e.status_code or 0) >= 500:
+            record_connector_failure('microsoftsentinel', str(e))
+        raise
+    record_connector_success('microsoftsentinel')
+    return response
+
+def get_timespan(from_date=None, to_date=None):
+    """
+    Get the timespan of a query.
+    :param from_date: Optional start date for the query. Date received in isoformat.
+    :param to_date: Optional end date for the query. Date received in isoformat.
+    :return: Tuple of UTC datetimes (start, end), or the last 24 hours if no dates are provided.
+    """
+    if from_date and to_date:
+        start_date = datetime.fromisoformat(from_date)
+        start_date_utc = start_date.replace(tzinfo=timezone.utc)
+        end_date = datetime.fromisoformat(to_date)
+        end_date_utc = end_date.replace(tzinfo=timezone.utc)
+        return (start_date_utc, end_date_utc)
+    # Default to the last 24 hours if no dates are provided
+    return timedelta(hours=24)
+
+def parse_tables(tables):
+    """
+    Convert the tables returned by a query to the format returned by the "query" function.
+    :param tables: List of LogsTable objects.
+    :return: List of results (endpoint.name, NULL, number of hits, NULL).
+    """
+    res = []
+    for table in tables:
+        for row in table.rows:
+            res.append([row[0], '', row[1], ''])
+    return res
+
 def query(analytic, from_date=None, to_date=None, debug=None):
     """
     API calls to Microsoft Sentinel to query logs. Used by the "campaign" daily cron, and the "regenerate stats" script
@@ -89,25 +158,15 @@ def query(analytic, from_date=None, to_date=None, debug=None):
         manage_analytic_error(analytic, f"Failed to connect to MS Sentinel while executing the analytic {analytic.name}.")
         return []
 
-
-    if from_date and to_date:
-        start_date = datetime.fromisoformat(from_date)
-        start_date_utc = start_date.replace(tzinfo=timezone.utc)
-        end_date = datetime.fromisoformat(to_date)
-        end_date_utc = end_date.replace(tzinfo=timezone.utc)
-        timespan = (start_date_utc, end_date_utc)
-    else:
-        # Default to the last 24 hours if no dates are provided
-        timespan = timedelta(hours=24)
-
-
+    timespan = get_timespan(from_date, to_date)
     q = f'{analytic.query} | summarize count() by Computer'
     if debug or DEBUG:
         print(f"Query: {q}")
     
     try:
         # Execute query
-        response = client.query_workspace(
+        response = call_api(
+            client.query_workspace,
             workspace_id=WORKSPACE_ID,
             query=q,
             timespan=timespan
@@ -120,17 +179,135 @@ def query(analytic, from_date=None, to_date=None, debug=None):
 
     # Handle response
     if response.status == LogsQueryStatus.SUCCESS:
-        res = []
-        for table in response.tables:
-            for row in table.rows:
-                res.append([row[0], '', row[1], ''])
-        return res
+        return parse_tables(response.tables)
     else:
         if debug or DEBUG:
             print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
         manage_analytic_error(analytic, response.error)
         return "ERROR"
 
+def query_batch(analytics, from_date=None, to_date=None, debug=None):
+    """
+    Run the queries of several analytics with the Log Analytics batch API, up to BATCH_SIZE queries per request.
+    Results of a batch are returned in the same order as the queries, and failed (or partial) results
+    are reported on their own analytic only.
+    Batches are run one after the other. The runtime of a query is its share of the duration of its batch (duration
+    of the batch divided by the number of queries), so that the runtimes of the analytics add up to the duration
+    of the campaign (see get_campaign_concurrency).
+    This is a generator: results are yielded as soon as each batch completes.
+    :param analytics: List of Analytic objects.
+    :param from_date: Optional start date for the queries (isoformat).
+    :param to_date: Optional end date for the queries (isoformat).
+    :return: Generator of tuples (analytic, data, runtime), where data is the same as the "query" function output
+        (list of results, or "ERROR") and runtime is in seconds.
+    """
+    init_globals()
+
+    # Use the global variable if not provided
+    if debug is None:
+        debug = DEBUG
+
+    def fail(analytic, error_message):
+        if debug or DEBUG:
+            print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
+        manage_analytic_error(analytic, str(error_message))
+
+    # Authentication
+    try:
+        client = authenticate()
+    except:
+        for analytic in analytics:
+            if debug or DEBUG:
+                print(f"[ ERROR ] Analytic {analytic.name} failed. Failed to connect to MS Sentinel. Check report for more info.")
+            manage_analytic_error(analytic, f"Failed to connect to MS Sentinel while executing the analytic {analytic.name}.")
+            yield analytic, "ERROR", 0
+        return
+
+    timespan = get_timespan(from_date, to_date)
+    analytics = list(analytics)
+    for i in range(0, len(analytics), BATCH_SIZE):
+        batch = analytics[i:i+BATCH_SIZE]
+        queries = []
+        for analytic in batch:
+            q = f'{analytic.query} | summarize count() by Computer'
+            if debug or DEBUG:
+                print(f"Query {analytic.name}: {q}")
+            queries.append(LogsBatchQuery(workspace_id=WORKSPACE_ID, query=q, timespan=timespan))
+
+        start_runtime = datetime.now()
+        try:
+            # Execute batch
+            responses = call_api(client.query_batch, queries)
+        except Exception as e:
+            runtime = (datetime.now()-start_runtime).total_seconds() / len(batch)
+            for analytic in batch:
+                fail(analytic, getattr(e, 'message', e))
+                yield analytic, "ERROR", runtime
+            continue
+        # share of each query in the duration of the batch
+        runtime = (datetime.now()-start_runtime).total_seconds() / len(batch)
+
+        # Responses are in the same order as the queries
+        for analytic, response in zip(batch, responses):
+            if response.status == LogsQueryStatus.SUCCESS:
+                yield analytic, parse_tables(response.tables), runtime
+            elif response.status == LogsQueryStatus.PARTIAL:
+                fail(analytic, response.partial_error)
+                yield analytic, "ERROR", runtime
+            else:
+                fail(analytic, response.message)
+                yield analytic, "ERROR", runtime
+
+def get_campaign_concurrency():
+    """
+    Number of queries running in parallel during campaigns, used by the campaign scheduler to predict the duration
+    of the campaign. Log Analytics batches are run one after the other by "query_batch", and the runtime of each query
+    is its share of the duration of its batch: queries are modeled as running one at a time.
+    :return: Integer.
+    """
+    return 1
+
+def query_by_day(analytic, from_date, to_date, debug=None):
+    """
+    Run the query of an analytic over a date range, with results grouped by day (bin(TimeGenerated, 1d)).
+    Used by the "regenerate stats" task to rebuild all snapshots of an analytic with a single query.
+    :param analytic: Analytic object corresponding to the threat hunting analytic.
+    :param from_date: Start date for the query (isoformat, midnight).
+    :param to_date: End date for the query (isoformat, midnight).
+    :return: Dictionary {date: results} where results have the same format as the "query" function output,
+        or None if the query failed (the caller should then fall back to one query per day).
+    """
+    init_globals()
+
+    q = f'{analytic.query} | summarize count() by Computer, Day=bin(TimeGenerated, 1d)'
+    if debug or DEBUG:
+        print(f"Query by day: {q}")
+
+    try:
+        client = authenticate()
+        response = call_api(
+            client.query_workspace,
+            workspace_id=WORKSPACE_ID,
+            query=q,
+            timespan=(
+                datetime.fromisoformat(from_date).replace(tzinfo=timezone.utc),
+                datetime.fromisoformat(to_date).replace(tzinfo=timezone.utc)
+            )
+        )
+    except:
+        return None
+
+    if response.status != LogsQueryStatus.SUCCESS:
+        if debug or DEBUG:
+            print(f"[ ERROR ] Query by day failed for analytic {analytic.name}: {response.partial_error}")
+        return None
+
+    res = {}
+    for table in response.tables:
+        for row in table.rows:
+            res.setdefault(row[1].date(), []).append([row[0], '', row[2], ''])
+    return res
+
 def need_to_sync_rule():
     """
     Check if the rule needs to be synced with Microsoft Sentinel.
@@ -4,23 +4,31 @@ SentinelOne connector
 
 from connectors.utils import get_connector_conf
 from django.conf import settings
-import requests
 import re
-from time import sleep
+from time import sleep, monotonic
+from requests.exceptions import RequestException
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote, quote_plus
-from connectors.utils import manage_analytic_error
+from connectors.utils import manage_analytic_error, get_max_concurrent_queries, get_http_session
 from notifications.utils import add_error_notification
 
 _globals_initialized = False
 def init_globals():
     global DEBUG, PROXY, DB_DATA_RETENTION, CAMPAIGN_MAX_HOSTS_THRESHOLD, \
             S1_URL, S1_TOKEN, S1_THREATS_URL, XDR_URL, XDR_PARAMS, SYNC_STAR_RULES, STAR_RULES_PREFIX, \
-            STAR_RULES_DEFAULTS, QUERY_ERROR_INFO, QUERY_LANGUAGE
+            STAR_RULES_DEFAULTS, QUERY_ERROR_INFO, QUERY_LANGUAGE, PQ_MAX_LIMIT, QUERY_TIMEOUT, \
+            PQ_MIN_POLL_INTERVAL, PQ_MAX_POLL_INTERVAL, PQ_MAX_PING_FAILURES
     global _globals_initialized
     if not _globals_initialized:
         DEBUG = False
         QUERY_LANGUAGE = "SentinelOne PowerQuery S1QL 2.0"
+        # Maximum number of results returned by a PowerQuery
+        PQ_MAX_LIMIT = 100000
+        # Bounds of the adaptive polling interval of PowerQueries (in seconds)
+        PQ_MIN_POLL_INTERVAL = 0.5
+        PQ_MAX_POLL_INTERVAL = 5
+        # Max number of consecutive failed pings before a PowerQuery is considered as failed
+        PQ_MAX_PING_FAILURES = 3
         PROXY = settings.PROXY
         DB_DATA_RETENTION = settings.DB_DATA_RETENTION
         CAMPAIGN_MAX_HOSTS_THRESHOLD = settings.CAMPAIGN_MAX_HOSTS_THRESHOLD
@@ -40,6 +48,8 @@ def init_globals():
             'networkQuarantine': get_connector_conf('sentinelone', 'STAR_RULES_DEFAULT_NETWORKQUARANTINE') # true|false
         }
         QUERY_ERROR_INFO = get_connector_conf('sentinelone', 'QUERY_ERROR_INFO')
+        # PowerQueries still running after this number of seconds are cancelled (0 for no timeout)
+        QUERY_TIMEOUT = int(get_connector_conf('sentinelone', 'QUERY_TIMEOUT') or 0)
         _globals_initialized = True
 
 def get_requirements():
@@ -56,13 +66,16 @@ def query_language():
     init_globals()
     return QUERY_LANGUAGE
 
-def query(analytic, from_date=None, to_date=None, debug=None):
+def build_query_body(analytic, from_date=None, to_date=None):
+    """
+    Build the body of the PowerQuery used to run an analytic.
+    :param analytic: Analytic object.
+    :param from_date: Optional start date (isoformat). Defaults to yesterday@midnight.
+    :param to_date: Optional end date (isoformat). Defaults to today@midnight.
+    :return: Dictionary used as body for the PowerQuery API call.
+    """
     init_globals()
-    
-    # Use the global variable if not provided
-    if debug is None:
-        debug = DEBUG
-    
+
     # Run analytic with filter for the last 24 hours by default, as the script is run every day, or from the given date range
     # hacklist is used instead of array_agg_distinct to get list of storylineid because
     # array_agg_distinct prevents the powerquery from executing without error
@@ -74,56 +87,359 @@ def query(analytic, from_date=None, to_date=None, debug=None):
         from_date = (to_date - timedelta(hours=24)).isoformat()
         to_date = to_date.isoformat()
     
-    body = {
+    return {
         'fromDate': from_date,
         'query': q,
         'toDate': to_date,
         'limit': CAMPAIGN_MAX_HOSTS_THRESHOLD
     }
+
+class PowerQueryJob:
+    """
+    PowerQuery submitted to SentinelOne.
+    Running PowerQueries have to be pinged, otherwise they are cancelled by SentinelOne. The polling interval adapts
+    to the progress reported by SentinelOne: short PowerQueries are pinged often (fast completion), and long PowerQueries
+    less often (between PQ_MIN_POLL_INTERVAL and PQ_MAX_POLL_INTERVAL seconds).
+    PowerQueries still running after the timeout (QUERY_TIMEOUT setting) are cancelled.
+    The time to first progress and the total latency are recorded on the job.
+    """
+
+    def __init__(self, body, timeout=None, debug=False):
+        """
+        :param body: Body of the PowerQuery API call.
+        :param timeout: Optional timeout in seconds (defaults to the QUERY_TIMEOUT setting, 0 for no timeout).
+        """
+        init_globals()
+        self.body = body
+        self.timeout = QUERY_TIMEOUT if timeout is None else timeout
+        self.debug = debug or DEBUG
+        self.query_id = None
+        self.status = None
+        self.progress = 0
+        self.response = None
+        self.start_time = None
+        self.first_progress_time = None
+        self.end_time = None
+        self.next_poll = None
+        self.interval = PQ_MIN_POLL_INTERVAL
+        self.ping_failures = 0
+
+    @property
+    def running(self):
+        return self.status == 'RUNNING'
+
+    @property
+    def cancelled(self):
+        return self.status == 'CANCELLED'
+
+    @property
+    def time_to_first_progress(self):
+        """
+        Time (in seconds) between the submission and the first progress reported, or None if no progress was reported.
+        """
+        if self.first_progress_time is None:
+            return None
+        return self.first_progress_time - self.start_time
+
+    @property
+    def latency(self):
+        """
+        Time (in seconds) between the submission and the completion (or now if the PowerQuery is still running).
+        """
+        if self.start_time is None:
+            return 0
+        return (self.end_time or monotonic()) - self.start_time
+
+    def update(self, r):
+        """
+        Update the status of the job from the response of the PowerQuery API (raises an exception if the PowerQuery failed).
+        :param r: Response of the submission or ping API call.
+        """
+        self.response = r
+        data = r.json()['data']
+        self.status = data['status']
+        self.progress = data.get('progress') or 0
+        if self.progress > 0 and self.first_progress_time is None:
+            self.first_progress_time = monotonic()
+        if not self.running:
+            self.end_time = monotonic()
+            if self.debug:
+                print(f"PowerQuery {self.query_id} completed: latency={self.latency:.1f}s, time to first progress={self.time_to_first_progress}")
+
+    def schedule(self):
+        """
+        Schedule the next ping, based on the time remaining estimated from the progress.
+        """
+        if 0 < self.progress < 100:
+            # assume a linear progress, and ping again halfway to the estimated completion
+            elapsed = monotonic() - self.start_time
+            self.interval = elapsed * (100 - self.progress) / self.progress / 2
+        else:
+            # no progress reported yet: back off
+            self.interval = self.interval * 1.5
+        self.interval = min(max(self.interval, PQ_MIN_POLL_INTERVAL), PQ_MAX_POLL_INTERVAL)
+        self.next_poll = monotonic() + self.interval
+
+    def submit(self):
+        """
+        Submit the PowerQuery.
+        """
+        self.start_time = monotonic()
+        self.response = get_http_session(S1_URL, 'sentinelone').post(f'{S1_URL}/web/api/v2.1/dv/events/pq',
+            json=self.body,
+            headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
+            proxies=PROXY)
+        self.query_id = self.response.json()['data']['queryId']
+        self.update(self.response)
+        if self.running:
+            self.schedule()
+
+    def poll(self):
+        """
+        Ping the PowerQuery (keeps it alive and updates its status). Cancel it if the timeout is reached.
+        Network errors and server errors are tolerated up to PQ_MAX_PING_FAILURES consecutive times.
+        """
+        try:
+            r = get_http_session(S1_URL, 'sentinelone').get(f'{S1_URL}/web/api/v2.1/dv/events/pq-ping',
+                params = {"queryId": self.query_id},
+                headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
+                proxies=PROXY)
+            if r.status_code >= 500:
+                self.response = r
+                raise RequestException(f"Error: {r.status_code} - {r.text}")
+            self.ping_failures = 0
+            self.update(r)
+            if self.debug:
+                print(f"PROGRESS {self.query_id}: {self.progress}")
+        except RequestException:
+            self.ping_failures += 1
+            if self.ping_failures >= PQ_MAX_PING_FAILURES:
+                raise
+
+        if self.running:
+            if self.timeout and self.latency >= self.timeout:
+                self.cancel()
+            else:
+                self.schedule()
+
+    def cancel(self):
+        """
+        Cancel the PowerQuery. SentinelOne also cancels PowerQueries that are no longer pinged, so failures are ignored.
+        """
+        try:
+            get_http_session(S1_URL, 'sentinelone').post(f'{S1_URL}/web/api/v2.1/dv/cancel-query',
+                json={'queryId': self.query_id},
+                headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
+                proxies=PROXY)
+        except RequestException:
+            pass
+        self.status = 'CANCELLED'
+        self.end_time = monotonic()
+        if self.debug:
+            print(f"PowerQuery {self.query_id} cancelled after {self.latency:.1f}s")
+
+    @property
+    def error(self):
+        """
+        Error message of a cancelled PowerQuery.
+        """
+        return f"PowerQuery cancelled: timeout of {self.timeout} seconds reached (progress: {self.progress}%)"
+
+    def run(self):
+        """
+        Submit the PowerQuery and ping it until it is complete.
+        :return: The job itself. Raises TimeoutError if the PowerQuery was cancelled.
+        """
+        self.submit()
+        while self.running:
+            sleep(max(0, self.next_poll - monotonic()))
+            self.poll()
+        if self.cancelled:
+            raise TimeoutError(self.error)
+        return self
+
+def query(analytic, from_date=None, to_date=None, debug=None):
+    init_globals()
+    
+    # Use the global variable if not provided
+    if debug is None:
+        debug = DEBUG
+    
+    body = build_query_body(analytic, from_date, to_date)
     
     if debug or DEBUG:
         print('*** RUNNING QUERY {}: {}'.format(analytic.name, analytic.query))
         print('*** BODY: {}'.format(body))
         
+    job = PowerQueryJob(body, debug=debug)
     try:
-        r = requests.post(f'{S1_URL}/web/api/v2.1/dv/events/pq',
-            json=body,
-            headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
-            proxies=PROXY)
+        r = job.run().response
 
-        query_id = r.json()['data']['queryId']
-        status = r.json()['data']['status']
-
-        # Ping PowerQuery every second, until it is complete (unless you do that, the PQ will be cancelled)
-        while status == 'RUNNING':
-            r = requests.get(f'{S1_URL}/web/api/v2.1/dv/events/pq-ping',
-                params = {"queryId": query_id},
-                headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
-                proxies=PROXY)
-                
-            status = r.json()['data']['status']
-            progress = r.json()['data']['progress']
-            
-            if debug or DEBUG:
-                print('PROGRESS: {}'.format(progress))
-            
-            sleep(1)
-
-                
         if debug or DEBUG:
             print('***DATA (JSON): {}'.format(r.json()))
         
         return r.json()['data']['data']
     
-    
+    except TimeoutError as e:
+        if debug or DEBUG:
+            print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
+
+        manage_analytic_error(analytic, str(e))
+
+        return "ERROR"
+
     except:
         if debug or DEBUG:
             print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
         
-        manage_analytic_error(analytic, r.text)
+        manage_analytic_error(analytic, job.response.text if job.response is not None else 'PowerQuery could not be submitted (connection failure)')
 
         return "ERROR"
 
+def query_batch(analytics, from_date=None, to_date=None, debug=None):
+    """
+    Run the PowerQueries of several analytics concurrently.
+    Up to MAX_CONCURRENT_QUERIES PowerQueries are submitted, and all running PowerQueries are pinged
+    in a single polling loop (each one at its own adaptive interval, see PowerQueryJob).
+    A new PowerQuery is submitted as soon as a running one completes or is cancelled (QUERY_TIMEOUT setting).
+    This is a generator: results are yielded as soon as each PowerQuery completes.
+    :param analytics: List of Analytic objects.
+    :param from_date: Optional start date for the queries (isoformat).
+    :param to_date: Optional end date for the queries (isoformat).
+    :return: Generator of tuples (analytic, data, runtime), where data is the same as the "query" function output
+        (list of results, or "ERROR") and runtime is in seconds.
+    """
+    init_globals()
+
+    # Use the global variable if not provided
+    if debug is None:
+        debug = DEBUG
+
+    max_concurrent_queries = get_max_concurrent_queries('sentinelone')
+    pending = list(analytics)
+    # running PowerQueries: {job: analytic}
+    running = {}
+
+    def fail(analytic, error_message):
+        if debug or DEBUG:
+            print(f"[ ERROR ] Analytic {analytic.name} failed. Check report for more info.")
+        manage_analytic_error(analytic, error_message)
+
+    while pending or running:
+
+        # Submit new PowerQueries while there are free slots
+        while pending and len(running) < max_concurrent_queries:
+            analytic = pending.pop(0)
+            body = build_query_body(analytic, from_date, to_date)
+            if debug or DEBUG:
+                print('*** SUBMITTING QUERY {}: {}'.format(analytic.name, analytic.query))
+                print('*** BODY: {}'.format(body))
+            job = PowerQueryJob(body, debug=debug)
+            try:
+                job.submit()
+                running[job] = analytic
+                continue
+            except Exception:
+                error_message = job.response.text if job.response is not None else 'PowerQuery could not be submitted (connection failure)'
+            # yield outside of the try block, so that closing the generator (GeneratorExit) is not caught
+            fail(analytic, error_message)
+            yield analytic, "ERROR", job.latency
+
+        # Ping the running PowerQueries that are due (unless you do that, the PowerQueries will be cancelled)
+        for job, analytic in list(running.items()):
+            error_message = None
+            try:
+                if job.running and job.next_poll <= monotonic():
+                    job.poll()
+                if job.running:
+                    continue
+
+                del running[job]
+                if job.cancelled:
+                    error_message = job.error
+                else:
+                    if debug or DEBUG:
+                        print('***DATA (JSON): {}'.format(job.response.json()))
+                    data = job.response.json()['data']['data']
+            except Exception:
+                running.pop(job, None)
+                error_message = job.response.text if job.response is not None else 'PowerQuery could not be pinged (connection failure)'
+
+            # yield outside of the try block, so that closing the generator (GeneratorExit) is not caught
+            if error_message is not None:
+                fail(analytic, error_message)
+                yield analytic, "ERROR", job.latency
+            else:
+                yield analytic, data, job.latency
+
+        if running:
+            sleep(max(0, min(job.next_poll for job in running) - monotonic()))
+
+def run_powerquery(body, debug=False):
+    """
+    Submit a PowerQuery and ping it until it is complete (see PowerQueryJob).
+    :param body: Body of the PowerQuery API call.
+    :return: Response of the last ping (or of the submission if the PowerQuery completed immediately).
+        Raises TimeoutError if the PowerQuery was cancelled (QUERY_TIMEOUT setting).
+    """
+    return PowerQueryJob(body, debug=debug).run().response
+
+def parse_timebucket(value):
+    """
+    Convert a timebucket value returned by PowerQuery (epoch in nanoseconds, or date string) to a date.
+    :param value: timebucket value.
+    :return: date object (UTC).
+    """
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1e9, tz=timezone.utc).date()
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).date()
+
+def query_by_day(analytic, from_date, to_date, debug=None):
+    """
+    Run the PowerQuery of an analytic over a date range, with results grouped by day (timebucket).
+    Used by the "regenerate stats" task to rebuild all snapshots of an analytic with a single PowerQuery.
+    :param analytic: Analytic object corresponding to the threat hunting analytic.
+    :param from_date: Start date for the query (isoformat, midnight).
+    :param to_date: End date for the query (isoformat, midnight).
+    :return: Dictionary {date: results} where results have the same format as the "query" function output,
+        or None if the PowerQuery failed or was truncated (the caller should then fall back to one query per day).
+    """
+    init_globals()
+
+    # Use the global variable if not provided
+    if debug is None:
+        debug = DEBUG
+
+    nb_days = (datetime.fromisoformat(to_date) - datetime.fromisoformat(from_date)).days
+    limit = min(CAMPAIGN_MAX_HOSTS_THRESHOLD * nb_days, PQ_MAX_LIMIT)
+    body = {
+        'fromDate': from_date,
+        'query': f"{analytic.query} | group nb=count(), storylineid=hacklist(src.process.storyline.id) by day=timebucket('1 day'), endpoint.name, site.name",
+        'toDate': to_date,
+        'limit': limit
+    }
+
+    if debug or DEBUG:
+        print('*** RUNNING QUERY BY DAY {}: {}'.format(analytic.name, analytic.query))
+        print('*** BODY: {}'.format(body))
+
+    try:
+        data = run_powerquery(body, debug)
+        data = data.json()['data']['data']
+    except:
+        if debug or DEBUG:
+            print(f"[ ERROR ] Query by day failed for analytic {analytic.name}.")
+        return None
+
+    # if the limit is reached, some days may be incomplete
+    if len(data) >= limit:
+        return None
+
+    res = {}
+    for row in data:
+        res.setdefault(parse_timebucket(row[0]), []).append(row[1:])
+    return res
+
 def need_to_sync_rule():
     """
     Check if the rule needs to be synced with SentinelOne.
@@ -188,7 +504,7 @@ def create_rule(analytic):
     """
     init_globals()
     body = build_rule_body(analytic)
-    r = requests.post(f'{S1_URL}/web/api/v2.1/cloud-detection/rules',
+    r = get_http_session(S1_URL, 'sentinelone').post(f'{S1_URL}/web/api/v2.1/cloud-detection/rules',
         json=body,
         headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
         proxies=PROXY
@@ -204,7 +520,7 @@ def update_rule(analytic):
 
     init_globals()
     # check if STAR rule already exists (STAR rule flag was previously set)
-    r = requests.get(f'{S1_URL}/web/api/v2.1/cloud-detection/rules?name__contains={STAR_RULES_PREFIX}{analytic.name}',
+    r = get_http_session(S1_URL, 'sentinelone').get(f'{S1_URL}/web/api/v2.1/cloud-detection/rules?name__contains={STAR_RULES_PREFIX}{analytic.name}',
         headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
         proxies=PROXY
         )
@@ -246,7 +562,7 @@ def update_rule(analytic):
                 }
             }
             
-        r = requests.put(f'{S1_URL}/web/api/v2.1/cloud-detection/rules/{rule_id}',
+        r = get_http_session(S1_URL, 'sentinelone').put(f'{S1_URL}/web/api/v2.1/cloud-detection/rules/{rule_id}',
             json=body_update,
             headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
             proxies=PROXY
@@ -254,7 +570,7 @@ def update_rule(analytic):
     else:
         # if it does not exist (STAR rule flag was not set), create it
         body_new = build_rule_body(analytic)
-        r = requests.post(f'{S1_URL}/web/api/v2.1/cloud-detection/rules',
+        r = get_http_session(S1_URL, 'sentinelone').post(f'{S1_URL}/web/api/v2.1/cloud-detection/rules',
             json=body_new,
             headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
             proxies=PROXY
@@ -275,7 +591,7 @@ def delete_rule(analytic):
             "name__contains": f"{STAR_RULES_PREFIX}{analytic.name}"
         }
     }
-    r = requests.delete(f'{S1_URL}/web/api/v2.1/cloud-detection/rules',
+    r = get_http_session(S1_URL, 'sentinelone').delete(f'{S1_URL}/web/api/v2.1/cloud-detection/rules',
         json=body,
         headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
         proxies=PROXY
@@ -289,7 +605,7 @@ def get_threats(hostname, sincedate):
     :return: List of threats (array) or None if not found.
     """
     init_globals()
-    r = requests.get(
+    r = get_http_session(S1_URL, 'sentinelone').get(
         f'{S1_URL}/web/api/v2.1/threats?computerName__contains={hostname}&createdAt__gte={sincedate}',
         params = {"limit": 100},
         headers={'Authorization': 'ApiToken:{}'.format(S1_TOKEN)},
@@ -304,7 +620,7 @@ def get_machine_details(hostname):
     :return: Dictionary containing machine details or None if not found.
     """
     init_globals()
-    r = requests.get(
+    r = get_http_session(S1_URL, 'sentinelone').get(
         '{}/web/api/v2.1/agents?computerName={}'.format(S1_URL, hostname),
         headers={'Authorization': 'ApiToken:{}'.format(S1_TOKEN)},
         proxies=PROXY
@@ -318,7 +634,7 @@ def get_last_logged_in_user(agent_id):
     :return: String containing the machine owner or None if not found.
     """
     init_globals()
-    r = requests.get(
+    r = get_http_session(S1_URL, 'sentinelone').get(
         '{}/web/api/v2.1/agents?ids={}'.format(S1_URL, agent_id),
         headers={'Authorization': 'ApiToken:{}'.format(S1_TOKEN)},
         proxies=PROXY
@@ -334,7 +650,7 @@ def get_applications(agent_id):
     :return: List of applications (array) or None if not found.
     """
     init_globals()
-    r = requests.get(
+    r = get_http_session(S1_URL, 'sentinelone').get(
         f'{S1_URL}/web/api/v2.1/agents/applications?ids={agent_id}',
         headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
         proxies=PROXY
@@ -414,27 +730,8 @@ and dst.ip.address != '127.0.0.1'
         'limit': 100
     }
             
-    r = requests.post('{}/web/api/v2.1/dv/events/pq'.format(S1_URL),
-        json=body,
-        headers={'Authorization': 'ApiToken:{}'.format(S1_TOKEN)},
-        proxies=PROXY)
-
     try:
-        query_id = r.json()['data']['queryId']
-        status = r.json()['data']['status']
-    
-        # Ping PowerQuery every second, until it is complete (unless you do that, the PowerQuery will be cancelled)
-        while status == 'RUNNING':
-            r = requests.get('{}/web/api/v2.1/dv/events/pq-ping'.format(S1_URL),
-                params = {"queryId": query_id},
-                headers={'Authorization': 'ApiToken:{}'.format(S1_TOKEN)},
-                proxies=PROXY)
-                
-            status = r.json()['data']['status']
-            progress = r.json()['data']['progress']
-            
-            sleep(1)
-
+        r = run_powerquery(body)
         return r.json()['data']['data'] if r.status_code == 200 and r.json()['data']['data'] else None
     
     except:
@@ -449,7 +746,7 @@ def get_token_expiration():
 
     init_globals()
     try:
-        r = requests.post(f'{S1_URL}/web/api/v2.1/users/api-token-details',
+        r = get_http_session(S1_URL, 'sentinelone').post(f'{S1_URL}/web/api/v2.1/users/api-token-details',
             headers={'Authorization': f'ApiToken:{S1_TOKEN}'},
             json={ "data": { "apiToken": S1_TOKEN } },
             proxies=PROXY)
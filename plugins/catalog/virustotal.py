@@ -2,8 +2,7 @@
 VirusTotal connector
 """
 
-from connectors.utils import get_connector_conf, is_valid_md5, is_valid_sha1, is_valid_sha256, is_valid_ip
-import requests
+from connectors.utils import get_connector_conf, is_valid_md5, is_valid_sha1, is_valid_sha256, is_valid_ip, get_http_session
 from django.conf import settings
 import vt
 from notifications.utils import add_error_notification
@@ -66,7 +65,7 @@ def check_ip(ip):
         }
 
         try:
-            response = requests.get(
+            response = get_http_session('https://www.virustotal.com/').get(
                 f"https://www.virustotal.com/api/v3/ip_addresses/{ip}",
                 headers=headers,
                 proxies=PROXY
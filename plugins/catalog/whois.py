@@ -2,8 +2,7 @@
 WHOIS connector
 """
 
-from connectors.utils import get_connector_conf, is_valid_ip
-import requests
+from connectors.utils import get_connector_conf, is_valid_ip, get_http_session
 from django.conf import settings
 from bs4 import BeautifulSoup
 
@@ -33,7 +32,7 @@ def whois(ip):
     """
     init_globals()
     if is_valid_ip(ip):
-        response = requests.get(
+        response = get_http_session('https://www.whois.com/').get(
             'https://www.whois.com/whois/{}/'.format(ip),
             proxies=PROXY
             )
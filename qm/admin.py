@@ -1,6 +1,6 @@
 from django.contrib import admin
 from .models import (Country, TargetOs, Vulnerability, MitreTactic, MitreTechnique, ThreatName,  
-    ThreatActor, Analytic, AnalyticMeta, Snapshot, Campaign, Endpoint, Tag, TasksStatus, Category,
+    ThreatActor, Analytic, AnalyticMeta, AnalyticStats, Snapshot, Campaign, Host, Endpoint, Tag, TasksStatus, Category,
     Review, SavedSearch, CampaignCompletion)
 from connectors.models import Connector
 from django.contrib.admin.models import LogEntry
@@ -222,6 +222,10 @@ class AnalyticMetaAdmin(admin.ModelAdmin):
     search_fields = ['analytic__name']
     list_filter = ['last_time_seen', 'query_error', 'query_error_date', 'maxhosts_count', 'next_review_date']
 
+class AnalyticStatsAdmin(admin.ModelAdmin):
+    list_display = ('analytic', 'count', 'hits_count_mean', 'hits_count_m2', 'hits_endpoints_mean', 'hits_endpoints_m2')
+    search_fields = ['analytic__name']
+
 class SnapshotAdmin(admin.ModelAdmin):
     list_display = ('get_campaign', 'analytic__name', 'analytic__connector__name', 'date', 'runtime', 'hits_count', 'hits_endpoints','zscore_count', 'zscore_endpoints', 'anomaly_alert_count', 'anomaly_alert_endpoints',)
     list_filter = ['campaign__name', 'analytic__connector__name', 'analytic__name', 'date', 'anomaly_alert_count', 'anomaly_alert_endpoints']
@@ -258,10 +262,16 @@ class ThreatActorAdmin(admin.ModelAdmin):
     list_filter = ['source_country']
     search_fields = ['name', 'aka_name']
 
+class HostAdmin(admin.ModelAdmin):
+    list_display = ('hostname', 'site', 'first_seen', 'last_seen')
+    list_filter = ['site', 'last_seen']
+    search_fields = ['hostname']
+
 class EndpointAdmin(admin.ModelAdmin):
-    list_display = ('hostname', 'site', 'get_analytic_name', 'get_connector_name', 'get_confidence', 'get_relevance', 'get_date', 'storylineid')
-    list_filter = ['snapshot__date', 'site', 'snapshot__analytic__connector__name', 'snapshot__analytic__confidence', 'snapshot__analytic__relevance', 'snapshot__analytic__name']
-    search_fields = ['hostname', 'snapshot__analytic__name', 'storylineid']
+    list_display = ('host__hostname', 'host__site', 'get_analytic_name', 'get_connector_name', 'get_confidence', 'get_relevance', 'get_date', 'storylineid')
+    list_filter = ['snapshot__date', 'host__site', 'snapshot__analytic__connector__name', 'snapshot__analytic__confidence', 'snapshot__analytic__relevance', 'snapshot__analytic__name']
+    search_fields = ['host__hostname', 'snapshot__analytic__name', 'storylineid']
+    list_select_related = ['host', 'snapshot__analytic__connector']
 
     @admin.display(description='analytic')
     def get_analytic_name(self, obj):
@@ -318,9 +328,11 @@ admin.site.register(ThreatName, ThreatNameAdmin)
 admin.site.register(ThreatActor, ThreatActorAdmin)
 admin.site.register(Analytic, AnalyticAdmin)
 admin.site.register(AnalyticMeta, AnalyticMetaAdmin)
+admin.site.register(AnalyticStats, AnalyticStatsAdmin)
 admin.site.register(Review)
 admin.site.register(Snapshot, SnapshotAdmin)
 admin.site.register(Campaign, CampaignAdmin)
+admin.site.register(Host, HostAdmin)
 admin.site.register(Endpoint, EndpointAdmin)
 admin.site.register(TasksStatus, TasksStatusAdmin)
 admin.site.register(Category, CategoryAdmin)
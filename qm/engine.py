@@ -0,0 +1,228 @@
+"""
+Campaign engine.
+Runs the queries of threat hunting analytics concurrently, with a maximum number of in-flight queries per connector.
+Results are returned as soon as each query completes, so that they can be saved in DB by the caller.
+Analytics sharing the same query (after normalization) on the same connector are run only once.
+"""
+
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from django.db import connection
+from requests.exceptions import RequestException
+from connectors.utils import get_max_concurrent_queries, get_cached_result, set_cached_result, is_circuit_open, group_by_query, manage_analytic_error
+
+# Dynamically import all connectors
+import importlib
+import pkgutil
+import plugins
+all_connectors = {}
+for loader, module_name, is_pkg in pkgutil.iter_modules(plugins.__path__):
+    module = importlib.import_module(f"plugins.{module_name}")
+    all_connectors[module_name] = module
+
+
+def reset_analytic_error(analytic):
+    """
+    Reset the query error flags of an analytic before running its query.
+    We assume that analytic won't fail (flag will be set later if analytic fails).
+    :param analytic: Analytic object (analyticmeta should be preloaded).
+    """
+    analytic.analyticmeta.query_error = False
+    analytic.analyticmeta.query_error_message = ''
+    analytic.analyticmeta.query_error_date = None
+    analytic.analyticmeta.save()
+
+def query_connector(analytic, from_date, to_date, debug=False):
+    """
+    Call the "query" function of the connector of an analytic, through the query cache.
+    The result is served from cache if the same query was already run for the same time window (see QUERY_CACHE setting).
+    :param analytic: Analytic object.
+    :param from_date: Start date of the query, in isoformat.
+    :param to_date: End date of the query, in isoformat.
+    :return: Result of the connector "query" function.
+    """
+    data = get_cached_result(analytic, from_date, to_date)
+    if data is not None:
+        if debug:
+            print(f"*** {analytic.name}: result served from cache")
+        return data
+
+    data = all_connectors.get(analytic.connector.name).query(
+        analytic=analytic,
+        from_date=from_date,
+        to_date=to_date,
+        debug=debug
+        )
+    set_cached_result(analytic, from_date, to_date, data)
+    return data
+
+def run_analytic_query(analytic, from_date, to_date, debug=False):
+    """
+    Run the query of an analytic against its connector. Called from a worker thread of the campaign engine.
+    :param analytic: Analytic object (connector and analyticmeta should be preloaded).
+    :param from_date: Start date of the query, in isoformat.
+    :param to_date: End date of the query, in isoformat.
+    :return: Tuple (analytic, data, runtime), where data is the result of the connector "query" function and runtime is in seconds.
+    """
+    try:
+        reset_analytic_error(analytic)
+
+        # store current time (used to update snapshot runtime)
+        start_runtime = datetime.now()
+
+        # Call the "query" function of the appropriate connector
+        # Number of endpoints is evaluated by length of data. The data arrary returned should have the following fields:
+        #  - endpoint name
+        #  - site name (endpoint name group)
+        #  - number of events
+        #  - storylineIDs separated by commas
+        data = query_connector(analytic, from_date, to_date, debug=debug)
+
+        # store current time (used to update snapshot runtime)
+        end_runtime = datetime.now()
+
+        return analytic, data, (end_runtime-start_runtime).total_seconds()
+
+    finally:
+        # Each worker thread opens its own DB connection. It is closed here to avoid leaking connections.
+        connection.close()
+
+def execute_analytics(analytics, from_date, to_date, debug=False):
+    """
+    Run the queries of a list of analytics concurrently.
+    One pool of workers is created per connector, sized with the MAX_CONCURRENT_QUERIES setting of the connector.
+    Connectors exposing a "query_batch" function (submit all queries, then poll) are run in a single dedicated thread instead.
+    Analytics of a connector whose circuit breaker is open (see connectors.utils.record_connector_failure) are skipped,
+    and returned as failed, while the other connectors keep running.
+    This is a generator: results are yielded (in completion order) as soon as each query completes.
+    Closing the generator before the end cancels the queries that have not started yet.
+    Analytics sharing the same query on the same connector (e.g., cloned or imported twice) are deduplicated:
+    the query is run once, and its result is returned for each of these analytics.
+    :param analytics: List (or queryset) of Analytic objects.
+    :param from_date: Start date of the queries, in isoformat.
+    :param to_date: End date of the queries, in isoformat.
+    :return: Generator of tuples (analytic, data, runtime).
+    """
+    analytics = list(analytics)
+    results = queue.Queue()
+    executors = []
+    # Set when the caller stops consuming results, so that batch threads stop submitting new queries
+    stop = threading.Event()
+
+    # Deduplicate identical queries: only the first analytic of each group is run
+    # {analytic_id: [other analytics sharing the same query]}
+    duplicates = {}
+    for group in group_by_query(analytics).values():
+        duplicates[group[0].pk] = group[1:]
+        if debug and len(group) > 1:
+            print(f"*** {group[0].name}: same query as {', '.join(a.name for a in group[1:])} (run once)")
+
+    # Group analytics by connector
+    analytics_by_connector = defaultdict(list)
+    for analytic in analytics:
+        if analytic.pk in duplicates:
+            analytics_by_connector[analytic.connector.name].append(analytic)
+
+    def worker(analytic):
+        try:
+            # Analytics of a connector whose circuit breaker is open are skipped (they can be run again by resuming the campaign)
+            if is_circuit_open(analytic.connector.name):
+                if debug:
+                    print(f"*** {analytic.name}: skipped (circuit breaker of {analytic.connector.name} is open)")
+                results.put((analytic, "ERROR", 0))
+                return
+            results.put(run_analytic_query(analytic, from_date, to_date, debug))
+        except RequestException as e:
+            # Connection failure (counted by the circuit breaker of the connector): the analytic fails, other analytics keep running
+            if debug:
+                print(f"*** {analytic.name}: connection failure ({e})")
+            results.put((analytic, "ERROR", 0))
+        except Exception as e:
+            # exception is raised again in the main thread
+            results.put(e)
+        finally:
+            connection.close()
+
+    def batch_worker(connector_name, connector, connector_analytics):
+        batch = None
+        try:
+            to_query = []
+            for analytic in connector_analytics:
+                reset_analytic_error(analytic)
+                # results available in cache are returned immediately
+                data = get_cached_result(analytic, from_date, to_date)
+                if data is not None:
+                    results.put((analytic, data, 0))
+                else:
+                    to_query.append(analytic)
+            done = set()
+            if not is_circuit_open(connector_name):
+                batch = connector.query_batch(
+                    analytics=to_query,
+                    from_date=from_date,
+                    to_date=to_date,
+                    debug=debug
+                    )
+                for result in batch:
+                    set_cached_result(result[0], from_date, to_date, result[1])
+                    results.put(result)
+                    done.add(result[0].pk)
+                    if stop.is_set() or is_circuit_open(connector_name):
+                        break
+            # Remaining analytics are skipped when the circuit breaker of the connector is open
+            if not stop.is_set():
+                for analytic in to_query:
+                    if analytic.pk not in done:
+                        if debug:
+                            print(f"*** {analytic.name}: skipped (circuit breaker of {connector_name} is open)")
+                        results.put((analytic, "ERROR", 0))
+        except Exception as e:
+            results.put(e)
+        finally:
+            if batch is not None:
+                batch.close()
+            connection.close()
+
+    try:
+        nb_queries = 0
+        for connector_name, connector_analytics in analytics_by_connector.items():
+            connector = all_connectors.get(connector_name)
+            max_workers = get_max_concurrent_queries(connector_name)
+            if debug:
+                print(f"*** {connector_name}: {len(connector_analytics)} analytics, {max_workers} concurrent queries")
+            if hasattr(connector, 'query_batch'):
+                # Concurrency is managed by the connector itself
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"campaign_{connector_name}")
+                executors.append(executor)
+                executor.submit(batch_worker, connector_name, connector, connector_analytics)
+            else:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"campaign_{connector_name}")
+                executors.append(executor)
+                for analytic in connector_analytics:
+                    executor.submit(worker, analytic)
+            nb_queries += len(connector_analytics)
+
+        for _ in range(nb_queries):
+            result = results.get()
+            if isinstance(result, Exception):
+                raise result
+            yield result
+
+            # The result is fanned out to the analytics sharing the same query
+            analytic, data, runtime = result
+            for duplicate in duplicates[analytic.pk]:
+                if data != "ERROR":
+                    reset_analytic_error(duplicate)
+                elif analytic.analyticmeta.query_error:
+                    # the error of the query is reported for each analytic (skipped analytics have no error message)
+                    manage_analytic_error(duplicate, f"{analytic.analyticmeta.query_error_message} (same query as analytic {analytic.name})")
+                yield duplicate, data, runtime
+
+    finally:
+        # Pending queries are cancelled (e.g., if the caller stops on error), running queries are awaited
+        stop.set()
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,269 @@
+"""
+Management command: bench_campaign
+
+Benchmarks the campaigns and the stats regeneration end-to-end, without
+any data lake: analytics are run against the "replay" connector
+(connectors.replay), which serves recorded responses with a configurable
+latency.
+
+A synthetic set of analytics is created, and a daily campaign is run for
+each day of the retention period (DB_DATA_RETENTION, 90 days by default).
+The stats of some analytics are then regenerated. For each phase, the
+command reports the throughput (analytics/second), the number of DB
+queries per analytic, the peak memory of the process (high-water mark
+since the command started) and its increase during the phase.
+
+Responses are recorded from real queries: run campaigns (or stats
+regeneration) on the production instance with the query cache enabled,
+and export the query cache with --record. Queries without recorded
+response get a synthetic (deterministic) result.
+
+The benchmark creates campaigns for past dates and must be run against
+a dedicated database: the command refuses to run if other analytics
+exist.
+
+Examples:
+    # record responses (production instance)
+    python manage.py bench_campaign --record /tmp/fixtures.json
+
+    # 500 synthetic analytics, 200ms +/- 100ms per query
+    python manage.py bench_campaign --analytics 500 --latency 0.2 --jitter 0.1
+
+    # replay recorded responses over 30 days, with 8 concurrent queries
+    python manage.py bench_campaign --fixtures /tmp/fixtures.json --days 30 --max-concurrent-queries 8
+
+    # remove the benchmark data
+    python manage.py bench_campaign --cleanup
+"""
+import resource
+import threading
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+
+from connectors import replay
+from connectors.models import ConnectorConf
+from qm.models import Analytic, AnalyticMeta, Campaign, TasksStatus
+from qm.utils import run_campaign, get_campaign_name
+import qm.engine
+import qm.signals
+import qm.tasks
+
+DB_DATA_RETENTION = settings.DB_DATA_RETENTION
+
+CONNECTOR_NAME = replay.CONNECTOR_NAME
+ANALYTIC_PREFIX = 'bench_replay_'
+
+
+class QueryCounter:
+    """
+    Count the DB queries of all threads (the campaign engine runs queries in worker threads, each with its own connection).
+    """
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    help = "Benchmark campaigns and stats regeneration against the replay connector."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--analytics',
+            type=int,
+            help="Number of analytics (default: one per recorded query with --fixtures, 100 otherwise).",
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=DB_DATA_RETENTION,
+            help=f"Number of daily campaigns (default: DB_DATA_RETENTION, {DB_DATA_RETENTION}).",
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0,
+            help="Mean latency of each query, in seconds (default: 0).",
+        )
+        parser.add_argument(
+            '--jitter',
+            type=float,
+            default=0,
+            help="Maximum deviation from the mean latency, in seconds (default: 0).",
+        )
+        parser.add_argument(
+            '--max-concurrent-queries',
+            type=int,
+            default=4,
+            help="MAX_CONCURRENT_QUERIES of the replay connector (default: 4).",
+        )
+        parser.add_argument(
+            '--regenerate',
+            type=int,
+            default=5,
+            help="Number of analytics whose stats are regenerated (default: 5).",
+        )
+        parser.add_argument(
+            '--use-cache',
+            action='store_true',
+            help="Use the query cache (by default, it is bypassed so that every query reaches the connector).",
+        )
+        parser.add_argument(
+            '--fixtures',
+            help="Replay the responses recorded in this file.",
+        )
+        parser.add_argument(
+            '--record',
+            metavar='FILE',
+            help="Export the query cache (responses of real queries) to this file, and exit.",
+        )
+        parser.add_argument(
+            '--connector',
+            help="With --record, only export the responses of this connector.",
+        )
+        parser.add_argument(
+            '--cleanup',
+            action='store_true',
+            help="Remove the benchmark analytics and campaigns, and exit.",
+        )
+
+    def handle(self, *args, **options):
+        if options['record']:
+            nb_fixtures = replay.record_fixtures(options['record'], options['connector'])
+            self.stdout.write(self.style.SUCCESS(f"{nb_fixtures} response(s) recorded in {options['record']}"))
+            return
+
+        if Analytic.objects.exclude(connector__name=CONNECTOR_NAME, name__startswith=ANALYTIC_PREFIX).exists():
+            raise CommandError("Other analytics exist. The benchmark must be run against a dedicated database.")
+
+        campaigndates = [
+            datetime.combine(datetime.now() - timedelta(days=days), datetime.min.time())
+            for days in reversed(range(options['days']))
+        ]
+        self.cleanup(campaigndates)
+        if options['cleanup']:
+            self.stdout.write(self.style.SUCCESS("Benchmark data removed"))
+            return
+
+        fixtures = replay.load_fixtures(options['fixtures']) if options['fixtures'] else {}
+        replay.configure(options['latency'], options['jitter'], fixtures)
+        analytics = self.create_analytics(
+            options['analytics'] or len(fixtures) or 100,
+            sorted(fixtures),
+            options['max_concurrent_queries'],
+            options['use_cache']
+        )
+        self.stdout.write(
+            f"{len(analytics)} analytics, {len(fixtures)} recorded queries, "
+            f"latency {options['latency']}s +/- {options['jitter']}s, "
+            f"{options['max_concurrent_queries']} concurrent queries"
+        )
+
+        # The replay connector is not a plugin: it is registered in the modules that load the connectors
+        for module in (qm.engine, qm.tasks, qm.signals):
+            module.all_connectors[CONNECTOR_NAME] = replay
+
+        counter = QueryCounter()
+        counter.install(connection=connection)
+        connection_created.connect(counter.install)
+        try:
+            self.bench(
+                "run_campaign",
+                counter,
+                len(analytics) * len(campaigndates),
+                lambda: [run_campaign(campaigndate) for campaigndate in campaigndates]
+            )
+            regenerated = analytics[:options['regenerate']]
+            self.bench(
+                "regenerate_stats",
+                counter,
+                len(regenerated),
+                lambda: [self.regenerate_stats(analytic) for analytic in regenerated]
+            )
+        finally:
+            connection_created.disconnect(counter.install)
+            if counter in connection.execute_wrappers:
+                connection.execute_wrappers.remove(counter)
+
+    def cleanup(self, campaigndates):
+        """
+        Remove the analytics (with their snapshots and endpoints) and campaigns of a previous benchmark.
+        """
+        Analytic.objects.filter(connector__name=CONNECTOR_NAME, name__startswith=ANALYTIC_PREFIX).delete()
+        Campaign.objects.filter(
+            Q(name__in=[get_campaign_name(campaigndate) for campaigndate in campaigndates])
+            | Q(name__startswith=f"regenerate_stats_{ANALYTIC_PREFIX}")
+            ).delete()
+        TasksStatus.objects.filter(taskname__startswith=ANALYTIC_PREFIX).delete()
+
+    def create_analytics(self, nb_analytics, query_hashes, max_concurrent_queries, use_cache):
+        """
+        Create the replay connector and the benchmark analytics (in bulk, so that signals are not triggered).
+        Analytics replay the recorded queries in turn, or get a distinct synthetic query if there is no recording.
+        Queries are made unique with a suffix (ignored by the replay connector), so that analytics replaying the same
+        recorded query are not deduplicated by the campaign engine (each analytic runs its own query).
+        """
+        connector = replay.create_connector()
+        ConnectorConf.objects.update_or_create(
+            connector=connector,
+            key='MAX_CONCURRENT_QUERIES',
+            defaults={'value': str(max_concurrent_queries), 'fieldtype': 'int'}
+            )
+
+        Analytic.objects.bulk_create([
+            Analytic(
+                name=f"{ANALYTIC_PREFIX}{i:05d}",
+                connector=connector,
+                query=f"{query_hashes[i % len(query_hashes)]} {i}" if query_hashes else f"bench query {i}",
+                status='PUB',
+                run_daily=True,
+                dynamic_query=not use_cache
+            )
+            for i in range(nb_analytics)
+        ])
+        # primary keys are not returned by bulk_create on MySQL: analytics are loaded again
+        analytics = list(Analytic.objects.filter(connector=connector, name__startswith=ANALYTIC_PREFIX).order_by('name'))
+        AnalyticMeta.objects.bulk_create([AnalyticMeta(analytic=analytic) for analytic in analytics])
+        return analytics
+
+    def regenerate_stats(self, analytic):
+        """
+        Run the "regenerate stats" task synchronously.
+        """
+        TasksStatus.objects.create(taskname=analytic.name)
+        qm.tasks.regenerate_stats(analytic.pk)
+
+    def bench(self, name, counter, nb_analytics, function):
+        """
+        Run a phase of the benchmark and report its throughput, DB queries and memory.
+        The peak memory is the high-water mark of the process (including the previous phases): the increase
+        during the phase is reported as well (0 if the phase used less memory than a previous one).
+        """
+        nb_queries = counter.count
+        # ru_maxrss is in kilobytes (Linux)
+        peak_memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        nb_queries = counter.count - nb_queries
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(self.style.SUCCESS(
+            f"{name}: {nb_analytics} analytics in {elapsed:.2f}s, "
+            f"{nb_analytics / elapsed if elapsed else 0:.1f} analytics/s, "
+            f"{nb_queries / nb_analytics if nb_analytics else 0:.1f} DB queries/analytic, "
+            f"process peak memory {peak_memory:.0f} MB (+{peak_memory - peak_memory_before:.0f} MB during the phase)"
+        ))
@@ -0,0 +1,151 @@
+"""
+Management command: bench_reports
+
+Renders every report and dashboard widget, and measures its wall time
+and number of SQL queries. Run it against a large dataset (see the
+generate_dataset command) to reproduce slow pages.
+
+Measures can be saved as a baseline, and later runs compared to it: the
+command fails (non-zero exit code) when a page is slower than the
+baseline (beyond the tolerance) or runs more SQL queries, so that it can
+be used to catch performance regressions.
+
+Examples:
+    # measure all pages
+    python manage.py bench_reports
+
+    # save a baseline, then compare to it
+    python manage.py bench_reports --save /tmp/baseline.json
+    python manage.py bench_reports --baseline /tmp/baseline.json --tolerance 0.2
+
+    # only some pages
+    python manage.py bench_reports endpoints rare_occurrences
+"""
+import json
+from statistics import median
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import reverse
+
+from connectors import replay
+import dashboard.urls
+import reports.urls
+import reports.views
+
+
+class Command(BaseCommand):
+    help = "Measure the wall time and number of SQL queries of the reports and dashboard widgets."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'pages',
+            nargs='*',
+            help="Names of the pages to measure (URL names, default: all reports and dashboard widgets).",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help="Number of measures per page, the median is kept (default: 3).",
+        )
+        parser.add_argument(
+            '--user',
+            help="Username used to render the pages (default: first superuser).",
+        )
+        parser.add_argument(
+            '--save',
+            metavar='FILE',
+            help="Save the measures as a baseline in this file.",
+        )
+        parser.add_argument(
+            '--baseline',
+            metavar='FILE',
+            help="Compare the measures to the baseline saved in this file, and fail on regressions.",
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help="Maximum relative increase of the wall time over the baseline (default: 0.25).",
+        )
+        parser.add_argument(
+            '--min-delta',
+            type=float,
+            default=0.05,
+            help="Wall time increases below this value (in seconds) are ignored (default: 0.05).",
+        )
+
+    def handle(self, *args, **options):
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('pk').first()
+        if not user:
+            raise CommandError("No user to render the pages. Create a superuser or use --user.")
+
+        pages = [
+            pattern.name
+            for urlpatterns in (reports.urls.urlpatterns, dashboard.urls.urlpatterns)
+            for pattern in urlpatterns
+        ]
+        if options['pages']:
+            unknown = set(options['pages']) - set(pages)
+            if unknown:
+                raise CommandError(f"Unknown page(s): {', '.join(sorted(unknown))}")
+            pages = [page for page in pages if page in options['pages']]
+
+        # Analytics of generated datasets use the replay connector, which is not a plugin
+        reports.views.all_connectors.setdefault(replay.CONNECTOR_NAME, replay)
+
+        # Allows the test client to reach the views (ALLOWED_HOSTS)
+        setup_test_environment()
+        client = Client()
+        client.force_login(user)
+
+        measures = {}
+        for page in pages:
+            url = reverse(page)
+            # first rendering is not measured (caches)
+            response = client.get(url)
+            if response.status_code != 200:
+                self.stdout.write(self.style.ERROR(f"{page}: HTTP {response.status_code}"))
+                continue
+            times = []
+            for _ in range(options['repeat']):
+                with CaptureQueriesContext(connection) as queries:
+                    start = perf_counter()
+                    client.get(url)
+                    times.append(perf_counter() - start)
+            measures[page] = {'time': median(times), 'queries': len(queries)}
+            self.stdout.write(f"{page}: {measures[page]['time']*1000:.0f}ms, {measures[page]['queries']} SQL queries")
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(measures, f, indent=4)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved in {options['save']}"))
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = []
+            for page in pages:
+                if page not in baseline:
+                    continue
+                if page not in measures:
+                    regressions.append(f"{page}: not rendered")
+                    continue
+                measure = measures[page]
+                reference = baseline[page]
+                if (measure['time'] > reference['time'] * (1 + options['tolerance'])
+                and measure['time'] - reference['time'] > options['min_delta']):
+                    regressions.append(f"{page}: {measure['time']*1000:.0f}ms (baseline {reference['time']*1000:.0f}ms)")
+                if measure['queries'] > reference['queries']:
+                    regressions.append(f"{page}: {measure['queries']} SQL queries (baseline {reference['queries']})")
+            if regressions:
+                raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regression"))
@@ -0,0 +1,216 @@
+"""
+Management command: generate_dataset
+
+Generates a synthetic dataset with realistic volumes, to reproduce slow
+pages (see the bench_reports command): thousands of analytics, a daily
+campaign for each day of the retention period (DB_DATA_RETENTION, 90
+days by default) and millions of detected endpoints.
+
+Distributions are skewed, as in production: most analytics match
+nothing, a few of them match many endpoints, and a small set of
+endpoints is matched by most analytics. The dataset is reproducible
+(same --seed, same data).
+
+Analytics use the "replay" connector (connectors.replay). The dataset
+creates campaigns for past dates and must be generated in a dedicated
+database: the command refuses to run if other analytics exist.
+
+Examples:
+    # default volumes (2000 analytics x 90 days, ~1M endpoints)
+    python manage.py generate_dataset
+
+    # larger dataset
+    python manage.py generate_dataset --analytics 5000 --hosts 100000 --endpoints 20
+
+    # remove the dataset
+    python manage.py generate_dataset --cleanup
+"""
+import random
+from datetime import datetime, time, timedelta
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from connectors import replay
+from qm.models import Analytic, AnalyticMeta, Campaign, Category, Endpoint, Host, Snapshot
+from qm.results import ENDPOINTS_BATCH_SIZE, get_host_ids, rebuild_stats, rebuild_sparklines
+from qm.utils import close_campaign, get_campaign_name
+
+DB_DATA_RETENTION = settings.DB_DATA_RETENTION
+CAMPAIGN_MAX_HOSTS_THRESHOLD = settings.CAMPAIGN_MAX_HOSTS_THRESHOLD
+
+ANALYTIC_PREFIX = 'dataset_'
+
+# Share of analytics per status, and share of analytics that never match
+STATUSES = {'PUB': 70, 'DRAFT': 10, 'REVIEW': 3, 'PENDING': 2, 'ARCH': 15}
+SILENT_ANALYTICS = 0.3
+NB_SITES = 50
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic dataset (analytics, campaigns, snapshots and endpoints)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--analytics',
+            type=int,
+            default=2000,
+            help="Number of analytics (default: 2000).",
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=DB_DATA_RETENTION,
+            help=f"Number of daily campaigns (default: DB_DATA_RETENTION, {DB_DATA_RETENTION}).",
+        )
+        parser.add_argument(
+            '--hosts',
+            type=int,
+            default=50000,
+            help="Number of distinct endpoints (default: 50000).",
+        )
+        parser.add_argument(
+            '--endpoints',
+            type=float,
+            default=10,
+            help="Mean number of endpoints per snapshot of a matching analytic (default: 10).",
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help="Seed of the random generator (default: 0).",
+        )
+        parser.add_argument(
+            '--cleanup',
+            action='store_true',
+            help="Remove the dataset, and exit.",
+        )
+
+    def handle(self, *args, **options):
+        if Analytic.objects.exclude(connector__name=replay.CONNECTOR_NAME, name__startswith=ANALYTIC_PREFIX).exists():
+            raise CommandError("Other analytics exist. The dataset must be generated in a dedicated database.")
+
+        campaigndates = [
+            datetime.combine(datetime.now() - timedelta(days=days), datetime.min.time())
+            for days in reversed(range(options['days']))
+        ]
+        Analytic.objects.filter(name__startswith=ANALYTIC_PREFIX).delete()
+        Campaign.objects.filter(name__in=[get_campaign_name(campaigndate) for campaigndate in campaigndates]).delete()
+        Host.objects.filter(endpoint__isnull=True).delete()
+        if options['cleanup']:
+            self.stdout.write(self.style.SUCCESS("Dataset removed"))
+            return
+
+        start = perf_counter()
+        rng = random.Random(options['seed'])
+        analytics = self.create_analytics(rng, options['analytics'])
+        self.stdout.write(f"{len(analytics)} analytics created")
+
+        # Mean number of endpoints of each analytic (Pareto distributed, a few analytics match many endpoints)
+        rates = {
+            analytic.pk: 0 if rng.random() < SILENT_ANALYTICS
+            else min(options['endpoints'] * 0.2 * rng.paretovariate(1.25), CAMPAIGN_MAX_HOSTS_THRESHOLD)
+            for analytic in analytics
+        }
+        nb_endpoints = 0
+        for campaigndate in campaigndates:
+            nb_endpoints += self.create_campaign(rng, campaigndate, analytics, rates, options['hosts'])
+            self.stdout.write(f"{get_campaign_name(campaigndate)}: {nb_endpoints} endpoints")
+
+        for analytic in analytics:
+            rebuild_stats(analytic)
+        rebuild_sparklines([analytic.pk for analytic in analytics])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(analytics)} analytics, {len(campaigndates)} campaigns and {nb_endpoints} endpoints "
+            f"generated in {perf_counter() - start:.2f}s"
+        ))
+
+    def create_analytics(self, rng, nb_analytics):
+        """
+        Create the analytics (in bulk, so that signals are not triggered).
+        """
+        connector = replay.create_connector()
+        categories = list(Category.objects.all()) or [None]
+        statuses = rng.choices(list(STATUSES), weights=list(STATUSES.values()), k=nb_analytics)
+        Analytic.objects.bulk_create([
+            Analytic(
+                name=f"{ANALYTIC_PREFIX}{i:05d}",
+                description=f"Synthetic analytic {i}",
+                connector=connector,
+                query=f"dataset query {i}",
+                status=statuses[i],
+                run_daily=statuses[i] == 'PUB',
+                confidence=rng.randint(1, 4),
+                relevance=rng.randint(1, 4),
+                category=rng.choice(categories)
+            )
+            for i in range(nb_analytics)
+        ])
+        # primary keys are not returned by bulk_create on MySQL: analytics are loaded again
+        analytics = list(Analytic.objects.filter(connector=connector, name__startswith=ANALYTIC_PREFIX).order_by('name'))
+        today = datetime.now().date()
+        AnalyticMeta.objects.bulk_create([
+            AnalyticMeta(
+                analytic=analytic,
+                next_review_date=today + timedelta(days=rng.randint(-10, 90)) if analytic.status == 'PUB' else None,
+                query_error=rng.random() < 0.02
+            )
+            for analytic in analytics
+        ])
+        return analytics
+
+    def create_campaign(self, rng, campaigndate, analytics, rates, nb_hosts):
+        """
+        Create the daily campaign of a given date, with the snapshots of the analytics run daily and their endpoints.
+        :return: Number of endpoints created.
+        """
+        campaign = Campaign.objects.create(
+            name=get_campaign_name(campaigndate),
+            description='Daily cron job, run all analytics',
+            date_start=datetime.combine(campaigndate, time(1))
+            )
+
+        results = {}
+        snapshots = []
+        for analytic in analytics:
+            if not analytic.run_daily:
+                continue
+            # Hosts are skewed: low indexes are matched much more often
+            nb_endpoints = min(int(rates[analytic.pk] * rng.uniform(0.5, 1.5)), nb_hosts)
+            hosts = {int(nb_hosts * rng.random() ** 3) for _ in range(nb_endpoints)}
+            results[analytic.pk] = [(host, rng.randint(1, 50)) for host in hosts]
+            snapshots.append(Snapshot(
+                campaign=campaign,
+                analytic=analytic,
+                date=(campaigndate - timedelta(days=1)).date(),
+                runtime=rng.lognormvariate(1, 1),
+                hits_count=sum(count for host, count in results[analytic.pk]),
+                hits_endpoints=len(hosts)
+            ))
+
+        with transaction.atomic():
+            Snapshot.objects.bulk_create(snapshots, batch_size=ENDPOINTS_BATCH_SIZE)
+            # primary keys are not returned by bulk_create on MySQL: snapshots are loaded again
+            snapshot_ids = dict(Snapshot.objects.filter(campaign=campaign).values_list('analytic_id', 'pk'))
+            host_ids = get_host_ids(
+                [[f"host-{host:06d}", f"site-{host % NB_SITES:02d}"] for host in {host for hosts in results.values() for host, count in hosts}],
+                (campaigndate - timedelta(days=1)).date()
+                )
+            endpoints = [
+                Endpoint(
+                    host_id=host_ids[f"host-{host:06d}"],
+                    snapshot_id=snapshot_ids[analytic_id]
+                )
+                for analytic_id, hosts in results.items()
+                for host, count in hosts
+            ]
+            Endpoint.objects.bulk_create(endpoints, batch_size=ENDPOINTS_BATCH_SIZE)
+
+        # Anomaly detection, campaign stats and completion per connector, as for real campaigns
+        close_campaign(campaign, campaigndate)
+        Campaign.objects.filter(pk=campaign.pk).update(date_end=datetime.combine(campaigndate, time(2)))
+        return len(endpoints)
@@ -0,0 +1,121 @@
+"""
+Management command: index_report
+
+Runs EXPLAIN on the main queries of the analytics list, the timeline,
+the reports and the dashboards, and flags the full scans of the large
+tables (snapshots, endpoints, hosts, host scores). Use it after an upgrade, or when a
+page is slow (see the bench_reports command), to check that the queries
+use the indexes of the models.
+
+Queries are run with sample values taken from the database (latest
+campaign, most recent host, analytic with the most snapshots). Supported
+databases: MySQL/MariaDB, PostgreSQL and SQLite.
+
+Examples:
+    python manage.py index_report
+
+    # show the plan of all queries, not only the full scans
+    python manage.py index_report --verbosity 2
+"""
+import re
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Sum
+
+from qm.models import Analytic, Campaign, Endpoint, Host, HostScore, Snapshot
+
+# Full scans are only flagged for these tables (other tables are small)
+LARGE_TABLES = [Snapshot._meta.db_table, Endpoint._meta.db_table, Host._meta.db_table, HostScore._meta.db_table]
+
+
+def explain(queryset):
+    """
+    Get the execution plan of a queryset.
+    :param queryset: QuerySet object.
+    :return: List of tuples (table, plan step, full scan flag).
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute(f"EXPLAIN {sql}", params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            return [
+                (row['table'], f"type={row['type']} key={row['key']} rows={row['rows']}", row['type'] == 'ALL')
+                for row in rows
+            ]
+        if connection.vendor == 'postgresql':
+            cursor.execute(f"EXPLAIN {sql}", params)
+            steps = []
+            for (line,) in cursor.fetchall():
+                match = re.search(r'Seq Scan on (\w+)', line)
+                steps.append((match.group(1) if match else '', line.strip(), bool(match)))
+            return steps
+        if connection.vendor == 'sqlite':
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            steps = []
+            for row in cursor.fetchall():
+                detail = row[-1]
+                match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+                steps.append((match.group(1) if match else '', detail, bool(match) and ' USING ' not in detail))
+            return steps
+    raise CommandError(f"Unsupported database: {connection.vendor}")
+
+
+class Command(BaseCommand):
+    help = "Run EXPLAIN on the main queries of the pages, and flag full scans of the large tables."
+
+    def get_queries(self):
+        """
+        Queries of the pages (same filters, joins and groupings as the views), with sample values from the database.
+        :return: Dictionary {description: queryset}.
+        """
+        campaign = Campaign.objects.filter(name__startswith='daily_cron_').order_by('-date_start').first()
+        host = Host.objects.order_by('-last_seen').first()
+        analytic = Analytic.objects.annotate(nb_snapshots=Count('snapshot')).order_by('-nb_snapshots').first()
+        if not campaign or not host or not analytic:
+            raise CommandError("No data to sample values from (campaigns, hosts and analytics are needed).")
+        yesterday = datetime.today() - timedelta(days=1)
+
+        return {
+            "list_analytics: last snapshot of an analytic": Snapshot.objects.filter(analytic=analytic, date=yesterday),
+            "trend: snapshots of an analytic": Snapshot.objects.filter(analytic=analytic, date__gt=datetime.today()-timedelta(days=90)).order_by('date'),
+            "trend: endpoints of an analytic": Endpoint.objects.filter(snapshot__analytic=analytic).values('host__hostname').distinct(),
+            "timeline: endpoints of a host": Endpoint.objects.filter(host__hostname=host.hostname).select_related('snapshot__analytic__connector').order_by('snapshot__date'),
+            "timeline: score of a host per day": Endpoint.objects.filter(host__hostname=host.hostname).values('snapshot__date').annotate(
+                cumulative_score=Sum('snapshot__analytic__weighted_relevance')).order_by('snapshot__date'),
+            "reports.endpoints: top endpoints of a campaign": HostScore.objects.filter(campaign=campaign).values(
+                'host', 'host__hostname', 'site', 'total_weighted_score').order_by('-total_weighted_score')[:300],
+            "reports.rare_occurrences: endpoints per analytic": Endpoint.objects.values('snapshot__analytic__id', 'host__hostname').exclude(
+                snapshot__analytic__status='ARCH'),
+            "reports.endpoints_most_analytics: analytics per endpoint": Endpoint.objects.values('host', 'host__hostname', 'host__site').annotate(
+                analytics_count=Count('snapshot__analytic', distinct=True)).order_by('-analytics_count')[:300],
+            "reports.highest_weighted_score: top endpoint of a campaign": HostScore.objects.filter(campaign=campaign).values(
+                'host__hostname', 'total_weighted_score').order_by('-total_weighted_score')[:1],
+            "dashboard: highest score of all campaigns": HostScore.objects.filter(campaign__name__startswith='daily_cron_').values(
+                'total_weighted_score').order_by('-total_weighted_score')[:1],
+            "reports.analytics_perfs: snapshots of a day": Snapshot.objects.filter(date=yesterday).order_by('-runtime'),
+            "dashboard: analytics matching on a day": Analytic.objects.filter(snapshot__hits_count__gt=0, snapshot__date=yesterday.date()).distinct(),
+            "dashboard: distinct endpoints of a campaign": Endpoint.objects.filter(snapshot__campaign=campaign).values('host').distinct(),
+        }
+
+    def handle(self, *args, **options):
+        nb_full_scans = 0
+        for description, queryset in self.get_queries().items():
+            steps = explain(queryset)
+            full_scans = [step for step in steps if step[2] and step[0] in LARGE_TABLES]
+            nb_full_scans += len(full_scans)
+            if full_scans:
+                self.stdout.write(self.style.WARNING(f"{description}: full scan of {', '.join(step[0] for step in full_scans)}"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{description}: OK"))
+            if options['verbosity'] > 1 or full_scans:
+                for table, step, full_scan in steps:
+                    self.stdout.write(f"    {step}")
+
+        if nb_full_scans:
+            self.stdout.write(self.style.WARNING(f"{nb_full_scans} full scan(s) of large tables"))
+        else:
+            self.stdout.write(self.style.SUCCESS("No full scan of large tables"))
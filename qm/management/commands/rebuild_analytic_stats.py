@@ -0,0 +1,51 @@
+"""
+Management command: rebuild_analytic_stats
+
+Rebuilds the running statistics (count, mean and M2 of hits_count and
+hits_endpoints) used to compute the zscores of new snapshots, and the
+sparklines of the analytics (values of the last days), from the
+snapshots available in the database.
+
+The running statistics and sparklines are maintained incrementally by campaigns, stats
+regeneration and retention purges. This command is only needed after an
+upgrade, or if snapshots were deleted outside of DeepHunter (e.g., from the
+admin or directly in the database).
+
+Examples:
+    # all analytics
+    python manage.py rebuild_analytic_stats
+
+    # a single analytic
+    python manage.py rebuild_analytic_stats --analytic my_analytic_name
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from qm.models import Analytic
+from qm.results import rebuild_stats, rebuild_sparklines
+
+
+class Command(BaseCommand):
+    help = "Rebuild the running statistics and sparklines of analytics from existing snapshots."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--analytic',
+            help="Name of the analytic to rebuild (default: all analytics).",
+        )
+
+    def handle(self, *args, **options):
+        analytics = Analytic.objects.all()
+        if options['analytic']:
+            analytics = analytics.filter(name=options['analytic'])
+            if not analytics.exists():
+                raise CommandError(f"No analytic named '{options['analytic']}'.")
+
+        for analytic in analytics:
+            analytic_stats = rebuild_stats(analytic)
+            rebuild_sparklines([analytic.pk])
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{analytic.name}: {analytic_stats.count} snapshot(s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Running statistics and sparklines rebuilt for {analytics.count()} analytic(s)."
+        ))
@@ -0,0 +1,61 @@
+"""
+Management command: score_campaign
+
+Computes again the zscores and anomaly alerts of all snapshots of one or
+several campaigns, in a single vectorized pass per campaign.
+
+Campaigns are scored automatically when they complete. This command is
+useful when anomaly thresholds of analytics have changed, or when
+snapshots of the retention period have been modified (e.g., stats
+regeneration).
+
+Examples:
+    # latest campaign
+    python manage.py score_campaign
+
+    # given campaigns
+    python manage.py score_campaign daily_cron_2025-06-01 daily_cron_2025-06-02
+
+    # all campaigns
+    python manage.py score_campaign --all
+"""
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from qm.models import Campaign
+from qm.scoring import score_campaign
+
+
+class Command(BaseCommand):
+    help = "Compute zscores and anomaly alerts of campaigns again."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'campaigns',
+            nargs='*',
+            help="Names of the campaigns to score (default: latest campaign).",
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help="Score all campaigns.",
+        )
+
+    def handle(self, *args, **options):
+        if options['all']:
+            campaigns = Campaign.objects.order_by('date_start')
+        elif options['campaigns']:
+            campaigns = Campaign.objects.filter(name__in=options['campaigns'])
+            missing = set(options['campaigns']) - set(campaigns.values_list('name', flat=True))
+            if missing:
+                raise CommandError(f"Unknown campaign(s): {', '.join(sorted(missing))}")
+        else:
+            campaigns = Campaign.objects.order_by('-date_start')[:1]
+
+        for campaign in campaigns:
+            start = perf_counter()
+            nb_snapshots = score_campaign(campaign)
+            self.stdout.write(self.style.SUCCESS(
+                f"{campaign.name}: {nb_snapshots} snapshot(s) scored in {perf_counter() - start:.2f}s"
+            ))
@@ -219,6 +219,123 @@ class AnalyticMeta(models.Model):
     def __str__(self):
         return self.analytic.name
 
+class AnalyticStats(models.Model):
+    analytic = models.OneToOneField(Analytic, on_delete=models.CASCADE, primary_key=True)
+    count = models.IntegerField(default=0, help_text="Number of snapshots")
+    hits_count_mean = models.FloatField(default=0)
+    hits_count_m2 = models.FloatField(default=0, help_text="Sum of squared differences from the mean (Welford)")
+    hits_endpoints_mean = models.FloatField(default=0)
+    hits_endpoints_m2 = models.FloatField(default=0, help_text="Sum of squared differences from the mean (Welford)")
+
+    def __str__(self):
+        return self.analytic.name
+
+    def reset(self):
+        self.count = 0
+        self.hits_count_mean = 0
+        self.hits_count_m2 = 0
+        self.hits_endpoints_mean = 0
+        self.hits_endpoints_m2 = 0
+
+    def add(self, hits_count, hits_endpoints):
+        """
+        Add the values of a new snapshot (Welford's online algorithm).
+        """
+        self.count += 1
+        for field, value in (('hits_count', hits_count), ('hits_endpoints', hits_endpoints)):
+            mean = getattr(self, f'{field}_mean')
+            delta = value - mean
+            mean += delta / self.count
+            setattr(self, f'{field}_mean', mean)
+            setattr(self, f'{field}_m2', getattr(self, f'{field}_m2') + delta * (value - mean))
+
+    def remove_group(self, count, hits_count_mean, hits_count_var, hits_endpoints_mean, hits_endpoints_var):
+        """
+        Remove a group of snapshots, given its size, means and population variances (inverse of the parallel algorithm).
+        """
+        remaining = self.count - count
+        if remaining <= 0:
+            self.reset()
+            return
+        for field, group_mean, group_var in (
+            ('hits_count', hits_count_mean, hits_count_var),
+            ('hits_endpoints', hits_endpoints_mean, hits_endpoints_var)
+        ):
+            mean = (self.count * getattr(self, f'{field}_mean') - count * group_mean) / remaining
+            delta = group_mean - mean
+            m2 = getattr(self, f'{field}_m2') - group_var * count - delta ** 2 * count * remaining / self.count
+            setattr(self, f'{field}_mean', mean)
+            setattr(self, f'{field}_m2', max(m2, 0))
+        self.count = remaining
+
+    def zscore(self, field, value):
+        """
+        zscore of a value for the given field (hits_count or hits_endpoints), against the population of snapshots.
+        Returns -9999 if the zscore can't be computed (no snapshot or standard deviation is null).
+        """
+        if self.count == 0:
+            return -9999
+        variance = getattr(self, f'{field}_m2') / self.count
+        # rounding errors may leave a tiny variance when all values are equal
+        if variance < 1e-9:
+            return -9999
+        return (value - getattr(self, f'{field}_mean')) / variance ** 0.5
+
+    class Meta:
+        verbose_name_plural = "Analytic stats"
+
+class AnalyticSparkline(models.Model):
+    # Daily values of the last DAYS days (oldest first, None for days without snapshot), read by the sparklines of the lists
+    DAYS = 20
+    analytic = models.OneToOneField(Analytic, on_delete=models.CASCADE, primary_key=True)
+    end_date = models.DateField(blank=True, null=True, help_text="Date of the last value of the series")
+    hits_count = models.JSONField(default=list, blank=True)
+    hits_endpoints = models.JSONField(default=list, blank=True)
+    runtime = models.JSONField(default=list, blank=True)
+
+    def __str__(self):
+        return self.analytic.name
+
+    def shift(self, end_date):
+        """
+        Move the end of the series forward to end_date (oldest values are dropped).
+        """
+        if self.end_date is None:
+            self.end_date = end_date
+            for field in ('hits_count', 'hits_endpoints', 'runtime'):
+                setattr(self, field, [None] * self.DAYS)
+            return
+        offset = (end_date - self.end_date).days
+        if offset <= 0:
+            return
+        for field in ('hits_count', 'hits_endpoints', 'runtime'):
+            setattr(self, field, (getattr(self, field) + [None] * offset)[-self.DAYS:])
+        self.end_date = end_date
+
+    def add(self, date, hits_count, hits_endpoints, runtime):
+        """
+        Set the values of a snapshot (ignored if the snapshot is older than the series).
+        """
+        if self.end_date is None or date > self.end_date:
+            self.shift(date)
+        index = self.DAYS - 1 - (self.end_date - date).days
+        if index < 0:
+            return
+        self.hits_count[index] = hits_count
+        self.hits_endpoints[index] = hits_endpoints
+        self.runtime[index] = round(runtime, 3)
+
+    def series(self, field, end_date):
+        """
+        Values of a field (hits_count, hits_endpoints or runtime) for the DAYS days until end_date,
+        days without snapshot are skipped.
+        """
+        if self.end_date is None:
+            return []
+        offset = (end_date - self.end_date).days
+        values = getattr(self, field)[max(offset, 0):max(self.DAYS + min(offset, 0), 0)]
+        return [value for value in values if value is not None]
+
 class Campaign(models.Model):
     name = models.CharField(max_length=250, unique=True)
     description = models.TextField(blank=True)
@@ -227,6 +344,7 @@ class Campaign(models.Model):
     nb_queries = models.IntegerField(default=0, help_text="Number of TH analytics targeted in this campaign")
     nb_analytics = models.IntegerField(default=0, help_text="Total number of TH analytics (even if not run in this campaign)")
     nb_endpoints = models.IntegerField(default=0, help_text="Total number of unique endpoints detected in this campaign")
+    predicted_duration = models.FloatField(blank=True, null=True, help_text="Predicted duration of the campaign (in seconds), from the runtime history of the analytics")
     
     def __str__(self):
         return self.name
@@ -258,20 +376,70 @@ class Snapshot(models.Model):
     def __str__(self):
         return '{} - {}'.format(self.date, self.analytic.name)
 
+    class Meta:
+        indexes = [
+            # trend, sparklines, stats regeneration and retention (snapshots of an analytic over a date range)
+            models.Index(fields=['analytic', 'date']),
+            # campaign results and resumed campaigns (snapshots of a campaign, per analytic)
+            models.Index(fields=['campaign', 'analytic']),
+            # dashboards (analytics matching on a given day)
+            models.Index(fields=['date', 'hits_count']),
+        ]
+
+class Host(models.Model):
+    hostname = models.CharField(max_length=253, unique=True)
+    site = models.CharField(max_length=253, blank=True, help_text="Site of the host in its most recent snapshot")
+    first_seen = models.DateField(help_text="Date of the oldest snapshot matching the host")
+    last_seen = models.DateField(help_text="Date of the most recent snapshot matching the host")
+
+    def __str__(self):
+        return self.hostname
+
 class Endpoint(models.Model):
-    hostname = models.CharField(max_length=253)
+    host = models.ForeignKey(Host, on_delete=models.CASCADE, null=True)
+    # Deprecated: replaced by the host field (emptied by the upgrade.dev_327 script, removed in a future release)
+    hostname = models.CharField(max_length=253, blank=True)
     site = models.CharField(max_length=253, blank=True)
     snapshot = models.ForeignKey(Snapshot, on_delete=models.CASCADE)
     storylineid = models.CharField(max_length=255, blank=True)
     
     def __str__(self):
-        return '{} - {} - {}'.format(self.snapshot.date, self.hostname, self.snapshot.analytic.name)
+        return '{} - {} - {}'.format(self.snapshot.date, self.host or self.hostname, self.snapshot.analytic.name)
+
+    class Meta:
+        indexes = [
+            # reports and dashboards (endpoints of a campaign, grouped by host)
+            models.Index(fields=['snapshot', 'host']),
+            # timeline (snapshots of a host)
+            models.Index(fields=['host', 'snapshot']),
+        ]
+
+class HostScore(models.Model):
+    # Rollup of the endpoints of a campaign per host (see qm.results.rebuild_host_scores), read by the reports and dashboards
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE)
+    host = models.ForeignKey(Host, on_delete=models.CASCADE)
+    site = models.CharField(max_length=253, blank=True, help_text="Site of the host when the scores were computed")
+    total_weighted_score = models.FloatField(default=0, help_text="Sum of the weighted relevance of the analytics matching the host in the campaign")
+    analytic_count = models.IntegerField(default=0, help_text="Number of analytics matching the host in the campaign")
+
+    def __str__(self):
+        return f'{self.campaign.name} - {self.host.hostname}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['campaign', 'host'], name='unique_campaign_host')
+        ]
+        indexes = [
+            # top hosts of a campaign
+            models.Index(fields=['campaign', '-total_weighted_score']),
+        ]
 
 class TasksStatus(models.Model):
     taskname = models.CharField(max_length=200, unique=True)
     date = models.DateTimeField(auto_now_add=True)
     progress = models.FloatField(default=0)
     taskid = models.CharField(max_length=36, blank=True)
+    groupid = models.CharField(max_length=36, blank=True, help_text="Celery group ID, when the task is split into subtasks")
     started_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, editable=False)
 
     def __str__(self):
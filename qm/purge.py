@@ -0,0 +1,152 @@
+"""
+Purger.
+Deletes snapshots and endpoints in bounded batches of primary keys, each batch in its own transaction, so that the
+tables read by the web interface are never locked for long, and at most one batch of rows is loaded in memory.
+Endpoints have no signal handler and no related object: they are deleted with a single DELETE query per batch
+(fast delete). Snapshots are deleted once their endpoints are gone, so that the cascade collects nothing.
+The running stats of the analytics (AnalyticStats) are updated in the same transaction as the snapshots they describe,
+and the sparklines of the analytics (AnalyticSparkline) and the scores of the hosts (HostScore) of the campaigns
+are rebuilt once their snapshots are deleted.
+
+Purges can be time-boxed and throttled (see the RETENTION_PURGE setting). An interrupted purge is resumed by running
+it again: only the remaining rows are deleted.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+from qm.models import Snapshot, Endpoint, Campaign, Host, AnalyticSparkline
+from qm.results import remove_snapshots_from_stats, rebuild_sparklines, rebuild_host_scores
+
+DB_DATA_RETENTION = settings.DB_DATA_RETENTION
+# Default purge settings if the setting is missing (settings.py not updated yet)
+RETENTION_PURGE = getattr(settings, 'RETENTION_PURGE', {"BATCH_SIZE": 5000, "PAUSE": 0.1, "MAX_DURATION": 1800})
+
+
+class Purge:
+    """
+    Progress of a purge: number of rows deleted, duration, and completion (False if the purge was time-boxed
+    and stopped before the end).
+    """
+    def __init__(self, max_duration=None):
+        self.start = monotonic()
+        self.deadline = self.start + max_duration if max_duration else None
+        self.rows = 0
+        self.complete = True
+
+    def expired(self):
+        if self.deadline is not None and monotonic() > self.deadline:
+            self.complete = False
+        return not self.complete
+
+    @property
+    def duration(self):
+        return monotonic() - self.start
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.duration if self.duration else 0
+
+    def __str__(self):
+        status = 'complete' if self.complete else 'interrupted (time limit reached)'
+        return f"{self.rows} rows deleted in {self.duration:.1f}s ({self.rows_per_second:.0f} rows/s), {status}"
+
+
+def purge_snapshots(snapshots, update_stats=True, purge=None, debug=False):
+    """
+    Delete a set of snapshots and their endpoints, by batches of RETENTION_PURGE['BATCH_SIZE'] rows.
+    :param snapshots: Queryset of Snapshot objects.
+    :param update_stats: If True, the snapshots are removed from the running stats of their analytics.
+        Set to False when all snapshots of an analytic are deleted (stats are reset instead, see qm.results.reset_stats).
+    :param purge: Purge object, to share the time limit and counters between several purges (no time limit if not set).
+    :return: Purge object.
+    """
+    if purge is None:
+        purge = Purge()
+    batch_size = RETENTION_PURGE['BATCH_SIZE']
+    campaign_ids = set()
+    analytic_ids = set()
+    sparkline_start = datetime.today() - timedelta(days=AnalyticSparkline.DAYS)
+
+    while not purge.expired():
+        snapshot_ids = list(snapshots.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not snapshot_ids:
+            break
+        campaign_ids.update(Snapshot.objects.filter(pk__in=snapshot_ids, hits_endpoints__gt=0).values_list('campaign_id', flat=True))
+        analytic_ids.update(Snapshot.objects.filter(pk__in=snapshot_ids, date__gt=sparkline_start).values_list('analytic_id', flat=True))
+
+        # Endpoints first (a snapshot may have up to CAMPAIGN_MAX_HOSTS_THRESHOLD endpoints)
+        while not purge.expired():
+            endpoint_ids = list(Endpoint.objects.filter(snapshot_id__in=snapshot_ids).values_list('pk', flat=True)[:batch_size])
+            if not endpoint_ids:
+                break
+            with transaction.atomic():
+                purge.rows += Endpoint.objects.filter(pk__in=endpoint_ids).delete()[0]
+            sleep(RETENTION_PURGE['PAUSE'])
+        # Time limit reached: snapshots are kept (with their remaining endpoints) for the next purge
+        if not purge.complete:
+            break
+
+        with transaction.atomic():
+            if update_stats:
+                remove_snapshots_from_stats(Snapshot.objects.filter(pk__in=snapshot_ids))
+            purge.rows += Snapshot.objects.filter(pk__in=snapshot_ids).delete()[0]
+        sleep(RETENTION_PURGE['PAUSE'])
+
+        if debug:
+            print(f"*** Purge: {purge}")
+
+    # Sparklines of the analytics that lost recent snapshots
+    if analytic_ids:
+        rebuild_sparklines(list(analytic_ids))
+
+    # Scores of the hosts of the campaigns that lost endpoints (only campaigns that have been closed have scores)
+    for campaign in Campaign.objects.filter(pk__in=campaign_ids, hostscore__isnull=False).distinct():
+        rebuild_host_scores(campaign)
+
+    return purge
+
+def purge_retention(max_duration=None, debug=False):
+    """
+    Delete the campaigns, snapshots and endpoints older than DB_DATA_RETENTION days, and the hosts that have not
+    been seen since then.
+    :param max_duration: Maximum duration of the purge, in seconds (defaults to RETENTION_PURGE['MAX_DURATION'], 0 for no limit).
+        Remaining rows are deleted by the next purge.
+    :return: Purge object.
+    """
+    if max_duration is None:
+        max_duration = RETENTION_PURGE['MAX_DURATION']
+    purge = Purge(max_duration)
+    cutoff = datetime.today() - timedelta(days=DB_DATA_RETENTION)
+
+    # Date of campaign is when the script runs while snapshot date is the day before (detection date).
+    # When stats are regenerated, the campaign date is today, while 1st snapshots are DB_DATA_RETENTION days old.
+    purge_snapshots(
+        Snapshot.objects.filter(Q(campaign__date_start__lt=cutoff) | Q(date__lt=cutoff)),
+        purge=purge,
+        debug=debug
+        )
+    if purge.expired():
+        return purge
+
+    # Old campaigns have no snapshot left (remaining related objects are small, they are deleted by cascade)
+    for campaign in Campaign.objects.filter(date_start__lt=cutoff):
+        campaign.delete()
+        if purge.expired():
+            return purge
+
+    # Hosts that have not been seen during the retention period have no endpoint left
+    # (regular delete, hosts may be referenced by other tables)
+    batch_size = RETENTION_PURGE['BATCH_SIZE']
+    hosts = Host.objects.filter(last_seen__lt=cutoff, endpoint__isnull=True)
+    while not purge.expired():
+        host_ids = list(hosts.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not host_ids:
+            break
+        with transaction.atomic():
+            purge.rows += Host.objects.filter(pk__in=host_ids).delete()[0]
+        sleep(RETENTION_PURGE['PAUSE'])
+
+    return purge
@@ -0,0 +1,336 @@
+"""
+Result writer.
+Persists the result of an analytic query (snapshot, detected endpoints, stats and analytic meta update)
+in a single transaction, with endpoints inserted in bulk. Endpoints are linked to their host (Host dimension),
+which is created on first detection.
+Used by the campaigns and the "regenerate stats" task.
+
+Running statistics of the snapshots (AnalyticStats) are maintained here as well. They must be updated
+whenever snapshots are deleted (see reset_stats and remove_snapshots_from_stats).
+
+Sparklines of the analytics (AnalyticSparkline, values of the last days) are updated with each snapshot,
+and rebuilt when snapshots are deleted (see rebuild_sparklines).
+
+Scores of the hosts per campaign (HostScore) are rolled up from the endpoints when the campaign is closed,
+and rebuilt when snapshots of the campaign are deleted (see rebuild_host_scores). They are read with get_host_scores,
+which computes them from the endpoints while the campaign is not closed.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from datetime import datetime, timedelta
+from django.db.models import Count, Avg, Variance, Sum, F
+from qm.models import Snapshot, Endpoint, Host, AnalyticStats, AnalyticSparkline, HostScore
+from notifications.utils import add_info_notification, add_warning_notification, del_notification_by_uid
+
+CAMPAIGN_MAX_HOSTS_THRESHOLD = settings.CAMPAIGN_MAX_HOSTS_THRESHOLD
+ON_MAXHOSTS_REACHED = settings.ON_MAXHOSTS_REACHED
+
+# Number of endpoints inserted per query
+ENDPOINTS_BATCH_SIZE = 500
+
+
+def save_results(campaign, analytic, snapshot_date, runtime, data, score=True, debug=False):
+    """
+    Save the result of an analytic query.
+    The snapshot is created with its stats (hits, zscores, anomaly alerts), detected endpoints are inserted in bulk,
+    and the analytic meta is updated (last time seen, max hosts counter). Everything is committed in one transaction.
+    :param campaign: Campaign object.
+    :param analytic: Analytic object (analyticmeta should be preloaded).
+    :param snapshot_date: Date of the snapshot (detection date).
+    :param runtime: Runtime of the query, in seconds.
+    :param data: Result of the connector "query" function (list of [endpoint name, site name, number of events, storylineIDs]).
+    :param score: If False, zscores and anomaly alerts are not computed (campaigns score all snapshots at once when complete, see qm.scoring).
+    :return: Snapshot object.
+    """
+    if debug:
+        print(f'***DATA: {data}')
+        if len(data) == 0:
+            print('NO DATA!')
+
+    # campaigns pass a datetime (day before the campaign), compared below with the date fields of the hosts
+    if isinstance(snapshot_date, datetime):
+        snapshot_date = snapshot_date.date()
+
+    hits_endpoints = len(data)
+    hits_count = sum(int(float(i[2])) for i in data)
+
+    if debug:
+        print(f"*** HITS_COUNT = {hits_count}")
+        print(f"*** HITS_ENDPOINTS = {hits_endpoints}")
+
+    delete_stats = False
+    with transaction.atomic():
+
+        # Running stats of the analytic are updated with the new snapshot
+        analytic_stats, created = AnalyticStats.objects.select_for_update().get_or_create(analytic=analytic)
+        analytic_stats.add(hits_count, hits_endpoints)
+        analytic_stats.save()
+
+        # Anomaly detection: zscores are computed against all snapshots available in DB (including the new one)
+        zscore_count = zscore_endpoints = 0
+        anomaly_alert_count = anomaly_alert_endpoints = False
+        if score:
+            zscore_count = analytic_stats.zscore('hits_count', hits_count)
+            anomaly_alert_count = zscore_count > analytic.anomaly_threshold_count
+            zscore_endpoints = analytic_stats.zscore('hits_endpoints', hits_endpoints)
+            anomaly_alert_endpoints = zscore_endpoints > analytic.anomaly_threshold_endpoints
+
+            if debug:
+                print("snapshot.zscore_count = {}".format(zscore_count))
+                print("snapshot.zscore_endpoints = {}".format(zscore_endpoints))
+                print("snapshot.anomaly_alert_count = {}".format(anomaly_alert_count))
+                print("snapshot.anomaly_alert_endpoints = {}".format(anomaly_alert_endpoints))
+
+        snapshot = Snapshot.objects.create(
+            campaign=campaign,
+            analytic=analytic,
+            date=snapshot_date,
+            runtime=runtime,
+            hits_count=hits_count,
+            hits_endpoints=hits_endpoints,
+            zscore_count=zscore_count,
+            zscore_endpoints=zscore_endpoints,
+            anomaly_alert_count=anomaly_alert_count,
+            anomaly_alert_endpoints=anomaly_alert_endpoints
+            )
+
+        # Sparklines of the analytic
+        sparkline, created = AnalyticSparkline.objects.select_for_update().get_or_create(analytic=analytic)
+        sparkline.add(snapshot_date, hits_count, hits_endpoints, runtime)
+        sparkline.save()
+
+        # Detected endpoints, linked to the snapshot and to their host
+        # The storylineid field has 255 chars max
+        host_ids = get_host_ids(data, snapshot_date)
+        Endpoint.objects.bulk_create(
+            [
+                Endpoint(
+                    host_id=host_ids[i[0].lower()],
+                    snapshot=snapshot,
+                    storylineid=i[3][1:][:-1] if len(i[3]) < 255 else ''
+                )
+                for i in data
+            ],
+            batch_size=ENDPOINTS_BATCH_SIZE
+            )
+
+        if debug:
+            print("Snapshot created")
+
+        # there are results, we can update the last_time_seen field of the analytic
+        if hits_endpoints != 0:
+            analytic.analyticmeta.last_time_seen = snapshot_date
+
+        # When the max_hosts threshold is reached (by default 1000)
+        if hits_endpoints >= CAMPAIGN_MAX_HOSTS_THRESHOLD:
+            # Send notification
+            del_notification_by_uid(f"max_number_hosts_reached_{datetime.now().strftime('%Y%m%d')}_{analytic.id}")
+            add_info_notification(f"Max number of hosts reached for analytic {analytic.name}", uid=f"max_number_hosts_reached_{datetime.now().strftime('%Y%m%d')}_{analytic.id}")
+            # Update the maxhost counter if reached
+            analytic.analyticmeta.maxhosts_count += 1
+            # if threshold is reached
+            if analytic.analyticmeta.maxhosts_count >= ON_MAXHOSTS_REACHED['THRESHOLD']:
+                # notification
+                add_warning_notification(f"Max hosts threshold reached for analytic {analytic.name}")
+                # If DISABLE_RUN_DAILY is set and run_daily_lock is not set, we disable the run_daily flag for the analytic
+                if ON_MAXHOSTS_REACHED['DISABLE_RUN_DAILY'] and not analytic.run_daily_lock:
+                    analytic.run_daily = False
+                    analytic.status = 'PENDING'
+                # If DELETE_STATS is set and run_daily_lock is not set, we delete all stats for the analytic
+                # (once the transaction is committed, by batches, see qm.purge)
+                if ON_MAXHOSTS_REACHED['DELETE_STATS'] and not analytic.run_daily_lock:
+                    delete_stats = True
+            # we update the analytic (flags updated)
+            analytic.save()
+            if debug:
+                print("Max hosts threshold reached. Counter updated")
+
+        if hits_endpoints != 0:
+            analytic.analyticmeta.save(update_fields=['last_time_seen', 'maxhosts_count'])
+
+    if delete_stats:
+        # imported here, qm.purge depends on this module
+        from qm.purge import purge_snapshots
+        purge_snapshots(Snapshot.objects.filter(analytic=analytic), update_stats=False, debug=debug)
+        reset_stats(analytic)
+
+    return snapshot
+
+def get_host_ids(data, snapshot_date):
+    """
+    Get the hosts of the endpoints of a query result, creating the missing ones in bulk.
+    First/last seen dates of the hosts are updated with the snapshot date, and the site of a host is the one
+    of its most recent snapshot.
+    Hostnames are case insensitive (unique under the collation of the database): endpoints whose names only differ
+    by case are linked to the same host, whatever the spelling of the host in DB.
+    :param data: Result of the connector "query" function (list of [endpoint name, site name, number of events, storylineIDs]).
+    :param snapshot_date: Date of the snapshot (detection date).
+    :return: Dictionary {lowercase hostname: host_id}.
+    """
+    # {lowercase hostname: (hostname, site)}, the first spelling of a hostname is used to create the host
+    names = {}
+    for i in data:
+        names.setdefault(i[0].lower(), (i[0], i[1]))
+    hostnames = list({i[0] for i in data})
+    hosts = {}
+    for start in range(0, len(hostnames), ENDPOINTS_BATCH_SIZE):
+        hosts.update({h.hostname.lower(): h for h in Host.objects.filter(hostname__in=hostnames[start:start+ENDPOINTS_BATCH_SIZE])})
+
+    missing = [hostname for key, (hostname, site) in names.items() if key not in hosts]
+    if missing:
+        # conflicts are ignored, as hosts may be created concurrently by other workers (distributed campaigns)
+        Host.objects.bulk_create(
+            [Host(hostname=hostname, site=names[hostname.lower()][1], first_seen=snapshot_date, last_seen=snapshot_date) for hostname in missing],
+            batch_size=ENDPOINTS_BATCH_SIZE,
+            ignore_conflicts=True
+            )
+        for start in range(0, len(missing), ENDPOINTS_BATCH_SIZE):
+            hosts.update({h.hostname.lower(): h for h in Host.objects.filter(hostname__in=missing[start:start+ENDPOINTS_BATCH_SIZE])})
+
+    updated = []
+    for hostname, host in hosts.items():
+        changed = False
+        if host.first_seen > snapshot_date:
+            host.first_seen = snapshot_date
+            changed = True
+        if host.last_seen < snapshot_date:
+            host.last_seen = snapshot_date
+            host.site = names[hostname][1]
+            changed = True
+        if changed:
+            updated.append(host)
+    # rows are updated in primary key order, to avoid deadlocks between concurrent workers
+    updated.sort(key=lambda host: host.pk)
+    Host.objects.bulk_update(updated, ['site', 'first_seen', 'last_seen'], batch_size=ENDPOINTS_BATCH_SIZE)
+
+    return {hostname: host.pk for hostname, host in hosts.items()}
+
+def max_hosts_threshold_reached(analytic):
+    """
+    Check if the analytic has reached the max hosts threshold too many times (ON_MAXHOSTS_REACHED['THRESHOLD']).
+    :param analytic: Analytic object (analyticmeta should be preloaded).
+    :return: True if the threshold is reached, False otherwise.
+    """
+    return analytic.analyticmeta.maxhosts_count >= ON_MAXHOSTS_REACHED['THRESHOLD']
+
+def reset_stats(analytic):
+    """
+    Reset the running stats of an analytic. To be called when all snapshots of the analytic are deleted.
+    :param analytic: Analytic object.
+    """
+    AnalyticStats.objects.filter(analytic=analytic).delete()
+
+def remove_snapshots_from_stats(snapshots):
+    """
+    Remove a set of snapshots from the running stats of their analytics. To be called before the snapshots are deleted.
+    :param snapshots: Queryset of Snapshot objects.
+    """
+    groups = snapshots.values('analytic').annotate(
+        count=Count('pk'),
+        hits_count_mean=Avg('hits_count'),
+        hits_count_var=Variance('hits_count'),
+        hits_endpoints_mean=Avg('hits_endpoints'),
+        hits_endpoints_var=Variance('hits_endpoints')
+        ).order_by()
+    with transaction.atomic():
+        for group in groups:
+            try:
+                analytic_stats = AnalyticStats.objects.select_for_update().get(analytic_id=group['analytic'])
+            except AnalyticStats.DoesNotExist:
+                continue
+            analytic_stats.remove_group(
+                group['count'],
+                group['hits_count_mean'],
+                group['hits_count_var'],
+                group['hits_endpoints_mean'],
+                group['hits_endpoints_var']
+                )
+            analytic_stats.save()
+
+def rebuild_stats(analytic):
+    """
+    Rebuild the running stats of an analytic from the snapshots available in DB.
+    :param analytic: Analytic object.
+    :return: AnalyticStats object.
+    """
+    group = Snapshot.objects.filter(analytic=analytic).aggregate(
+        count=Count('pk'),
+        hits_count_mean=Avg('hits_count'),
+        hits_count_var=Variance('hits_count'),
+        hits_endpoints_mean=Avg('hits_endpoints'),
+        hits_endpoints_var=Variance('hits_endpoints')
+        )
+    analytic_stats, created = AnalyticStats.objects.get_or_create(analytic=analytic)
+    analytic_stats.reset()
+    if group['count']:
+        analytic_stats.count = group['count']
+        analytic_stats.hits_count_mean = group['hits_count_mean']
+        analytic_stats.hits_count_m2 = group['hits_count_var'] * group['count']
+        analytic_stats.hits_endpoints_mean = group['hits_endpoints_mean']
+        analytic_stats.hits_endpoints_m2 = group['hits_endpoints_var'] * group['count']
+    analytic_stats.save()
+    return analytic_stats
+
+def rebuild_sparklines(analytic_ids):
+    """
+    Rebuild the sparklines of a set of analytics from their snapshots of the last AnalyticSparkline.DAYS days.
+    :param analytic_ids: List of analytic IDs.
+    """
+    end_date = datetime.today().date()
+    sparklines = {analytic_id: AnalyticSparkline(analytic_id=analytic_id) for analytic_id in analytic_ids}
+    for sparkline in sparklines.values():
+        sparkline.shift(end_date)
+    snapshots = Snapshot.objects.filter(
+        analytic_id__in=analytic_ids,
+        date__gt=end_date-timedelta(days=AnalyticSparkline.DAYS)
+        ).values_list('analytic_id', 'date', 'hits_count', 'hits_endpoints', 'runtime')
+    for analytic_id, date, hits_count, hits_endpoints, runtime in snapshots:
+        sparklines[analytic_id].add(date, hits_count, hits_endpoints, runtime)
+    with transaction.atomic():
+        AnalyticSparkline.objects.filter(analytic_id__in=analytic_ids).delete()
+        AnalyticSparkline.objects.bulk_create(sparklines.values(), batch_size=ENDPOINTS_BATCH_SIZE)
+
+def get_host_scores(campaign):
+    """
+    Get the scores of the hosts of a campaign, highest first. Scores are read from HostScore once the campaign
+    is closed, and computed from the endpoints collected so far otherwise (campaign running, or interrupted).
+    :param campaign: Campaign object.
+    :return: Queryset of dictionaries (host, host__hostname, site, total_weighted_score).
+    """
+    if HostScore.objects.filter(campaign=campaign).exists():
+        return HostScore.objects.filter(campaign=campaign).values(
+            'host', 'host__hostname', 'site', 'total_weighted_score'
+            ).order_by('-total_weighted_score')
+    return Endpoint.objects.filter(snapshot__campaign=campaign, host__isnull=False).values(
+        'host', 'host__hostname', site=F('host__site')
+        ).annotate(
+        total_weighted_score=Sum('snapshot__analytic__weighted_relevance')
+        ).order_by('-total_weighted_score')
+
+def rebuild_host_scores(campaign):
+    """
+    Rebuild the scores of the hosts of a campaign (HostScore): sum of the weighted relevance of the analytics
+    matching each host, and number of analytics. To be called when the campaign is closed, and when snapshots
+    of the campaign are deleted.
+    :param campaign: Campaign object.
+    """
+    rows = Endpoint.objects.filter(snapshot__campaign=campaign, host__isnull=False).values('host', 'host__site').annotate(
+        total_weighted_score=Sum('snapshot__analytic__weighted_relevance'),
+        analytic_count=Count('snapshot__analytic', distinct=True)
+        ).order_by()
+    with transaction.atomic():
+        HostScore.objects.filter(campaign=campaign).delete()
+        HostScore.objects.bulk_create(
+            [
+                HostScore(
+                    campaign=campaign,
+                    host_id=row['host'],
+                    site=row['host__site'],
+                    total_weighted_score=row['total_weighted_score'],
+                    analytic_count=row['analytic_count']
+                )
+                for row in rows
+            ],
+            batch_size=ENDPOINTS_BATCH_SIZE
+            )
@@ -0,0 +1,95 @@
+"""
+Campaign scheduler.
+Orders the analytics of a campaign by predicted runtime (trailing median of the runtime of their last snapshots),
+so that the longest queries of each connector are started first (longest job first), which minimizes the duration
+of the campaign when queries run in parallel. Analytics without history are interleaved with the others.
+"""
+
+from collections import defaultdict
+from statistics import median
+import heapq
+from qm.models import Snapshot
+from connectors.utils import get_max_concurrent_queries
+from qm.engine import all_connectors
+
+# Number of snapshots used to predict the runtime of an analytic
+RUNTIME_HISTORY = 7
+
+
+def get_predicted_runtimes(analytics):
+    """
+    Predict the runtime of analytics, from the median runtime of their last RUNTIME_HISTORY snapshots.
+    :param analytics: List (or queryset) of Analytic objects.
+    :return: Dictionary {analytic_id: predicted runtime in seconds}. Analytics without snapshot are not included.
+    """
+    runtimes = defaultdict(list)
+    # results served from the query cache have a null runtime and are ignored
+    history = Snapshot.objects.filter(
+        analytic__in=analytics,
+        runtime__gt=0
+        ).order_by('analytic_id', '-date').values_list('analytic_id', 'runtime')
+    for analytic_id, runtime in history:
+        if len(runtimes[analytic_id]) < RUNTIME_HISTORY:
+            runtimes[analytic_id].append(runtime)
+    return {analytic_id: median(values) for analytic_id, values in runtimes.items()}
+
+def order_analytics(analytics, runtimes):
+    """
+    Order analytics by predicted runtime, longest first. Analytics without prediction are spread evenly in the list.
+    :param analytics: List (or queryset) of Analytic objects.
+    :param runtimes: Dictionary {analytic_id: predicted runtime}, as returned by get_predicted_runtimes.
+    :return: Ordered list of Analytic objects.
+    """
+    known = sorted([a for a in analytics if a.pk in runtimes], key=lambda a: runtimes[a.pk], reverse=True)
+    unknown = [a for a in analytics if a.pk not in runtimes]
+    # each analytic is given its relative position in its own list, and both lists are merged on this position
+    positions = [((i+1) / (len(known)+1), 0, a) for i, a in enumerate(known)]
+    positions += [((i+1) / (len(unknown)+1), 1, a) for i, a in enumerate(unknown)]
+    return [a for position, rank, a in sorted(positions, key=lambda p: (p[0], p[1]))]
+
+def get_campaign_concurrency(connector_name):
+    """
+    Get the number of queries of a connector running in parallel during campaigns: the "get_campaign_concurrency"
+    function of the connector if any (e.g., batches run one after the other), MAX_CONCURRENT_QUERIES otherwise.
+    :param connector_name: Name of the connector.
+    :return: Integer (>= 1).
+    """
+    connector = all_connectors.get(connector_name)
+    if hasattr(connector, 'get_campaign_concurrency'):
+        return max(1, connector.get_campaign_concurrency())
+    return get_max_concurrent_queries(connector_name)
+
+def predict_makespan(analytics, runtimes):
+    """
+    Predict the duration of a campaign, by simulating the queues of the connectors (one slot per query running
+    in parallel, see get_campaign_concurrency, queries started in the order of the list). Connectors run in parallel.
+    Analytics without prediction are given the median predicted runtime of their connector.
+    :param analytics: Ordered list of Analytic objects (connector should be preloaded).
+    :param runtimes: Dictionary {analytic_id: predicted runtime}, as returned by get_predicted_runtimes.
+    :return: Predicted duration in seconds.
+    """
+    analytics_by_connector = defaultdict(list)
+    for analytic in analytics:
+        analytics_by_connector[analytic.connector.name].append(analytic)
+
+    makespan = 0
+    for connector_name, connector_analytics in analytics_by_connector.items():
+        known = [runtimes[a.pk] for a in connector_analytics if a.pk in runtimes]
+        default = median(known) if known else 0
+        # end time of the query running in each slot
+        slots = [0] * get_campaign_concurrency(connector_name)
+        for analytic in connector_analytics:
+            heapq.heappush(slots, heapq.heappop(slots) + runtimes.get(analytic.pk, default))
+        makespan = max(makespan, max(slots))
+    return makespan
+
+def schedule_analytics(analytics):
+    """
+    Order the analytics of a campaign (longest job first) and predict the duration of the campaign.
+    :param analytics: List (or queryset) of Analytic objects.
+    :return: Tuple (ordered list of Analytic objects, predicted duration in seconds).
+    """
+    analytics = list(analytics)
+    runtimes = get_predicted_runtimes(analytics)
+    ordered = order_analytics(analytics, runtimes)
+    return ordered, predict_makespan(ordered, runtimes)
@@ -0,0 +1,78 @@
+"""
+Anomaly scoring.
+Computes the zscores and anomaly alerts of all snapshots of a campaign in a single vectorized pass.
+Stats of all analytics of the campaign over the retention period are loaded with one query into a 2D matrix
+(one row per analytic, one column per day), and zscores are computed for all analytics at once.
+"""
+
+from django.conf import settings
+from datetime import timedelta
+import numpy as np
+from scipy import stats
+from qm.models import Snapshot
+
+DB_DATA_RETENTION = settings.DB_DATA_RETENTION
+
+
+def score_campaign(campaign, debug=False):
+    """
+    Compute zscores and anomaly alerts of all snapshots of a campaign, and save them.
+    Each snapshot is scored against the snapshots of the same analytic over the DB_DATA_RETENTION days
+    ending at the snapshot date. Can be run again at any time (e.g., when anomaly thresholds change).
+    :param campaign: Campaign object.
+    :return: Number of snapshots scored.
+    """
+    snapshots = list(Snapshot.objects.filter(campaign=campaign).select_related('analytic'))
+    if not snapshots:
+        return 0
+
+    first_date = min(s.date for s in snapshots) - timedelta(days=DB_DATA_RETENTION-1)
+    last_date = max(s.date for s in snapshots)
+    nb_days = (last_date - first_date).days + 1
+
+    # One row per analytic, one column per day. Days without snapshot are NaN (ignored)
+    rows = {analytic_id: i for i, analytic_id in enumerate(sorted({s.analytic_id for s in snapshots}))}
+    hits_count = np.full((len(rows), nb_days), np.nan)
+    hits_endpoints = np.full((len(rows), nb_days), np.nan)
+
+    history = Snapshot.objects.filter(
+        analytic_id__in=rows.keys(),
+        date__range=(first_date, last_date)
+        ).order_by('pk').values_list('analytic_id', 'date', 'hits_count', 'hits_endpoints')
+    for analytic_id, date, count, endpoints in history:
+        hits_count[rows[analytic_id], (date - first_date).days] = count
+        hits_endpoints[rows[analytic_id], (date - first_date).days] = endpoints
+
+    # Snapshots of the campaign take precedence over other snapshots of the same day
+    for snapshot in snapshots:
+        hits_count[rows[snapshot.analytic_id], (snapshot.date - first_date).days] = snapshot.hits_count
+        hits_endpoints[rows[snapshot.analytic_id], (snapshot.date - first_date).days] = snapshot.hits_endpoints
+
+    # zscores are computed once per distinct snapshot date (only one for daily campaigns)
+    zscores = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for date in {s.date for s in snapshots}:
+            end = (date - first_date).days + 1
+            window = slice(max(0, end - DB_DATA_RETENTION), end)
+            zscores[date] = (
+                stats.zscore(hits_count[:, window], axis=1, nan_policy='omit')[:, -1],
+                stats.zscore(hits_endpoints[:, window], axis=1, nan_policy='omit')[:, -1]
+            )
+
+    for snapshot in snapshots:
+        zscore_count = zscores[snapshot.date][0][rows[snapshot.analytic_id]]
+        zscore_endpoints = zscores[snapshot.date][1][rows[snapshot.analytic_id]]
+        snapshot.zscore_count = -9999 if np.isnan(zscore_count) else float(zscore_count)
+        snapshot.zscore_endpoints = -9999 if np.isnan(zscore_endpoints) else float(zscore_endpoints)
+        snapshot.anomaly_alert_count = snapshot.zscore_count > snapshot.analytic.anomaly_threshold_count
+        snapshot.anomaly_alert_endpoints = snapshot.zscore_endpoints > snapshot.analytic.anomaly_threshold_endpoints
+        if debug:
+            print(f"{snapshot.analytic.name}: zscore_count={snapshot.zscore_count}, zscore_endpoints={snapshot.zscore_endpoints}")
+
+    Snapshot.objects.bulk_update(
+        snapshots,
+        ['zscore_count', 'zscore_endpoints', 'anomaly_alert_count', 'anomaly_alert_endpoints'],
+        batch_size=500
+        )
+
+    return len(snapshots)
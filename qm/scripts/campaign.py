@@ -1,19 +1,53 @@
-from django.conf import settings
-from datetime import datetime, timedelta
-from qm.models import Snapshot, Campaign
-from qm.utils import run_campaign
-
-DB_DATA_RETENTION = settings.DB_DATA_RETENTION
+from datetime import datetime
+from qm.models import TasksStatus
+from qm.utils import run_campaign, get_campaign_name
+from qm.tasks import start_campaign_shards
+from qm.purge import purge_retention
+from connectors.utils import evict_query_cache
+from notifications.utils import add_warning_notification
 
 DEBUG = False
 
-def run():
+def run_distributed(campaigndate, resume=False):
+    """
+    Run the campaign over the Celery workers (see CAMPAIGN_SHARD_SIZE) and wait until it is complete.
+    """
+    TasksStatus.objects.get_or_create(taskname=get_campaign_name(campaigndate))
+    result = start_campaign_shards(campaigndate, resume=resume)
+    if result:
+        result.get(propagate=False)
+
+def run(*args):
+    """
+    Run the daily campaign.
+    Can be called with "--script-args resume [YYYY-MM-DD]" to resume a campaign (today's campaign if no date is provided):
+    only analytics that are missing or failed in the campaign are run.
+    With the "celery" argument, the campaign is distributed over the Celery workers.
+    """
+
+    celery = 'celery' in args
+
+    if 'resume' in args:
+        dates = [arg for arg in args if arg not in ('resume', 'celery')]
+        campaigndate = datetime.strptime(dates[0], "%Y-%m-%d") if dates else datetime.now()
+        if celery:
+            run_distributed(campaigndate, resume=True)
+        else:
+            run_campaign(campaigndate=campaigndate, debug=DEBUG, resume=True)
+        return
+
+    # Cleanup all campaigns, snapshots, endpoints and hosts older than DB_DATA_RETENTION (90 days by default).
+    # Rows are deleted by batches, within RETENTION_PURGE['MAX_DURATION']. Remaining rows are deleted by the next run.
+    purge = purge_retention(debug=DEBUG)
+    print(f"Retention purge: {purge}")
+    if not purge.complete:
+        add_warning_notification(f"Retention purge interrupted after {purge.duration:.0f}s ({purge.rows} rows deleted), will resume on next campaign")
 
-    # Cleanup all campaigns older than DB_DATA_RETENTION (90 days by default). Will automatically cascade delete snapshots and endpoints
-    # Date of campaign is when the script runs (today) while snapshot date is the day before (detection date)
-    Campaign.objects.filter(date_start__lt=datetime.today()-timedelta(days=DB_DATA_RETENTION)).delete()
-    # Make sure remaining old Snapshots/Endpoints are also deleted (when regen stats is used, campaign date is today, while 1st stats are 3 months old)
-    Snapshot.objects.filter(date__lt=datetime.today()-timedelta(days=DB_DATA_RETENTION)).delete()
+    # Evict old entries of the query cache
+    evict_query_cache()
 
     # Run campaign by calling the run_campaign function (no date provided will default to today)
-    run_campaign(debug=DEBUG)
+    if celery:
+        run_distributed(datetime.now())
+    else:
+        run_campaign(debug=DEBUG)
@@ -0,0 +1,129 @@
+"""
+Dev #327 - Campaign engine and database performance
+This script upgrades an existing installation to the new campaign engine and data model. It can be interrupted and run again.
+- Connector settings: adds the MAX_CONCURRENT_QUERIES, MAX_REQUESTS_PER_SECOND and CIRCUIT_BREAKER_THRESHOLD keys to the
+  connectors used by campaigns (analytics domain), and the QUERY_TIMEOUT key to the SentinelOne connector.
+- Host dimension: endpoints are now linked to a Host object (hostname, site, first/last seen) instead of storing the
+  hostname and site on every row. Hosts are created from existing endpoints, endpoints are linked to them, and the
+  deprecated hostname and site fields of the endpoints are emptied (run optimize_db.sh afterwards to reclaim the space).
+- Host scores: scores of the hosts per campaign (HostScore) are computed for the existing campaigns.
+- Analytic stats and sparklines: running statistics (AnalyticStats) and sparklines (AnalyticSparkline) of all analytics
+  are built from existing snapshots.
+
+To run:
+$ source /data/venv/bin/activate
+(venv) $ cd /data/deephunter/
+(venv) $ python manage.py runscript upgrade.dev_327
+"""
+
+from time import perf_counter
+from django.core.management import call_command
+from django.db.models import Min, Max, OuterRef, Subquery
+from connectors.models import Connector, ConnectorConf
+from qm.models import Campaign, Endpoint, Host
+from qm.results import rebuild_host_scores
+
+# Number of endpoints linked to their host per query
+BATCH_SIZE = 10000
+
+CONNECTOR_SETTINGS = {
+    'sentinelone': ['MAX_CONCURRENT_QUERIES', 'QUERY_TIMEOUT', 'MAX_REQUESTS_PER_SECOND', 'CIRCUIT_BREAKER_THRESHOLD'],
+    'microsoftdefender': ['MAX_CONCURRENT_QUERIES', 'MAX_REQUESTS_PER_SECOND', 'CIRCUIT_BREAKER_THRESHOLD'],
+    'microsoftsentinel': ['MAX_CONCURRENT_QUERIES', 'MAX_REQUESTS_PER_SECOND', 'CIRCUIT_BREAKER_THRESHOLD'],
+}
+
+SETTINGS = {
+    'MAX_CONCURRENT_QUERIES': {
+        'value': '3',
+        'description': 'Maximum number of queries sent in parallel during a campaign (1 to run queries sequentially).',
+        'fieldtype': 'int',
+    },
+    'QUERY_TIMEOUT': {
+        'value': '1800',
+        'description': 'PowerQueries still running after this number of seconds are cancelled (0 for no timeout).',
+        'fieldtype': 'int',
+    },
+    'MAX_REQUESTS_PER_SECOND': {
+        'value': '10',
+        'description': 'Maximum number of API requests sent per second to the connector (0 for no limit).',
+        'fieldtype': 'float',
+    },
+    'CIRCUIT_BREAKER_THRESHOLD': {
+        'value': '5',
+        'description': 'Number of consecutive connection failures or server errors after which the remaining analytics of the connector are skipped during the campaign (0 to disable).',
+        'fieldtype': 'int',
+    },
+}
+
+
+def add_connector_settings():
+    for connector_name, keys in CONNECTOR_SETTINGS.items():
+        try:
+            connector = Connector.objects.get(name=connector_name)
+        except Connector.DoesNotExist:
+            print(f"Connector not found: {connector_name}")
+            continue
+
+        for key in keys:
+            connector_conf, created = ConnectorConf.objects.get_or_create(
+                connector=connector,
+                key=key,
+                defaults=SETTINGS[key]
+            )
+            if created:
+                print(f"Added connector key: {connector_name}:{key} ({connector_conf.value})")
+            else:
+                print(f"Connector key already exists: {connector_name}:{key}")
+
+def link_endpoints_to_hosts():
+    # Create hosts from the endpoints that are not linked yet
+    # (the site of the host is not necessarily the one of its most recent snapshot, it is updated by the next campaigns)
+    rows = Endpoint.objects.filter(host__isnull=True).values('hostname').annotate(
+        site=Max('site'),
+        first_seen=Min('snapshot__date'),
+        last_seen=Max('snapshot__date')
+        ).order_by()
+    # hostnames are case insensitive (unique under the collation of the database)
+    hosts = {host.hostname.lower(): host for host in Host.objects.all()}
+    created = []
+    updated = []
+    for row in rows:
+        host = hosts.get(row['hostname'].lower())
+        if host is None:
+            hosts[row['hostname'].lower()] = Host(**row)
+            created.append(hosts[row['hostname'].lower()])
+        elif row['first_seen'] < host.first_seen or row['last_seen'] > host.last_seen:
+            host.first_seen = min(host.first_seen, row['first_seen'])
+            host.last_seen = max(host.last_seen, row['last_seen'])
+            # hosts created by this script are saved below
+            if host.pk is not None and host not in updated:
+                updated.append(host)
+    Host.objects.bulk_create(created, batch_size=1000, ignore_conflicts=True)
+    Host.objects.bulk_update(updated, ['first_seen', 'last_seen'], batch_size=1000)
+    print(f"{len(created)} hosts created, {len(updated)} hosts updated")
+
+    # Link endpoints to their host, by batches of primary keys
+    host_id = Subquery(Host.objects.filter(hostname=OuterRef('hostname')).values('pk')[:1])
+    bounds = Endpoint.objects.filter(host__isnull=True).aggregate(first=Min('pk'), last=Max('pk'))
+    nb_endpoints = 0
+    if bounds['first'] is not None:
+        for first in range(bounds['first'], bounds['last'] + 1, BATCH_SIZE):
+            endpoints = Endpoint.objects.filter(pk__range=(first, first + BATCH_SIZE - 1))
+            nb_endpoints += endpoints.filter(host__isnull=True).update(host_id=host_id)
+            endpoints.filter(host__isnull=False).exclude(hostname='', site='').update(hostname='', site='')
+            print(f"{nb_endpoints} endpoints linked to their host")
+
+def compute_host_scores():
+    # endpoints must be linked to their host (see link_endpoints_to_hosts)
+    for campaign in Campaign.objects.filter(date_end__isnull=False).order_by('date_start'):
+        rebuild_host_scores(campaign)
+        print(f"{campaign.name}: host scores computed")
+
+def run():
+    start = perf_counter()
+    add_connector_settings()
+    link_endpoints_to_hosts()
+    compute_host_scores()
+    # running statistics and sparklines of all analytics
+    call_command('rebuild_analytic_stats')
+    print(f"Done in {perf_counter() - start:.2f}s")
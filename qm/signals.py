@@ -7,7 +7,7 @@ from datetime import datetime, timedelta
 from .models import Analytic, TasksStatus, AnalyticMeta
 from qm.utils import is_update_available, is_mitre_update_available
 from connectors.utils import is_connector_enabled
-from qm.tasks import regenerate_stats
+from qm.tasks import regenerate_stats, rebuild_analytic_host_scores
 from notifications.utils import del_notification_by_uid, add_info_notification, add_error_notification, add_warning_notification
 import time
 
@@ -104,6 +104,10 @@ def pre_save_handler(sender, instance, **kwargs):
             if original_instance.query != instance.query and instance.status == 'PENDING':
                 instance.status = 'DRAFT'
 
+        # Scores of the hosts depend on the weighted relevance of the analytic (confidence x relevance)
+        if original_instance.confidence != instance.confidence or original_instance.relevance != instance.relevance:
+            instance._weighted_relevance_changed = True
+
         # Only apply if "need_to_sync_rule" function returns True (defined in the connector settings)
         if all_connectors.get(instance.connector.name).need_to_sync_rule():
 
@@ -184,9 +188,12 @@ def post_save_handler(sender, instance, created, **kwargs):
             regenerate_analytic_stats(instance)
     else:
         # for updated analytics, we check the flag set by the pre_save handler
-        if getattr(instance, '_query_changed', False):
-            if AUTO_STATS_REGENERATION:
-                regenerate_analytic_stats(instance)
+        regenerated = getattr(instance, '_query_changed', False) and AUTO_STATS_REGENERATION
+        if regenerated:
+            regenerate_analytic_stats(instance)
+        # scores of the hosts are rebuilt in the background (not needed if the snapshots are regenerated)
+        if getattr(instance, '_weighted_relevance_changed', False) and not regenerated:
+            rebuild_analytic_host_scores.delay(instance.id)
 
 
 # This handler is triggered after an "Analytic" object is deleted
@@ -1,16 +1,17 @@
 from django.conf import settings
 from datetime import datetime, timedelta
-import numpy as np
-from scipy import stats
-from math import isnan
-from qm.models import Analytic, Snapshot, Campaign, Endpoint, TasksStatus
+from qm.models import Analytic, Snapshot, Campaign, TasksStatus
 from connectors.models import Connector
-from qm.utils import run_campaign, get_campaign_date
+from qm.utils import run_campaign, open_campaign, run_campaign_analytics, close_campaign
+from qm.results import save_results, max_hosts_threshold_reached, reset_stats, rebuild_host_scores
+from qm.purge import purge_snapshots
+from qm.engine import query_connector
+from connectors.utils import count_cached_results, set_cached_result
 import requests
-from celery import shared_task
+from celery import shared_task, group, chord
 from django.shortcuts import get_object_or_404
 from time import sleep
-from notifications.utils import add_info_notification, add_success_notification, add_warning_notification, del_notification_by_uid
+from notifications.utils import add_info_notification, add_success_notification
 
 # Dynamically import all connectors
 import importlib
@@ -25,7 +26,8 @@ for loader, module_name, is_pkg in pkgutil.iter_modules(plugins.__path__):
 PROXY = settings.PROXY
 DB_DATA_RETENTION = settings.DB_DATA_RETENTION
 CAMPAIGN_MAX_HOSTS_THRESHOLD = settings.CAMPAIGN_MAX_HOSTS_THRESHOLD
-ON_MAXHOSTS_REACHED = settings.ON_MAXHOSTS_REACHED
+# Campaigns are not sharded if the setting is missing (settings.py not updated yet)
+CAMPAIGN_SHARD_SIZE = getattr(settings, 'CAMPAIGN_SHARD_SIZE', 0)
 
 @shared_task()
 def regenerate_stats(analytic_id):
@@ -51,131 +53,58 @@ def regenerate_stats(analytic_id):
     # Get task in TasksStatus object
     celery_status = get_object_or_404(TasksStatus, taskname=analytic.name)
 
-    # Delete all snapshots for this analytic
-    # (related Endpoint object will automatically cascade delete)
-    Snapshot.objects.filter(analytic=analytic).delete()
+    # Delete all snapshots for this analytic and their endpoints (by batches, see qm.purge)
+    purge_snapshots(Snapshot.objects.filter(analytic=analytic), update_stats=False)
+    reset_stats(analytic)
     
+    # If the connector supports it, all days are queried at once, with results grouped by day.
+    # Otherwise (or if the query by day fails), the connector is queried once per day.
+    # If all days are already in the query cache, the cache is used instead.
+    connector = all_connectors.get(analytic.connector.name)
+    range_to = datetime.combine(datetime.now(), datetime.min.time())
+    windows = [
+        ((range_to - timedelta(days=days+1)).isoformat(), (range_to - timedelta(days=days)).isoformat())
+        for days in range(DB_DATA_RETENTION)
+        ]
+    data_by_day = None
+    if hasattr(connector, 'query_by_day') and count_cached_results(analytic, windows) < DB_DATA_RETENTION:
+        start_runtime = datetime.now()
+        range_from = range_to - timedelta(days=DB_DATA_RETENTION)
+        data_by_day = connector.query_by_day(analytic, range_from.isoformat(), range_to.isoformat())
+        # runtime of the query is spread over all snapshots
+        runtime_by_day = (datetime.now()-start_runtime).total_seconds() / DB_DATA_RETENTION
+
     # Rebuild campaigns for last DB_DATA_RETENTION (90 days by default) for the analytic
     for days in reversed(range(DB_DATA_RETENTION)):
         
-        # store current time (used to update snapshot runtime)
-        start_runtime = datetime.now()
-
-        # Call the "query" function of the appropriate connector
-        # (no date range provided, so it will use the last 24 hours by default)
         todate = datetime.combine((datetime.now() - timedelta(days=days)), datetime.min.time())
         fromdate = (todate - timedelta(days=1))
-        data = all_connectors.get(analytic.connector.name).query(analytic, fromdate.isoformat(), todate.isoformat())
 
-        # if error, we exit the for loop
-        if data == "ERROR":
-            break
-
-        # store current time (used to update snapshot runtime)
-        end_runtime = datetime.now()
-
-        # Create snapshot. Necessary to have the object to link the detected assets.
-        # Stats will be updated later to the snaptshot
-        # the date of the snapshot is the day before the campaign (detection date)
-        snapshot = Snapshot(
-            campaign=campaign,
-            analytic=analytic,
-            date=todate - timedelta(days=1),
-            runtime = (end_runtime-start_runtime).total_seconds()
-            )
-        snapshot.save()
-
-        if len(data) != 0:
-
-            # there are results, we can update the last_time_seen field of the analytic
-            analytic.analyticmeta.last_time_seen = snapshot.date
-            analytic.analyticmeta.save()
-
-            hits_endpoints = len(data)
-            hits_count = 0
-            
-            for i in data:
-                
-                # The storylineid field has 255 chars max
-                if len(i[3]) < 255:
-                    storylineid = i[3][1:][:-1]
-                else:
-                    storylineid = ''
-                
-                # update detected endpoints and link it with current snapshot
-                endpoint = Endpoint(
-                    hostname = i[0],
-                    site = i[1],
-                    snapshot = snapshot,
-                    storylineid = storylineid
-                )
-                endpoint.save()
-                # count nb of hits
-                hits_count += int(float(i[2]))
+        if data_by_day is not None:
+            # results are limited to the max hosts threshold, as for daily queries
+            data = data_by_day.get(fromdate.date(), [])[:CAMPAIGN_MAX_HOSTS_THRESHOLD]
+            runtime = runtime_by_day
+            set_cached_result(analytic, fromdate.isoformat(), todate.isoformat(), data)
         else:
-            hits_count = 0
-            hits_endpoints = 0
-        
-        # Now that stats have been collected, snapshot is updated.
-        snapshot.hits_count = hits_count
-        snapshot.hits_endpoints = hits_endpoints
-        snapshot.save()
-        
-        # When the max_hosts threshold is reached (by default 1000)
-        if hits_endpoints >= CAMPAIGN_MAX_HOSTS_THRESHOLD:
-            # Send notification
-            del_notification_by_uid(f"max_number_hosts_reached_{datetime.now().strftime('%Y%m%d')}_{analytic.id}")
-            add_info_notification(f"Max number of hosts reached for analytic {analytic.name}", uid=f"max_number_hosts_reached_{datetime.now().strftime('%Y%m%d')}_{analytic.id}")
-            # Update the maxhost counter if reached
-            analytic.analyticmeta.maxhosts_count += 1
-            # if threshold is reached
-            if analytic.analyticmeta.maxhosts_count >= ON_MAXHOSTS_REACHED['THRESHOLD']:
-                # notification
-                add_warning_notification(f"Max hosts threshold reached for analytic {analytic.name}")
-                # If DISABLE_RUN_DAILY is set and run_daily_lock is not set, we disable the run_daily flag for the analytic
-                if ON_MAXHOSTS_REACHED['DISABLE_RUN_DAILY'] and not analytic.run_daily_lock:
-                    analytic.run_daily = False
-                    analytic.status = 'PENDING'
-                # If DELETE_STATS is set and run_daily_lock is not set, we delete all stats for the analytic
-                if ON_MAXHOSTS_REACHED['DELETE_STATS'] and not analytic.run_daily_lock:
-                    Snapshot.objects.filter(analytic=analytic).delete()
-            # we update the analytic (counter updated, and flags updated)
-            analytic.analyticmeta.save()
-            analytic.save()
-            # if threshold is reached, we exit the for loop
-            if analytic.analyticmeta.maxhosts_count >= ON_MAXHOSTS_REACHED['THRESHOLD']:
+            # store current time (used to update snapshot runtime)
+            start_runtime = datetime.now()
+
+            # Call the "query" function of the appropriate connector (through the query cache)
+            data = query_connector(analytic, fromdate.isoformat(), todate.isoformat())
+
+            # if error, we exit the for loop
+            if data == "ERROR":
                 break
 
-        # Anomaly detection for hits_count (compute zscore against all snapshots available in DB)
-        snapshots = Snapshot.objects.filter(analytic=analytic)
-        a = np.array([c.hits_count for c in snapshots])
-        z = stats.zscore(a)
-        zscore_count = z[-1]
-        if isnan(zscore_count):
-            zscore_count = -9999
-        if zscore_count > analytic.anomaly_threshold_count:
-            anomaly_alert_count = True
-        else:
-            anomaly_alert_count = False
-        
-        # Anomaly detection for hits_endpoints (compute zscore against all snapshots available in DB)
-        a = np.array([c.hits_endpoints for c in snapshots])
-        z = stats.zscore(a)
-        zscore_endpoints = z[-1]
-        if isnan(zscore_endpoints):
-            zscore_endpoints = -9999
-        if zscore_endpoints > analytic.anomaly_threshold_endpoints:
-            anomaly_alert_endpoints = True
-        else:
-            anomaly_alert_endpoints = False
-        
-        # Final update of snpashots with stats for the last snapshot (just created above)            
-        snapshot.zscore_count = zscore_count
-        snapshot.zscore_endpoints = zscore_endpoints
-        snapshot.anomaly_alert_count = anomaly_alert_count
-        snapshot.anomaly_alert_endpoints = anomaly_alert_endpoints
-        snapshot.save()
-        
+            # store current time (used to update snapshot runtime)
+            runtime = (datetime.now()-start_runtime).total_seconds()
+
+        # Save snapshot, detected endpoints and stats (the date of the snapshot is the day before, i.e. detection date)
+        snapshot = save_results(campaign, analytic, fromdate.date(), runtime, data)
+
+        # if max hosts threshold is reached, we exit the for loop
+        if snapshot.hits_endpoints >= CAMPAIGN_MAX_HOSTS_THRESHOLD and max_hosts_threshold_reached(analytic):
+            break
 
         # Update Celery task progress
         celery_status.progress = (DB_DATA_RETENTION-days)*100/DB_DATA_RETENTION
@@ -190,7 +119,77 @@ def regenerate_stats(analytic_id):
 
     add_success_notification(f'Regenerate stats task for analytic "{analytic.name}" successfully completed.')
 
+def start_campaign_shards(campaigndate, resume=False):
+    """
+    Open the daily campaign and split its analytics into shards (up to CAMPAIGN_SHARD_SIZE analytics per shard).
+    Shards are run in parallel by the Celery workers (one subtask per shard), and the campaign is closed
+    by a finalizer once all shards are complete (chord). The TasksStatus object of the campaign must exist.
+    :param campaigndate: Date of the campaign.
+    :param resume: If True, only analytics missing or failed in the campaign are run.
+    :return: AsyncResult of the finalizer (None if there is no analytic to run).
+    """
+    campaign, analytics = open_campaign(campaigndate, resume=resume)
+    analytic_ids = [analytic.pk for analytic in analytics]
+
+    # no analytic to run, the campaign can be closed immediately
+    if not analytic_ids:
+        close_campaign(campaign, campaigndate)
+        return None
+
+    # Analytics are ordered by predicted runtime (longest first). They are dealt round-robin to the shards,
+    # so that long analytics are spread over all shards, and each shard runs its longest analytics first.
+    nb_shards = -(-len(analytic_ids) // CAMPAIGN_SHARD_SIZE)
+    header = group(
+        run_campaign_shard.s(campaign.pk, analytic_ids[i::nb_shards], campaigndate, len(analytic_ids))
+        for i in range(nb_shards)
+        )
+    result = chord(header)(close_campaign_shards.s(campaign.pk, campaigndate))
+
+    # Group ID is saved so that all subtasks can be revoked when the task is cancelled
+    result.parent.save()
+    TasksStatus.objects.filter(taskname=campaign.name).update(groupid=result.parent.id)
+
+    return result
+
+@shared_task()
+def run_campaign_shard(campaign_id, analytic_ids, campaigndate, nb_analytics):
+    # Run a subset of the analytics of a campaign (see start_campaign_shards)
+    campaign = get_object_or_404(Campaign, pk=campaign_id)
+    analytics = Analytic.objects.filter(pk__in=analytic_ids).select_related('connector', 'analyticmeta')
+    # analytics are run in the order of the shard (see start_campaign_shards)
+    analytics = sorted(analytics, key=lambda analytic: analytic_ids.index(analytic.pk))
+    task_status = get_object_or_404(TasksStatus, taskname=campaign.name)
+    return run_campaign_analytics(campaign, analytics, campaigndate, task_status, nb_analytics)
+
+@shared_task()
+def close_campaign_shards(nb_errors, campaign_id, campaigndate):
+    # Finalizer of a sharded campaign, called with the number of errors of each shard
+    campaign = get_object_or_404(Campaign, pk=campaign_id)
+    close_campaign(campaign, campaigndate, sum(nb_errors))
+
 @shared_task()
 def regenerate_campaign(campaigndate):
     # We assume that the task is managed by Celery because it is called from the tasks.py file
-    run_campaign(campaigndate=campaigndate, celery=True)
+    if CAMPAIGN_SHARD_SIZE:
+        start_campaign_shards(campaigndate)
+    else:
+        run_campaign(campaigndate=campaigndate, celery=True)
+
+@shared_task()
+def rebuild_analytic_host_scores(analytic_id):
+    # Scores of the hosts of the campaigns matching an analytic, rebuilt when the weighted relevance of the analytic changes
+    campaigns = Campaign.objects.filter(
+        snapshot__analytic_id=analytic_id,
+        snapshot__hits_endpoints__gt=0,
+        hostscore__isnull=False
+        ).distinct()
+    for campaign in campaigns:
+        rebuild_host_scores(campaign)
+
+@shared_task()
+def resume_campaign(campaigndate):
+    # Only analytics missing or failed in the campaign are run
+    if CAMPAIGN_SHARD_SIZE:
+        start_campaign_shards(campaigndate, resume=True)
+    else:
+        run_campaign(campaigndate=campaigndate, celery=True, resume=True)
@@ -1,3 +1,33 @@
+from datetime import date, datetime
 from django.test import TestCase
+from connectors import replay
+from qm.models import Analytic, AnalyticMeta, Campaign, Endpoint, Host
+from qm.results import get_host_ids, save_results
 
-# Create your tests here.
+
+class HostIdsTestCase(TestCase):
+    """
+    Hostnames are case insensitive: endpoints whose names only differ by case are linked to the same host.
+    """
+    def setUp(self):
+        connector = replay.create_connector()
+        # created in bulk, so that signals are not triggered (the replay connector is not a plugin)
+        Analytic.objects.bulk_create([Analytic(name='test_hostnames', connector=connector, query='test', status='PUB')])
+        self.analytic = Analytic.objects.get(name='test_hostnames')
+        AnalyticMeta.objects.create(analytic=self.analytic)
+        self.campaign = Campaign.objects.create(name='daily_cron_2025-01-02', date_start=datetime(2025, 1, 2))
+        Host.objects.create(hostname='host1', site='site1', first_seen=date(2025, 1, 1), last_seen=date(2025, 1, 1))
+
+    def test_get_host_ids(self):
+        host_ids = get_host_ids([['HOST1', 'site1', 1, ''], ['host1', 'site1', 1, '']], date(2025, 1, 1))
+        self.assertEqual(list(host_ids), ['host1'])
+
+    def test_save_results(self):
+        data = [['HOST1', 'site1', 3, ''], ['host1', 'site1', 2, ''], ['host2', 'site2', 1, '']]
+        snapshot = save_results(self.campaign, self.analytic, datetime(2025, 1, 1), 1.0, data)
+        self.assertEqual(snapshot.hits_endpoints, 3)
+        self.assertEqual(Endpoint.objects.filter(snapshot=snapshot).count(), 3)
+        self.assertEqual(
+            Endpoint.objects.filter(snapshot=snapshot, host__hostname__iexact='host1').values('host').distinct().count(),
+            1
+            )
@@ -34,6 +34,7 @@ urlpatterns = [
     path('about/', views.about, name='about'),
     path('managecampaigns/', views.managecampaigns, name='managecampaigns'),
     path('regencampaign/<str:campaign_name>/', views.regencampaign, name='regencampaign'),
+    path('resumecampaign/<str:campaign_name>/', views.resumecampaign, name='resumecampaign'),
     path('regencampaignstatus/<str:campaign_name>/', views.regencampaignstatus, name='regencampaignstatus'),
 
     path('edit_description_initial/<int:analytic_id>/', views.edit_description_initial, name='edit_description_initial'),
@@ -1,22 +1,18 @@
 from django.conf import settings
 from datetime import datetime, timedelta
-from qm.models import Campaign, Analytic, Snapshot, Endpoint, TasksStatus, CampaignCompletion
+from qm.models import Campaign, Analytic, Snapshot, TasksStatus, CampaignCompletion, HostScore
 from connectors.models import Connector
+from connectors.utils import reset_circuit_breakers
+from qm.engine import execute_analytics
+from qm.results import save_results, rebuild_host_scores
+from qm.scoring import score_campaign
+from qm.scheduler import schedule_analytics
 from django.shortcuts import get_object_or_404
-import numpy as np
-from scipy import stats
-from math import isnan
+from django.db.models import F
+from celery import current_app
+from celery.result import GroupResult
 import requests
-from notifications.utils import add_info_notification, add_success_notification, add_warning_notification, del_notification_by_uid
-
-# Dynamically import all connectors
-import importlib
-import pkgutil
-import plugins
-all_connectors = {}
-for loader, module_name, is_pkg in pkgutil.iter_modules(plugins.__path__):
-    module = importlib.import_module(f"plugins.{module_name}")
-    all_connectors[module_name] = module
+from notifications.utils import add_info_notification, add_success_notification, add_warning_notification
 
 PROXY = settings.PROXY
 STATIC_PATH = settings.STATIC_ROOT
@@ -25,8 +21,6 @@ UPDATE_ON = settings.UPDATE_ON
 DB_DATA_RETENTION = settings.DB_DATA_RETENTION
 GITHUB_LATEST_RELEASE_URL = settings.GITHUB_LATEST_RELEASE_URL
 GITHUB_COMMIT_URL = settings.GITHUB_COMMIT_URL
-CAMPAIGN_MAX_HOSTS_THRESHOLD = settings.CAMPAIGN_MAX_HOSTS_THRESHOLD
-ON_MAXHOSTS_REACHED = settings.ON_MAXHOSTS_REACHED
 
 
 def is_update_available():
@@ -102,226 +96,175 @@ def get_campaign_date(campaign):
     """
     return datetime.strptime(campaign.name.replace('daily_cron_', ''), "%Y-%m-%d").date()
 
-def run_campaign(campaigndate=None, debug=False, celery=False):
-
-    if not campaigndate:
-        campaigndate = datetime.now()
+def get_campaign_name(campaigndate):
+    """
+    Helper function to get the campaign name from the campaign date (format 'daily_cron_YYYY-MM-DD').
+    """
+    return 'daily_cron_{}'.format(campaigndate.strftime("%Y-%m-%d"))
 
-    add_info_notification(f"Running campaign for date: {campaigndate.strftime('%Y-%m-%d')}")
-    campaign_name = 'daily_cron_{}'.format(campaigndate.strftime("%Y-%m-%d"))
+def open_campaign(campaigndate, resume=False):
+    """
+    Create the daily campaign (or get the existing one if resumed) and list the analytics to run.
+    Analytics are ordered by predicted runtime (longest first, see qm.scheduler), and the predicted duration
+    of the campaign is saved.
+    :param campaigndate: Date of the campaign.
+    :param resume: If True, the existing campaign is reused and only analytics without snapshot in this campaign
+        (missing or failed) are listed.
+    :return: Tuple (campaign, ordered list of analytics).
+    """
+    if resume:
+        add_info_notification(f"Resuming campaign for date: {campaigndate.strftime('%Y-%m-%d')}")
+    else:
+        add_info_notification(f"Running campaign for date: {campaigndate.strftime('%Y-%m-%d')}")
 
-    if celery:
-        # if task is managed by Celery, no need to create a new TasksStatus object as it is already created
-        task_status = get_object_or_404(TasksStatus, taskname=campaign_name)
+    # Create Campaign (or get the existing one if resumed)
+    if resume:
+        campaign, created = Campaign.objects.get_or_create(
+            name=get_campaign_name(campaigndate),
+            defaults={
+                'description': 'Daily cron job, run all analytics',
+                'date_start': datetime.now()
+            })
     else:
-        # if task is started by cron, we create a new TasksStatus object
-        task_status = TasksStatus(taskname=campaign_name)
-        task_status.save()
+        campaign = Campaign(
+            name=get_campaign_name(campaigndate),
+            description='Daily cron job, run all analytics',
+            date_start=datetime.now()
+            )
+        campaign.save()
 
+    # Progress is computed on the analytics of this run (the TasksStatus object may remain from an interrupted run)
+    TasksStatus.objects.filter(taskname=campaign.name).update(progress=0)
 
-    # Define the range (day-1@midnight to day@midnight)
-    from_date = datetime.combine(campaigndate - timedelta(days=1), datetime.min.time())
-    to_date = datetime.combine(campaigndate, datetime.min.time())
+    # Data lakes are tried again, even if they were failing in the previous run
+    reset_circuit_breakers()
 
-    # Create Campaign
-    campaign = Campaign(
-        name=campaign_name,
-        description='Daily cron job, run all analytics',
-        date_start=datetime.now()
-        )
-    campaign.save()
-    
     # List of analytics with the run_daily flag but not archived
-    analytics = Analytic.objects.filter(run_daily=True).exclude(status='ARCH')
+    analytics = Analytic.objects.filter(run_daily=True).exclude(status='ARCH').select_related('connector', 'analyticmeta')
+    # A snapshot is saved (in a single transaction) for each completed analytic. Analytics with a snapshot are skipped when resuming.
+    if resume:
+        analytics = analytics.exclude(snapshot__campaign=campaign)
 
-    # Filter analytic with the "run_daily" flag set
-    for progress, analytic in enumerate(analytics, start=1):
-        
-        # we assume that analytic won't fail (flag will be set later if analytic fails).
-        analytic.analyticmeta.query_error = False
-        analytic.analyticmeta.query_error_message = ''
-        analytic.analyticmeta.query_error_date = None
-        analytic.analyticmeta.save()
-                
-        # store current time (used to update snapshot runtime)
-        start_runtime = datetime.now()
-        
-        # Call the "query" function of the appropriate connector
-        # Number of endpoints is evaluated by length of data. The data arrary returned should have the following fields:
-        #  - endpoint name
-        #  - site name (endpoint name group)
-        #  - number of events
-        #  - storylineIDs separated by commas
-        data = all_connectors.get(analytic.connector.name).query(
-            analytic=analytic,
-            from_date=from_date.isoformat(),
-            to_date=to_date.isoformat(),
-            debug=debug
-            )
+    # Longest analytics are started first
+    analytics, predicted_duration = schedule_analytics(analytics)
+    # When a campaign is resumed, the prediction of the initial run is kept
+    if campaign.predicted_duration is None:
+        campaign.predicted_duration = predicted_duration
+        campaign.save(update_fields=['predicted_duration'])
 
-        # if error, we exit the for loop
-        if data == "ERROR":
-            break
+    return campaign, analytics
 
-        # store current time (used to update snapshot runtime)
-        end_runtime = datetime.now()
+def run_campaign_analytics(campaign, analytics, campaigndate, task_status, nb_analytics, debug=False):
+    """
+    Run a list of analytics and save their results in the campaign.
+    Analytics that fail are skipped (no snapshot is created for them).
+    :param campaign: Campaign object.
+    :param analytics: List of analytics to run, in order (may be a subset of the campaign analytics, see qm.tasks.run_campaign_shard).
+    :param campaigndate: Date of the campaign. Analytics are run for the day before.
+    :param task_status: TasksStatus object used to report progress.
+    :param nb_analytics: Total number of analytics in the campaign (used to compute progress).
+    :return: Number of failed analytics.
+    """
+    # Define the range (day-1@midnight to day@midnight)
+    from_date = datetime.combine(campaigndate - timedelta(days=1), datetime.min.time())
+    to_date = datetime.combine(campaigndate, datetime.min.time())
+    nb_errors = 0
 
-        # Create snapshot. Necessary to have the object to link the detected assets.
-        # Stats will be updated later to the snapshot
-        # the date of the snapshot is the day before the campaign (detection date)
-        snapshot = Snapshot(
-            campaign=campaign,
-            analytic=analytic,
-            date=campaigndate-timedelta(days=1),
-            runtime = (end_runtime-start_runtime).total_seconds()
-            )
-        snapshot.save()
-                
-        if debug:
-            print(f'***DATA: {data}')
-        
-        if len(data) != 0:
-            
-            # there are results, we can update the last_time_seen field of the analytic
-            analytic.analyticmeta.last_time_seen = snapshot.date
-            analytic.analyticmeta.save()
+    # Queries are run concurrently by the campaign engine (max number of in-flight queries defined per connector).
+    # Results are saved in DB as soon as each query completes.
+    for analytic, data, runtime in execute_analytics(analytics, from_date.isoformat(), to_date.isoformat(), debug=debug):
 
-            hits_endpoints = len(data)
-            hits_count = 0
-            
-            for i in data:
-                
-                # The storylineid field has 255 chars max
-                if len(i[3]) < 255:
-                    storylineid = i[3][1:][:-1]
-                else:
-                    storylineid = ''
-                
-                # update detected endpoints and link it with current snapshot
-                endpoint = Endpoint(
-                    hostname = i[0],
-                    site = i[1],
-                    snapshot = snapshot,
-                    storylineid = storylineid
-                )
-                endpoint.save()
-                # count nb of hits
-                hits_count += int(float(i[2]))
-        else:
-            if debug:
-                print('NO DATA!')
-            hits_count = 0
-            hits_endpoints = 0
-        
-        if debug:
-            print(f"*** HITS_COUNT = {hits_count}")
-            print(f"*** HITS_ENDPOINTS = {hits_endpoints}")
-        
-        # Now that stats have been collected, snapshot is updated.
-        snapshot.hits_count = hits_count
-        snapshot.hits_endpoints = hits_endpoints
-        snapshot.save()
-        if debug:
-            print("Snapshot created")
-        
-        # When the max_hosts threshold is reached (by default 1000)
-        if hits_endpoints >= CAMPAIGN_MAX_HOSTS_THRESHOLD:
-            # Send notification
-            del_notification_by_uid(f"max_number_hosts_reached_{datetime.now().strftime('%Y%m%d')}_{analytic.id}")
-            add_info_notification(f"Max number of hosts reached for analytic {analytic.name}", uid=f"max_number_hosts_reached_{datetime.now().strftime('%Y%m%d')}_{analytic.id}")
-            # Update the maxhost counter if reached
-            analytic.analyticmeta.maxhosts_count += 1
-            # if threshold is reached
-            if analytic.analyticmeta.maxhosts_count >= ON_MAXHOSTS_REACHED['THRESHOLD']:
-                # notification
-                add_warning_notification(f"Max hosts threshold reached for analytic {analytic.name}")
-                # If DISABLE_RUN_DAILY is set and run_daily_lock is not set, we disable the run_daily flag for the analytic
-                if ON_MAXHOSTS_REACHED['DISABLE_RUN_DAILY'] and not analytic.run_daily_lock:
-                    analytic.run_daily = False
-                    analytic.status = 'PENDING'
-                # If DELETE_STATS is set and run_daily_lock is not set, we delete all stats for the analytic
-                if ON_MAXHOSTS_REACHED['DELETE_STATS'] and not analytic.run_daily_lock:
-                    Snapshot.objects.filter(analytic=analytic).delete()
-            # we update the analytic (counter updated, and flags updated)
-            analytic.save()
-            analytic.analyticmeta.save()
-            if debug:
-                print("Max hosts threshold reached. Counter updated")            
-        
-        # Anomaly detection for hits_count (compute zscore against all snapshots available in DB)
-        if debug:
-            print("Anomaly detection for hits_count")
-        snapshots = Snapshot.objects.filter(analytic=analytic)
-        a = np.array([c.hits_count for c in snapshots])
-        z = stats.zscore(a)
-        if debug:
-            for i,v in enumerate(a):
-                print( '{},{}'.format(v,z[i]) )
-        zscore_count = z[-1]
-        if isnan(zscore_count):
-            zscore_count = -9999
-        if zscore_count > analytic.anomaly_threshold_count:
-            anomaly_alert_count = True
-        else:
-            anomaly_alert_count = False
-        
-        # Anomaly detection for hits_endpoints (compute zscore against all snapshots available in DB)
-        if debug:
-            print("Anomaly detection for hits_endpoints")
-        a = np.array([c.hits_endpoints for c in snapshots])
-        z = stats.zscore(a)
-        if debug:
-            for i,v in enumerate(a):
-                print( '{},{}'.format(v,z[i]) )
-        zscore_endpoints = z[-1]
-        if isnan(zscore_endpoints):
-            zscore_endpoints = -9999
-        if zscore_endpoints > analytic.anomaly_threshold_endpoints:
-            anomaly_alert_endpoints = True
+        # if error, the analytic is skipped (it can be run again by resuming the campaign)
+        if data == "ERROR":
+            nb_errors += 1
         else:
-            anomaly_alert_endpoints = False
+            # Save snapshot, detected endpoints and stats (the date of the snapshot is the day before the campaign, i.e. detection date)
+            # zscores are computed for all analytics once the campaign is complete
+            save_results(campaign, analytic, campaigndate-timedelta(days=1), runtime, data, score=False, debug=debug)
         
-        # Final update of snapshots with stats for the last snapshot (just created above)
-        if debug:
-            print("***Final update for new snapshot")
-            print("snapshot.zscore_count = {}".format(zscore_count))
-            print("snapshot.zscore_endpoints = {}".format(zscore_endpoints))
-            print("snapshot.anomaly_alert_count = {}".format(anomaly_alert_count))
-            print("snapshot.anomaly_alert_endpoints = {}".format(anomaly_alert_endpoints))
-        
-        snapshot.zscore_count = zscore_count
-        snapshot.zscore_endpoints = zscore_endpoints
-        snapshot.anomaly_alert_count = anomaly_alert_count
-        snapshot.anomaly_alert_endpoints = anomaly_alert_endpoints
-        snapshot.save()
-        
-        # update task progress
-        task_status.progress = progress / analytics.count() * 100
-        task_status.save()
+        # update task progress (incremented in DB, as several shards of the campaign may run in parallel)
+        TasksStatus.objects.filter(pk=task_status.pk).update(progress=F('progress') + 100 / nb_analytics)
 
         if debug:
-            print(f"PROGRESS: {progress / analytics.count() * 100}%")
+            print(f"PROGRESS: {TasksStatus.objects.get(pk=task_status.pk).progress}%")
             print("================================")
 
+    return nb_errors
+
+def close_campaign(campaign, campaigndate, nb_errors=0, debug=False):
+    """
+    Close the campaign once all analytics have run: anomaly detection, scores of the hosts, campaign stats and completion per connector.
+    The TasksStatus object of the campaign is deleted.
+    :param campaign: Campaign object.
+    :param campaigndate: Date of the campaign.
+    :param nb_errors: Number of failed analytics.
+    """
+    # Anomaly detection for all analytics of the campaign
+    score_campaign(campaign, debug=debug)
+
+    # Scores of the hosts (reports and dashboards)
+    rebuild_host_scores(campaign)
 
     # Close Campaign
     campaign.date_end = datetime.now()
     campaign.nb_queries = Analytic.objects.exclude(status='ARCH').filter(run_daily=True).count()
     campaign.nb_analytics = Analytic.objects.exclude(status='ARCH').count()
-    campaign.nb_endpoints = Endpoint.objects.filter(snapshot__campaign=campaign).values('hostname').distinct().count()
+    campaign.nb_endpoints = HostScore.objects.filter(campaign=campaign).count()
     campaign.save()
 
     for connector in Connector.objects.filter(domain="analytics", enabled=True):
-        CampaignCompletion(
+        CampaignCompletion.objects.update_or_create(
             campaign=campaign,
             connector=connector,
-            nb_queries_complete=Snapshot.objects.filter(campaign=campaign, analytic__connector=connector).count()
-        ).save()
+            defaults={
+                'nb_queries_complete': Snapshot.objects.filter(campaign=campaign, analytic__connector=connector).count()
+            })
+
+    # Delete task in DB
+    TasksStatus.objects.filter(taskname=campaign.name).delete()
+
+    if nb_errors:
+        add_warning_notification(f"Campaign for date {campaigndate.strftime('%Y-%m-%d')} complete with {nb_errors} failed analytic(s). Resume the campaign to run them again.")
+    else:
+        add_success_notification(f"Campaign for date {campaigndate.strftime('%Y-%m-%d')} complete")
+
+def run_campaign(campaigndate=None, debug=False, celery=False, resume=False):
+    """
+    Run all analytics with the run_daily flag set (not archived) and save results in a daily campaign.
+    Analytics that fail are skipped (no snapshot is created for them) without stopping the campaign.
+    :param campaigndate: Date of the campaign (defaults to today). Analytics are run for the day before.
+    :param celery: True if the task is managed by Celery (TasksStatus object already created).
+    :param resume: If True, the existing campaign is reused and only analytics without snapshot in this campaign
+        (missing or failed) are run.
+    """
+
+    if not campaigndate:
+        campaigndate = datetime.now()
 
-    # Delete Celery task in DB if celery is used
-    task_status.delete()
+    if celery:
+        # if task is managed by Celery, no need to create a new TasksStatus object as it is already created
+        task_status = get_object_or_404(TasksStatus, taskname=get_campaign_name(campaigndate))
+    else:
+        # if task is started by cron, we create a new TasksStatus object
+        # (it may remain from an interrupted run when the campaign is resumed)
+        task_status, created = TasksStatus.objects.get_or_create(taskname=get_campaign_name(campaigndate))
+
+    campaign, analytics = open_campaign(campaigndate, resume=resume)
+    nb_errors = run_campaign_analytics(campaign, analytics, campaigndate, task_status, len(analytics), debug=debug)
+    close_campaign(campaign, campaigndate, nb_errors, debug=debug)
 
-    add_success_notification(f"Campaign for date {campaigndate.strftime('%Y-%m-%d')} complete")
+def revoke_task(task_status):
+    """
+    Revoke a Celery task, and its subtasks if the task has been split (distributed campaigns).
+    :param task_status: TasksStatus object.
+    """
+    # without signal='SIGKILL', the task is not cancelled immediately
+    if task_status.taskid:
+        current_app.control.revoke(task_status.taskid, terminate=True, signal='SIGKILL')
+    if task_status.groupid:
+        group_result = GroupResult.restore(task_status.groupid, app=current_app)
+        if group_result:
+            group_result.revoke(terminate=True, signal='SIGKILL')
 
 
 def get_available_statuses(analytic, edit=False):
@@ -4,7 +4,8 @@ from django.template.loader import render_to_string
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required, permission_required
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse
-from django.db.models import Q, Sum, Count, F
+from django.db.models import Q, Sum, Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.core.paginator import Paginator
 from django.urls import reverse
 from datetime import datetime, timedelta, timezone
@@ -16,11 +17,12 @@ from .models import (Country, Analytic, Snapshot, Campaign, TargetOs, Vulnerabil
     SavedSearch, Repo, CampaignCompletion)
 from notifications.models import UserNotification
 from connectors.models import Connector
-from .tasks import regenerate_stats, regenerate_campaign
+from .tasks import regenerate_stats, regenerate_campaign, resume_campaign
 import ipaddress
 from connectors.utils import is_connector_enabled, is_connector_for_analytics, get_connector_conf
-from celery import current_app
-from .utils import get_campaign_date, get_available_statuses, find_sha_by_parent_sha
+from .utils import get_campaign_date, get_available_statuses, find_sha_by_parent_sha, revoke_task
+from .results import reset_stats
+from .purge import purge_snapshots
 from urllib.parse import urlencode, quote
 from .forms import (ReviewForm, EditAnalyticDescriptionForm, EditAnalyticNotesForm,
                     EditAnalyticQueryForm, SavedSearchForm, AnalyticForm, TagForm,
@@ -277,27 +279,28 @@ def list_analytics(request):
     # Exclude analytics that are archived
     analytics = analytics.exclude(status='ARCH').distinct()
 
-    for analytic in analytics:
-        snapshot = Snapshot.objects.filter(analytic=analytic, date=datetime.today()-timedelta(days=1)).order_by('date')
-        if len(snapshot) > 0:
-            snapshot = snapshot[0]
-            analytic.hits_endpoints = snapshot.hits_endpoints
-            analytic.hits_count = snapshot.hits_count
-            analytic.anomaly_alert_count = snapshot.anomaly_alert_count
-            analytic.anomaly_alert_endpoints = snapshot.anomaly_alert_endpoints
-        else:
-            analytic.hits_endpoints = 0
-            analytic.hits_count = 0
-        
-        # Sparkline: show sparkline only for last 20 days event count
-        snapshots = Snapshot.objects.filter(analytic=analytic, date__gt=datetime.today()-timedelta(days=20))
-        analytic.sparkline = [snapshot.hits_endpoints for snapshot in snapshots]
-        
+    # Stats of yesterday's snapshot, computed by the database (0 if the analytic has no snapshot yesterday)
+    last_snapshot = Snapshot.objects.filter(analytic=OuterRef('pk'), date=(datetime.today()-timedelta(days=1)).date())
+    analytics = analytics.select_related('connector', 'category', 'analyticmeta', 'analyticsparkline').annotate(
+        hits_count=Coalesce(Subquery(last_snapshot.values('hits_count')[:1]), 0),
+        hits_endpoints=Coalesce(Subquery(last_snapshot.values('hits_endpoints')[:1]), 0),
+        anomaly_alert_count=Subquery(last_snapshot.values('anomaly_alert_count')[:1]),
+        anomaly_alert_endpoints=Subquery(last_snapshot.values('anomaly_alert_endpoints')[:1])
+        )
+
     # Paginate the analytics list
-    analytics_count = analytics.count()
     paginator = Paginator(analytics, ANALYTICS_PER_PAGE)
+    analytics_count = paginator.count
     page_number = int(request.GET.get('page', 1))
     page_obj = paginator.get_page(page_number)
+
+    # Sparkline: hosts of the last 20 days (precomputed series, see qm.results)
+    for analytic in page_obj:
+        if hasattr(analytic, 'analyticsparkline'):
+            analytic.sparkline = analytic.analyticsparkline.series('hits_endpoints', datetime.today().date())
+        else:
+            analytic.sparkline = []
+
     # Save filters to query string for pagination
     querydict = request.GET.copy()
     if 'page' in querydict:
@@ -345,7 +348,7 @@ def list_analytics(request):
 @permission_required("qm.view_snapshot", raise_exception=True)
 def trend(request, analytic_id, tab=0):
     analytic = get_object_or_404(Analytic, pk=analytic_id)
-    endpoints = Endpoint.objects.filter(snapshot__analytic=analytic).values('hostname').distinct()
+    endpoints = Endpoint.objects.filter(snapshot__analytic=analytic).values('host__hostname').distinct()
 
     context = {
         'analytic': analytic,
@@ -401,8 +404,8 @@ def analyticdetail(request, analytic_id):
         snapshots = Snapshot.objects.filter(analytic=analytic, date=datetime.today()-timedelta(days=1))
         endpoints = []
         for snapshot in snapshots:
-            for e in Endpoint.objects.filter(snapshot=snapshot):
-                endpoints.append(e.hostname)
+            for e in Endpoint.objects.filter(snapshot=snapshot).select_related('host'):
+                endpoints.append(e.host.hostname)
         # remove duplicated values (due to endpoints appearing in several snapshots)
         endpoints = list(set(endpoints))[:10]
     except:
@@ -455,7 +458,7 @@ def tl_timeline(request, hostname):
 
     apps = ''
 
-    endpoints = Endpoint.objects.filter(hostname=hostname).order_by('snapshot__date')
+    endpoints = Endpoint.objects.filter(host__hostname=hostname).select_related('snapshot__analytic__connector').order_by('snapshot__date')
     for e in endpoints:
         # search if group already exists
         g = next((group for group in groups if group['content'] == f'{e.snapshot.analytic.name} ({e.snapshot.analytic.connector.name})'), None)
@@ -568,7 +571,7 @@ def tl_timeline(request, hostname):
                                 iid += 1
 
     # Visualization #2 (graph)
-    items2 = Endpoint.objects.filter(hostname=hostname) \
+    items2 = Endpoint.objects.filter(host__hostname=hostname) \
         .values('snapshot__date') \
         .annotate(cumulative_score=Sum('snapshot__analytic__weighted_relevance')) \
         .order_by('snapshot__date')
@@ -711,10 +714,10 @@ def regen(request, analytic_id):
 @permission_required("qm.change_snapshot", raise_exception=True)
 def cancelregen(request, taskid):
     try:
-        # without signal='SIGKILL', the task is not cancelled immediately
-        current_app.control.revoke(taskid, terminate=True, signal='SIGKILL')
-        # delete task in DB
         celery_status = get_object_or_404(TasksStatus, taskid=taskid)
+        # revoke the task and its subtasks (distributed campaigns)
+        revoke_task(celery_status)
+        # delete task in DB
         celery_status.delete()
         return HttpResponse('stopping...')
     except Exception as e:
@@ -736,7 +739,8 @@ def progress(request, analytic_id):
 @permission_required("qm.delete_snapshot", raise_exception=True)
 def deletestats(request, analytic_id):
     analytic = get_object_or_404(Analytic, pk=analytic_id)
-    Snapshot.objects.filter(analytic=analytic).delete()
+    purge_snapshots(Snapshot.objects.filter(analytic=analytic), update_stats=False)
+    reset_stats(analytic)
     return HttpResponse('Stats deleted')
 
 @login_required
@@ -885,6 +889,7 @@ def regencampaign(request, campaign_name):
     campaign_name = campaign.name
     campaign_date = get_campaign_date(campaign)
     # Delete campaign and all related snapshots/endpoints
+    purge_snapshots(Snapshot.objects.filter(campaign=campaign))
     campaign.delete()
     
     # start the celery task (defined in qm/tasks.py)
@@ -900,6 +905,29 @@ def regencampaign(request, campaign_name):
 
     return HttpResponse('running...')
 
+@login_required
+@permission_required("qm.change_campaign", raise_exception=True)
+def resumecampaign(request, campaign_name):
+    campaign = get_object_or_404(Campaign, name=campaign_name)
+    campaign_date = get_campaign_date(campaign)
+
+    # Create task in TasksStatus object before the task starts (the task reads it).
+    # The campaign can't be resumed while it is running (from cron or from another resume).
+    celery_status, created = TasksStatus.objects.get_or_create(
+        taskname=campaign.name,
+        defaults={'started_by': request.user}
+    )
+    if not created:
+        return HttpResponse('campaign already running')
+
+    # start the celery task (defined in qm/tasks.py). Only analytics missing or failed in the campaign are run
+    taskid = resume_campaign.delay(campaigndate=campaign_date)
+    # only the task ID is saved (the group ID may have been saved by the task already)
+    celery_status.taskid = taskid
+    celery_status.save(update_fields=['taskid'])
+
+    return HttpResponse('running...')
+
 @login_required
 def regencampaignstatus(request, campaign_name):
     try:
@@ -911,7 +939,7 @@ def regencampaignstatus(request, campaign_name):
         button += '</span>'
         return HttpResponse(button)
     except:
-        return HttpResponse(f'<button hx-get="/qm/regencampaign/{campaign_name}/" class="buttonred">Regenerate</button>')
+        return HttpResponse(f'<button hx-get="/qm/resumecampaign/{campaign_name}/" class="button">Resume</button> <button hx-get="/qm/regencampaign/{campaign_name}/" class="buttonred">Regenerate</button>')
 
 @login_required
 @permission_required("qm.view_savedsearch", raise_exception=True)
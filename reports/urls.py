@@ -12,4 +12,5 @@ urlpatterns = [
     path('endpoints_most_analytics/', views.endpoints_most_analytics, name='endpoints_most_analytics'),
     path('upcoming-analytic-reviews/', views.upcoming_analytic_reviews, name='upcoming_analytic_reviews'),
     path('highest_weighted_score/', views.highest_weighted_score, name='highest_weighted_score'),
+    path('duplicate_queries/', views.duplicate_queries, name='duplicate_queries'),
 ]
@@ -3,11 +3,13 @@ import json
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required, permission_required
 from django.utils import timezone
-from django.db.models import Q, Sum, Count, F
+from django.db.models import Q, Sum, Count, F, OuterRef, Subquery
 from django.core.paginator import Paginator
 from datetime import datetime, timedelta
-from qm.models import Analytic, Snapshot, Campaign, MitreTactic, MitreTechnique, Endpoint, Connector, CampaignCompletion
+from qm.models import Analytic, Snapshot, Campaign, MitreTactic, MitreTechnique, Endpoint, Connector, CampaignCompletion, HostScore
 from notifications.utils import add_debug_notification
+from connectors.utils import group_by_query
+from qm.results import get_host_scores
 from collections import defaultdict
 import time
 
@@ -67,6 +69,7 @@ def campaigns_stats(request):
                 'date':d,
                 'count_analytics':campaign.nb_queries,
                 'duration':duration,
+                'predicted_duration':round(campaign.predicted_duration/60, 1) if campaign.predicted_duration is not None else 0,
                 'count_endpoints_total':campaign.nb_endpoints,
                 })
         except:
@@ -74,6 +77,7 @@ def campaigns_stats(request):
                 'date':d,
                 'count_analytics':0,
                 'duration':0,
+                'predicted_duration':0,
                 'count_endpoints_total':0
                 })
     
@@ -217,21 +221,16 @@ def endpoints(request):
 
     campaign = get_object_or_404(Campaign, id=selected_campaign_id)
 
-    # Get top endpoints
-    endpoints_qs = (
-        Endpoint.objects
-        .filter(snapshot__campaign=campaign)
-        .values('hostname', 'site')
-        .annotate(total=Sum('snapshot__analytic__weighted_relevance'))
-        .order_by('-total')[:300]
-    )
+    # Get top endpoints (computed from the endpoints if the campaign is not closed yet)
+    endpoints_qs = list(get_host_scores(campaign)[:300])
 
     # Get all analytics for these endpoints in one query
-    hostnames = [e['hostname'] for e in endpoints_qs]
+    host_ids = [e['host'] for e in endpoints_qs]
     analytics_qs = (
         Endpoint.objects
-        .filter(snapshot__campaign=campaign, hostname__in=hostnames)
+        .filter(snapshot__campaign=campaign, host_id__in=host_ids)
         .select_related(
+            'host',
             'snapshot__analytic__connector',
             'snapshot__analytic__category'
         )
@@ -244,8 +243,8 @@ def endpoints(request):
         a = analytic.snapshot.analytic
         startdate = analytic.snapshot.date.strftime('%Y-%m-%d')
         connector_name = a.connector.name
-        xdrlink = all_connectors.get(connector_name).get_redirect_analytic_link(a, filter_date=startdate, endpoint_name=analytic.hostname)
-        analytics_by_hostname[analytic.hostname].append({
+        xdrlink = all_connectors.get(connector_name).get_redirect_analytic_link(a, filter_date=startdate, endpoint_name=analytic.host.hostname)
+        analytics_by_hostname[analytic.host.hostname].append({
             "analyticid": a.id,
             "name": a.name,
             "connector": connector_name,
@@ -259,12 +258,12 @@ def endpoints(request):
     # Build data for template
     data = []
     for endpoint in endpoints_qs:
-        hostname = endpoint['hostname']
+        hostname = endpoint['host__hostname']
         site = endpoint['site']
         data.append({
             "hostname": hostname,
             "site": site,
-            "total": endpoint['total'],
+            "total": endpoint['total_weighted_score'],
             "analytics": analytics_by_hostname.get(hostname, [])
         })
 
@@ -286,18 +285,23 @@ def endpoints(request):
 def analytics_perfs(request):
     start_time = time.time()
     yesterday = datetime.now() - timedelta(days=1)
-    snapshots = Snapshot.objects.filter(date=yesterday).order_by('-runtime')
+    snapshots = Snapshot.objects.filter(date=yesterday).select_related(
+        'analytic__connector', 'analytic__analyticsparkline').order_by('-runtime')
     analytics = []
     
     for snapshot in snapshots:
-        analytic_snapshots = Snapshot.objects.filter(analytic=snapshot.analytic, date__gt=datetime.today()-timedelta(days=20)).order_by('date')
+        # Sparkline: runtime of the last 20 days (precomputed series, see qm.results)
+        if hasattr(snapshot.analytic, 'analyticsparkline'):
+            sparkline = snapshot.analytic.analyticsparkline.series('runtime', datetime.today().date())
+        else:
+            sparkline = []
         analytics.append({
                 'id': snapshot.analytic.id,
                 'name': snapshot.analytic.name,
                 'connector': snapshot.analytic.connector.name,
                 'runtime': snapshot.runtime,
                 'status': snapshot.analytic.status,
-                'sparkline': [analytic_snapshot.runtime for analytic_snapshot in analytic_snapshots]
+                'sparkline': sparkline
             })
 
     paginator = Paginator(analytics, ANALYTICS_PER_PAGE)
@@ -374,7 +378,7 @@ def rare_occurrences(request):
             'snapshot__analytic__relevance',
             'snapshot__analytic__description',
             'snapshot__analytic__query',
-            'hostname'
+            'host__hostname'
         )
         .exclude(snapshot__analytic__status='ARCH')
     )
@@ -405,7 +409,7 @@ def rare_occurrences(request):
         analytic['relevance'] = row['snapshot__analytic__relevance']
         analytic['description'] = row['snapshot__analytic__description']
         analytic['query'] = row['snapshot__analytic__query']
-        analytic['hostnames'].add(row['hostname'])
+        analytic['hostnames'].add(row['host__hostname'])
 
     # Filter analytics with rare occurrences
     data = []
@@ -449,7 +453,7 @@ def endpoints_most_analytics(request):
     # Limited to first 300 endpoints with the most analytics
     top_endpoints = (
         Endpoint.objects
-        .values('hostname', 'site')
+        .values('host', 'host__hostname', 'host__site')
         .annotate(analytics_count=Count('snapshot__analytic', distinct=True))
         .order_by('-analytics_count')[:300]
     )
@@ -491,24 +495,23 @@ def highest_weighted_score(request):
     start_time = time.time()
     results = []
     highest_score = 0
-    campaigns = Campaign.objects.filter(name__startswith='daily_cron_').order_by('date_start')
+    # Host with the highest score of each campaign, in one query (scores of the hosts are computed when the campaign is closed)
+    top_hostscore = HostScore.objects.filter(campaign=OuterRef('pk')).order_by('-total_weighted_score')
+    campaigns = Campaign.objects.filter(name__startswith='daily_cron_').annotate(
+        highest_weighted_relevance=Subquery(top_hostscore.values('total_weighted_score')[:1]),
+        hostname=Subquery(top_hostscore.values('host__hostname')[:1])
+        ).order_by('date_start')
     for campaign in campaigns:
-        qs = Endpoint.objects.filter(
-            snapshot__campaign=campaign
-        ).values('hostname').annotate(
-            total_weighted_score=Sum(F('snapshot__analytic__weighted_relevance'))
-        ).order_by('-total_weighted_score')
-        highestweightedscore = qs.first()
-        if highestweightedscore:
-            highest_weighted_relevance = highestweightedscore['total_weighted_score']
-            hostname = highestweightedscore['hostname']
-        else:
-            highest_weighted_relevance = 0
-            hostname = ''
+        # campaigns not closed yet (running or interrupted) have no host scores
+        if campaign.highest_weighted_relevance is None:
+            top_host = get_host_scores(campaign).first()
+            if top_host:
+                campaign.hostname = top_host['host__hostname']
+                campaign.highest_weighted_relevance = top_host['total_weighted_score']
         results.append({
             "date": campaign.date_start,
-            "hostname": hostname,
-            "highest_weighted_relevance": highest_weighted_relevance,
+            "hostname": campaign.hostname or '',
+            "highest_weighted_relevance": campaign.highest_weighted_relevance or 0,
             "color": "#4661EE"  # Default color (light blue)
             })
 
@@ -524,3 +527,18 @@ def highest_weighted_score(request):
         'elapsed_time': elapsed_time,
     }
     return render(request, 'highest_weighted_score.html', context)
+
+@login_required
+@permission_required('qm.view_analytic', raise_exception=True)
+def duplicate_queries(request):
+    start_time = time.time()
+    analytics = Analytic.objects.exclude(status='ARCH').select_related('connector').order_by('name')
+    # Analytics sharing the same query (regardless of whitespaces) on the same connector
+    groups = [group for group in group_by_query(analytics).values() if len(group) > 1]
+    groups.sort(key=lambda group: len(group), reverse=True)
+    elapsed_time = time.time() - start_time
+    context = {
+        'groups': groups,
+        'elapsed_time': elapsed_time,
+    }
+    return render(request, 'duplicate_queries.html', context)
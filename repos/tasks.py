@@ -9,7 +9,7 @@ from django.db import transaction
 from .models import Repo, RepoAnalytic
 from qm.models import Analytic, Category, TargetOs, ThreatName, ThreatActor, Vulnerability, MitreTechnique, TasksStatus
 from connectors.models import Connector
-import requests
+from connectors.utils import get_http_session
 from json.decoder import JSONDecodeError
 from pathlib import Path
 import time
@@ -67,7 +67,7 @@ def import_repo_task(repo_id, mode, selected_analytics=None):
             stop = False
             update_analytic = False
 
-            results = requests.get(
+            results = get_http_session(content.get('download_url')).get(
                 content.get('download_url'),
                 proxies=PROXY
             )
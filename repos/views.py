@@ -7,7 +7,7 @@ from qm.models import TasksStatus
 from repos.models import Repo
 from .forms import RepoForm
 from repos.tasks import import_repo_task
-import requests
+from connectors.utils import get_http_session
 from urllib.parse import unquote
 import base64
 from notifications.utils import add_debug_notification, add_error_notification, add_success_notification, add_info_notification
@@ -68,8 +68,9 @@ def preview(request, url):
     # Add back padding if necessary
     padding = '=' * (-len(url) % 4)
     url += padding
-    results = requests.get(
-        unquote(base64.urlsafe_b64decode(url).decode()),
+    download_url = unquote(base64.urlsafe_b64decode(url).decode())
+    results = get_http_session(download_url).get(
+        download_url,
         proxies=PROXY
     )
     return HttpResponse(results.json() if results.headers.get('Content-Type') == 'application/json' else results.text)